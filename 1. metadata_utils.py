@@ -2,30 +2,24 @@
 import os
 import glob
 import pandas as pd
+import catalog_utils
 
 def parse_mtl_file(mtl_path):
-    meta = {}
-    with open(mtl_path, "r") as f:
-        for line in f:
-            if "=" in line:
-                key, value = line.strip().split(" = ")
-                meta[key.strip()] = value.strip().strip('"')
-    return meta
+    # Shared with the scene catalog and reflectance extraction
+    return catalog_utils.parse_mtl_file(mtl_path)
 
 
 def assign_flood_type(date_str):
-    try:
-        month = int(date_str.split("-")[1])
-        if month in [12, 1, 2, 3]:
-            return "BF"
-        if month in [6, 7, 8, 9, 10, 11]:
-            return "WF"
-        return "Unknown"
-    except Exception:
-        return "Unknown"
-
-
-def extract_metadata_from_folder(base_path):
+    # Shared with the scene catalog and the datacube
+    return catalog_utils.assign_flood_type(date_str)
+
+
+def extract_metadata_from_folder(base_path, catalog=None):
+    # With a SceneCatalog only new or changed folders are reparsed
+    if catalog is not None:
+        catalog.scan(base_path)
+        return catalog.metadata_frame(base_path=base_path)
+
     records = []
     folders = [f.path for f in os.scandir(base_path) if f.is_dir()]
 
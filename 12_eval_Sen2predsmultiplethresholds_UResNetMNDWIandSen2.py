@@ -1,4 +1,3 @@
-
 """
 Evaluate U-Net/MNDWI flood predictions against Sentinel-2 and ISO reference maps
 using multiple thresholds: Threshold params {0.10, 0.20, 0.22, 0.40, 0.90} .
@@ -6,11 +5,13 @@ using multiple thresholds: Threshold params {0.10, 0.20, 0.22, 0.40, 0.90} .
 
 import os
 import rasterio
-from rasterio.mask import mask
 import geopandas as gpd
 import numpy as np
-from skimage.transform import resize
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, jaccard_score, confusion_matrix
+from raster_utils import ALIGN_RESAMPLING, RasterRegistry, aligned_loader, site_grid
+from evaluation_utils import (
+    class_histograms, evaluate_confusion, threshold_sweep, sweep_summary
+)
+from trace_utils import setup as setup_trace, span
 
 
 # Paths
@@ -19,108 +20,64 @@ ISO_DIR = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji
 URESMNDWI_DIR = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji to Professor\General format\ManuKainjiPhd\DLSeg\Final UResNetMNDWI rasters"
 CLIP_SHP = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji to Professor\General format\ManuKainjiPhd\DLSeg\GIS Files_DLSeg\ClipAfterPred.shp"
 
-# Load clip boundary
-clip = gpd.read_file(CLIP_SHP)
-clip = clip.to_crs("EPSG:4326")
+# Stage timings (trace_utils); None falls back to MNDWI_TRACE
+TRACE_PATH = None
+setup_trace(TRACE_PATH)
 
-# Sample raster to extract correct CRS
-sample_raster_path = os.path.join(SEN2_DIR, "WF2020.tif")
-with rasterio.open(sample_raster_path) as src:
-    target_crs = src.crs
+# Common evaluation grid: the UResNet-MNDWI (Landsat 30 m) grid cropped to
+# the clip boundary, built once and cached in GRID_CACHE. Sentinel-2 MNDWI is
+# averaged onto it, masks take the nearest value, and pixels outside the
+# clip boundary are NaN (ignored by the evaluation)
+GRID_CACHE = "kainji_eval_grid.json"
 
-clip = clip.to_crs(target_crs)
-geometry = clip.geometry
-
-# Helper function: Clip raster
-
-def clip_raster(raster_path, geometry):
-    with rasterio.open(raster_path) as src:
-        out_image, out_transform = mask(src, geometry, crop=True)
-        out_meta = src.meta.copy()
-        out_meta.update({
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform
-        })
-        return out_image[0], out_meta
-
-# Load and clip all raster types
 years = ["2019", "2020", "2021", "2022", "2023", "2024"]
-globals_data = {}
+flood_types = ["BF", "WF"]
+
+reference_path = next(
+    path for path in (
+        os.path.join(URESMNDWI_DIR, f"{flood_type}{year}.tif")
+        for year in years for flood_type in flood_types
+    )
+    if os.path.exists(path)
+)
+with rasterio.open(reference_path) as src:
+    target_crs = src.crs
 
-for year in years:
+# Load clip boundary
+clip = gpd.read_file(CLIP_SHP)
+clip = clip.to_crs(target_crs)
+geometry = list(clip.geometry)
 
-    # Before Flood (BF)
-    for prefix, directory, fname in [
-        ("Sen2_BF", SEN2_DIR, f"BF{year}.tif"),
-        ("ISO_BF",  ISO_DIR, f"iso3BF{year}.tif"),
-        ("UNet_BF", URESMNDWI_DIR, f"BF{year}.tif")
-    ]:
-        path = os.path.join(directory, fname)
-        if os.path.exists(path):
-            try:
-                clipped, _ = clip_raster(path, geometry)
-                globals_data[f"{prefix}{year}"] = clipped
-                print(f"Clipped {prefix}{year}")
-            except Exception as e:
-                print(f"Error clipping {prefix}{year}: {e}")
-
-    # Wet Flood (WF)
-    for prefix, directory, fname in [
-        ("Sen2_WF", SEN2_DIR, f"WF{year}.tif"),
-        ("ISO_WF",  ISO_DIR, f"iso3WF{year}.tif"),
-        ("UNet_WF", URESMNDWI_DIR, f"WF{year}.tif")
-    ]:
-        path = os.path.join(directory, fname)
-        if os.path.exists(path):
-            try:
-                clipped, _ = clip_raster(path, geometry)
-                globals_data[f"{prefix}{year}"] = clipped
-                print(f"Clipped {prefix}{year}")
-            except Exception as e:
-                print(f"Error clipping {prefix}{year}: {e}")
-
-# Resize Sentinel-2 to 30 m
-target_shape = (3019, 1356)
+grid = site_grid(GRID_CACHE, reference_path, geometry)
+print(f"Evaluation grid: {grid['width']} x {grid['height']} from {reference_path}")
 
-for year in years:
-    for prefix in [f"Sen2_BF{year}", f"Sen2_WF{year}"]:
-        if prefix in globals_data:
-            arr_10m = globals_data[prefix]
-            arr_30m = resize(arr_10m, target_shape, order=1, mode="reflect", anti_aliasing=True)
-            globals_data[prefix] = arr_30m
-            print(f"{prefix} resized to {arr_30m.shape}")
-
-# Load U-ResNet-MNDWI predictions
-for year in years:
-    try:
-        globals_data[f"BF{year}"] = rasterio.open(
-            os.path.join(URESMNDWI_DIR, f"BF{year}.tif")
-        ).read(1)
+# Lazy raster registry
+# Rasters are opened on first use and the least recently used arrays are
+# dropped above REGISTRY_MAX_MB. Set REGISTRY_CACHE_DIR to keep the aligned
+# arrays as memory-mapped .npy files between uses and runs.
+REGISTRY_MAX_MB = 2048
+REGISTRY_CACHE_DIR = None
 
-        globals_data[f"WF{year}"] = rasterio.open(
-            os.path.join(URESMNDWI_DIR, f"WF{year}.tif")
-        ).read(1)
+load_mask = aligned_loader(grid, ALIGN_RESAMPLING["mask"], geometry)
+load_prob = aligned_loader(grid, ALIGN_RESAMPLING["prob"], geometry)
 
-        print(f"Loaded UResMNDWI BF{year} WF{year}")
+registry = RasterRegistry(max_mb=REGISTRY_MAX_MB, cache_dir=REGISTRY_CACHE_DIR)
 
-    except Exception as e:
-        print(f"Error loading UResMNDWI for {year}: {e}")
+for year in years:
+    for flood_type in flood_types:
+        for source, directory, fname, loader in [
+            ("Sen2", SEN2_DIR, f"{flood_type}{year}.tif", load_prob),
+            ("ISO", ISO_DIR, f"iso3{flood_type}{year}.tif", load_mask),
+            ("UResMNDWI", URESMNDWI_DIR, f"{flood_type}{year}.tif", load_mask),
+        ]:
+            path = os.path.join(directory, fname)
+            if registry.register((source, flood_type, year), path, loader):
+                print(f"Registered {source}_{flood_type}{year}")
 
 # Evaluation utilities
 def evaluate_model(pred, ref):
-    mask = (~np.isnan(pred)) & (~np.isnan(ref)) & (ref != -9999) & (pred != -9999)
-    pred_f = pred[mask].astype(int).flatten()
-    ref_f = ref[mask].astype(int).flatten()
-
-    return {
-        "Accuracy": accuracy_score(ref_f, pred_f),
-        "Precision": precision_score(ref_f, pred_f, average="macro", zero_division=0),
-        "Recall": recall_score(ref_f, pred_f, average="macro", zero_division=0),
-        "F1": f1_score(ref_f, pred_f, average="macro", zero_division=0),
-        "IoU": jaccard_score(ref_f, pred_f, average="macro", zero_division=0),
-        "Confusion": confusion_matrix(ref_f, pred_f)
-    }
+    # NaN and -9999 pixels in either map are ignored; macro-averaged metrics
+    return evaluate_confusion(pred, ref, average="macro", nodata=-9999)
 
 
 def threshold_array(arr, thr):
@@ -128,36 +85,50 @@ def threshold_array(arr, thr):
 
 
 def binarize_iso(arr):
-    return np.where(arr == 1, 1, 0)
+    # NaN (outside the clip or the ISO map) stays ignored
+    return np.where(np.isnan(arr), np.nan, arr == 1)
 
 # Threshold set
 THRESHOLDS = [0.10, 0.20, 0.22, 0.40, 0.90]
 
+# Dense sweep for ROC/PR curves and the optimal Sen2 threshold
+SWEEP_THRESHOLDS = np.round(np.linspace(0.0, 1.0, 1001), 3)
+
 # Full evaluation
 results = {}
+sweep_results = {}
 
 for flood_type in ["WF", "BF"]:
     for year in years:
         try:
-            pred = globals_data[f"{flood_type}{year}"]
-            sen2_raw = globals_data[f"Sen2_{flood_type}{year}"]
-            iso_raw = globals_data[f"ISO_{flood_type}{year}"]
-
-            year_results = {}
-
-            for thr in THRESHOLDS:
-                sen2_bin = threshold_array(sen2_raw, thr)
-                iso_bin = binarize_iso(iso_raw)
-
-                eval_sen2 = evaluate_model(pred, sen2_bin)
-                eval_iso = evaluate_model(pred, iso_bin)
-
-                year_results[f"thr_{thr}"] = {
-                    "UResMNDWI vs Sen2": eval_sen2,
-                    "UResMNDWI vs ISO": eval_iso
-                }
-
-            results[f"{flood_type}{year}"] = year_results
+            with span("scene", scene=f"{flood_type}{year}") as scene_span:
+                with span("read"):
+                    pred = registry.get(("UResMNDWI", flood_type, year))
+                    sen2_raw = registry.get(("Sen2", flood_type, year))
+                    iso_raw = registry.get(("ISO", flood_type, year))
+                scene_span.add(pixels=pred.size)
+
+                year_results = {}
+
+                # One histogram of Sen2 MNDWI per predicted class serves every
+                # threshold; the ISO reference does not depend on the threshold
+                with span("evaluate") as s:
+                    s.add(pixels=pred.size)
+                    sen2_hist = class_histograms(pred, sen2_raw)
+                    sen2_sweep = threshold_sweep(sen2_hist, THRESHOLDS)
+                    eval_iso = evaluate_model(pred, binarize_iso(iso_raw))
+
+                for i, thr in enumerate(THRESHOLDS):
+                    year_results[f"thr_{thr}"] = {
+                        "UResMNDWI vs Sen2": sen2_sweep["metrics"][i],
+                        "UResMNDWI vs ISO": eval_iso
+                    }
+
+                results[f"{flood_type}{year}"] = year_results
+                with span("sweep", thresholds=len(SWEEP_THRESHOLDS)):
+                    sweep_results[f"{flood_type}{year}"] = sweep_summary(
+                        threshold_sweep(sen2_hist, SWEEP_THRESHOLDS)
+                    )
             print(f"Evaluated {flood_type}{year}")
 
         except Exception as e:
@@ -170,3 +141,10 @@ with open(output_json, "w") as f:
     json.dump(results, f, indent=4)
 
 print(f"Saved evaluation results to {output_json}")
+
+sweep_json = "threshold_sweep_results.json"
+
+with open(sweep_json, "w") as f:
+    json.dump(sweep_results, f, indent=4)
+
+print(f"Saved threshold sweep to {sweep_json}")
@@ -8,26 +8,46 @@ Groundtruth MNDWI is thresholded at 0.22 with masking.
 import os
 import numpy as np
 import rasterio
-from rasterio.mask import mask
 import geopandas as gpd
-from sklearn.metrics import (
-    accuracy_score, precision_score, recall_score,
-    f1_score, jaccard_score, confusion_matrix
-)
-import arcpy
+from evaluation_utils import evaluate_confusion
+from raster_utils import masked_read
+from trace_utils import setup as setup_trace, span
 
 # Paths – update these to your GEE export folders
 RGB_DIR = r"D:\GEEExports\Gerinya_LKJ\RGB"
 MNDWI_DIR = r"D:\GEEExports\Gerinya_LKJ\MNDWI"
 JRC_DIR = r"D:\JRCWaterExtentData"
 MODEL_PATH = r"D:\Models\UNet\UResNet34.dlpk"
+
+# "arcpy" runs ClassifyPixelsUsingDeepLearning; "local" runs the exported
+# TorchScript/ONNX model on CPU through inference_utils
+PREDICT_BACKEND = "arcpy"
+LOCAL_MODEL_PATH = r"D:\Models\UNet\UResNet34.onnx"
+# .emd of this model: its AllTilesStats must hold one entry per RGB band
+# (a 7-band Landsat .emd is rejected rather than cut to 3 bands)
+LOCAL_EMD_PATH = r"D:\Models\UNet\UResNet34.emd"
+LOCAL_TILE_SIZE = 224
+LOCAL_THREADS = None
+LOCAL_BLEND = "center"
 CLIP_SHP = r"D:\ClipBoundaries\clip.shp"
 OUTPUT_DIR = r"D:\FloodOutputs\UResNet_vs_MNDWI"
 
+# Stage timings (trace_utils); None falls back to MNDWI_TRACE
+TRACE_PATH = None
+setup_trace(TRACE_PATH)
+
 
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
+if PREDICT_BACKEND == "local":
+    from inference_utils import load_emd_stats, load_model, predict_raster
+
+    model = load_model(LOCAL_MODEL_PATH, n_threads=LOCAL_THREADS)
+    stats = load_emd_stats(LOCAL_EMD_PATH) if LOCAL_EMD_PATH else None
+else:
+    import arcpy
+
 # Load clip boundary
 clip = gpd.read_file(CLIP_SHP)
 clip = clip.to_crs("EPSG:4326")
@@ -43,7 +63,7 @@ def read_raster(path):
 # Helper: clip raster to AOI
 def clip_raster(path, geometry):
     with rasterio.open(path) as src:
-        out_image, out_transform = mask(src, geometry, crop=True)
+        out_image, out_transform = masked_read(src, geometry)
         out_meta = src.meta.copy()
         out_meta.update({
             "height": out_image.shape[1],
@@ -54,26 +74,30 @@ def clip_raster(path, geometry):
 
 # Helper: evaluate two binary maps
 def evaluate(pred, ref):
-    mask_valid = (~np.isnan(pred)) & (~np.isnan(ref))
-    p = pred[mask_valid].astype(int).flatten()
-    r = ref[mask_valid].astype(int).flatten()
-
-    return {
-        "Accuracy": accuracy_score(r, p),
-        "Precision": precision_score(r, p, zero_division=0),
-        "Recall": recall_score(r, p, zero_division=0),
-        "F1": f1_score(r, p, zero_division=0),
-        "IoU": jaccard_score(r, p, zero_division=0),
-        "Confusion": confusion_matrix(r, p)
-    }
-
-# Process each pair of RGB + MNDWI images
-files = [f for f in os.listdir(RGB_DIR) if f.endswith("_RGB.tif")]
-
-for rgb_file in files:
-
-    print(f"\nProcessing: {rgb_file}")
-
+    # NaN pixels are ignored; binary metrics for the water class
+    return evaluate_confusion(pred, ref, average="binary", nodata=None)
+
+# Helper: run the selected backend on the clipped RGB raster
+def predict(tmp_rgb_path, pred_path):
+    if PREDICT_BACKEND == "local":
+        # Water probability, thresholded at 0.5 below like the ArcPy output
+        predict_raster(
+            model, tmp_rgb_path, pred_path,
+            tile_size=LOCAL_TILE_SIZE, padding=32, batch_size=8, stats=stats,
+            blend=LOCAL_BLEND
+        )
+    else:
+        with arcpy.EnvManager(cellSize=10, processorType="GPU"):
+            out = arcpy.ia.ClassifyPixelsUsingDeepLearning(
+                in_raster=tmp_rgb_path,
+                in_model_definition=MODEL_PATH,
+                arguments="padding 32;batch_size 8;predict_background True",
+                processing_mode="PROCESS_AS_MOSAICKED_IMAGE"
+            )
+        out.save(pred_path)
+
+# Helper: predict, evaluate and save one RGB + MNDWI pair
+def process_pair(rgb_file):
     base = rgb_file.replace("_RGB.tif", "")
     rgb_path = os.path.join(RGB_DIR, rgb_file)
     mndwi_path = os.path.join(MNDWI_DIR, f"{base}_MNDWI.tif")
@@ -81,10 +105,12 @@ for rgb_file in files:
 
     if not os.path.exists(mndwi_path):
         print(f"MNDWI missing for {base}, skipping.")
-        continue
+        return
 
     # Clip RGB
-    rgb_arr, _ = clip_raster(rgb_path, geometry)
+    with span("read") as s:
+        rgb_arr, _ = clip_raster(rgb_path, geometry)
+        s.add(bytes_read=rgb_arr.nbytes, pixels=rgb_arr[0].size)
     rgb_arr = rgb_arr.astype("float32")
 
     tmp_rgb_path = os.path.join(OUTPUT_DIR, f"tmp_{base}_rgb.tif")
@@ -102,42 +128,44 @@ for rgb_file in files:
     # Deep learning prediction
     print("Running U-ResNet34 model prediction...")
 
-    with arcpy.EnvManager(cellSize=10, processorType="GPU"):
-        out = arcpy.ia.ClassifyPixelsUsingDeepLearning(
-            in_raster=tmp_rgb_path,
-            in_model_definition=MODEL_PATH,
-            arguments="padding 32;batch_size 8;predict_background True",
-            processing_mode="PROCESS_AS_MOSAICKED_IMAGE"
-        )
-
     pred_path = os.path.join(OUTPUT_DIR, f"{base}_UResNetMNDWI_pred.tif")
-    out.save(pred_path)
+
+    with span("predict", backend=PREDICT_BACKEND) as s:
+        s.add(pixels=rgb_arr[0].size)
+        predict(tmp_rgb_path, pred_path)
+
     os.remove(tmp_rgb_path)
 
-    pred_arr = rasterio.open(pred_path).read(1)
+    with span("read") as s:
+        with rasterio.open(pred_path) as src:
+            pred_arr = src.read(1)
 
-    # Clip MNDWI and threshold at 0.22
-    mndwi_arr, _ = clip_raster(mndwi_path, geometry)
-    mndwi_arr = mndwi_arr[0]
+        # Clip MNDWI and JRC mask
+        mndwi_arr, _ = clip_raster(mndwi_path, geometry)
+        mndwi_arr = mndwi_arr[0]
 
-    mndwi_bin = (mndwi_arr > 0.22).astype(np.uint8)
+        jrc_arr, _ = clip_raster(jrc_path, geometry)
+        jrc_arr = jrc_arr[0]
+        s.add(bytes_read=pred_arr.nbytes + mndwi_arr.nbytes + jrc_arr.nbytes)
 
-    # Load and clip JRC mask
-    jrc_arr, _ = clip_raster(jrc_path, geometry)
-    jrc_arr = jrc_arr[0]
+    with span("evaluate") as s:
+        s.add(pixels=pred_arr.size)
 
-    # JRC extent
-    jrc_mask = (jrc_arr > 0).astype(np.uint8)
+        # Threshold MNDWI at 0.22
+        mndwi_bin = (mndwi_arr > 0.22).astype(np.uint8)
 
-    # Apply mask to both prediction and groundtruth
-    pred_masked = np.where(jrc_mask == 1, pred_arr, 0)
-    mndwi_masked = np.where(jrc_mask == 1, mndwi_bin, 0)
+        # JRC extent
+        jrc_mask = (jrc_arr > 0).astype(np.uint8)
 
-    # Threshold prediction at 0.5
-    pred_bin = (pred_masked > 0.5).astype(np.uint8)
+        # Apply mask to both prediction and groundtruth
+        pred_masked = np.where(jrc_mask == 1, pred_arr, 0)
+        mndwi_masked = np.where(jrc_mask == 1, mndwi_bin, 0)
 
-    # Evaluate
-    metrics = evaluate(pred_bin, mndwi_masked)
+        # Threshold prediction at 0.5
+        pred_bin = (pred_masked > 0.5).astype(np.uint8)
+
+        # Evaluate
+        metrics = evaluate(pred_bin, mndwi_masked)
 
     print(f"Evaluation for {base}:")
     for k, v in metrics.items():
@@ -151,10 +179,22 @@ for rgb_file in files:
 
     meta.update({"dtype": "uint8", "count": 1})
 
-    with rasterio.open(out_masked_path, "w", **meta) as dst:
-        dst.write(pred_bin, 1)
+    with span("write") as s:
+        with rasterio.open(out_masked_path, "w", **meta) as dst:
+            dst.write(pred_bin, 1)
+
+        with rasterio.open(out_gt_path, "w", **meta) as dst:
+            dst.write(mndwi_masked, 1)
+        s.add(bytes_written=pred_bin.nbytes + mndwi_masked.nbytes)
+
+# Process each pair of RGB + MNDWI images
+files = [f for f in os.listdir(RGB_DIR) if f.endswith("_RGB.tif")]
+
+for rgb_file in files:
+
+    print(f"\nProcessing: {rgb_file}")
 
-    with rasterio.open(out_gt_path, "w", **meta) as dst:
-        dst.write(mndwi_masked, 1)
+    with span("scene", scene=rgb_file):
+        process_pair(rgb_file)
 
 print("\nProcessing done by Kola.")
@@ -2,20 +2,35 @@
 import os
 import glob
 import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import rasterio
-from rasterio.mask import mask
+from rasterio.windows import Window
+from raster_utils import clip_mask, geometry_key
+from catalog_utils import parse_mtl_file
+from trace_utils import span
 
+BAND_LIST = [1, 2, 3, 4, 5, 6, 7]
+BAND_NAMES = ["Coastal", "Blue", "Green", "Red", "NIR", "SWIR1", "SWIR2"]
 
-def get_acquisition_date(mtl_file):
-    with open(mtl_file, "r") as f:
-        content = f.read()
-    match = re.search(r"DATE_ACQUIRED\s=\s\"?(\d{4}-\d{2}-\d{2})\"?", content)
+# Bands are read concurrently (GDAL releases the GIL during reads), in row
+# blocks of the reservoir window so memory stays flat
+BAND_READ_WORKERS = 7
+BLOCK_ROWS = 1024
+STATS_PERCENTILES = [10, 25, 75, 90]
+
+
+def parse_acquisition_date(date_str):
+    match = re.fullmatch(r"(\d{4}-\d{2}-\d{2})", date_str or "")
     return datetime.strptime(match.group(1), "%Y-%m-%d") if match else None
 
 
+def get_acquisition_date(mtl_file):
+    return parse_acquisition_date(parse_mtl_file(mtl_file).get("DATE_ACQUIRED"))
+
+
 def determine_flood_type(date):
     m = date.month
     if 6 <= m <= 11:
@@ -24,57 +39,211 @@ def determine_flood_type(date):
         return "Black Flood"
     return "Other"
 
+# Per-band reservoir statistics
+# Valid pixels are inside the reservoir, not nodata and not 0 (the old
+# zero-to-NaN rule). Sum and count are accumulated in integer space; with
+# stats=True an exact value histogram is accumulated alongside for the
+# median, std and percentiles.
+
+def histogram_percentile(hist, q):
+    # Same linear interpolation as np.percentile on the expanded values
+    n = hist.sum()
+    if n == 0:
+        return np.nan
+    cum = np.cumsum(hist)
+    pos = q / 100 * (n - 1)
+    lo = int(np.floor(pos))
+    frac = pos - lo
+    v_lo = np.searchsorted(cum, lo, side="right")
+    v_hi = np.searchsorted(cum, min(lo + 1, n - 1), side="right")
+    return float(v_lo + (v_hi - v_lo) * frac)
+
+
+def add_histogram(hist, block_hist):
+    if hist is None:
+        return block_hist
+    if block_hist.size > hist.size:
+        hist, block_hist = block_hist, hist
+    hist[:block_hist.size] += block_hist
+    return hist
+
+
+def histogram_stats(hist):
+    n = hist.sum()
+    if n == 0:
+        stats = {"median": np.nan, "std": np.nan}
+        stats.update({f"p{q}": np.nan for q in STATS_PERCENTILES})
+        return stats
+
+    values = np.arange(hist.size, dtype=np.float64)
+    mean = (values * hist).sum() / n
+    std = np.sqrt((hist * (values - mean) ** 2).sum() / n)
+
+    stats = {"median": histogram_percentile(hist, 50), "std": float(std)}
+    for q in STATS_PERCENTILES:
+        stats[f"p{q}"] = histogram_percentile(hist, q)
+    return stats
+
 
-def compute_mean_reflectance(scene_folder, reservoir):
-    values = []
-    band_list = [1, 2, 3, 4, 5, 6, 7]
+def band_reservoir_stats(tif_path, reservoir, stats=False):
+    with span("band", band=os.path.basename(tif_path)) as s, rasterio.open(tif_path) as src:
+        shape_mask, _, window = clip_mask(src, reservoir.geometry)
+        integer = np.issubdtype(np.dtype(src.dtypes[0]), np.integer)
+        # Exact histograms need non-negative integers (Landsat SR is uint16)
+        histogram = np.issubdtype(np.dtype(src.dtypes[0]), np.unsignedinteger)
+        nodata = src.nodata
 
-    for b in band_list:
+        total = 0 if integer else 0.0
+        count = 0
+        hist = None
+
+        row_off = int(window.row_off)
+        col_off = int(window.col_off)
+        height, width = shape_mask.shape
+
+        for r0 in range(0, height, BLOCK_ROWS):
+            rows = min(BLOCK_ROWS, height - r0)
+            block = src.read(1, window=Window(col_off, row_off + r0, width, rows))
+            s.add(bytes_read=block.nbytes, pixels=block.size)
+
+            valid = ~shape_mask[r0:r0 + rows] & (block != 0)
+            if nodata is not None:
+                valid &= block != nodata
+            if not integer:
+                valid &= ~np.isnan(block)
+
+            acc_dtype = np.int64 if integer else np.float64
+            total += np.add.reduce(block, axis=None, dtype=acc_dtype, where=valid)
+            count += int(np.count_nonzero(valid))
+
+            if stats and histogram:
+                hist = add_histogram(hist, np.bincount(block[valid]))
+
+    mean = float(total) / count if count else np.nan
+    if not stats:
+        return mean, None
+
+    if hist is None:
+        hist = np.zeros(1, dtype=np.int64)
+    return mean, histogram_stats(hist)
+
+
+def _band_stats_or_nan(args):
+    tif_path, reservoir, stats = args
+    if tif_path is None:
+        return np.nan, None
+    try:
+        return band_reservoir_stats(tif_path, reservoir, stats)
+    except Exception:
+        return np.nan, None
+
+
+def compute_mean_reflectance(scene_folder, reservoir, stats=False, n_threads=None):
+    n_threads = n_threads or BAND_READ_WORKERS
+    jobs = []
+
+    for b in BAND_LIST:
         tif = glob.glob(os.path.join(scene_folder, f"*SR_B{b}.TIF"))
-        if not tif:
-            values.append(np.nan)
-            continue
-        try:
-            with rasterio.open(tif[0]) as src:
-                arr, _ = mask(src, reservoir.geometry, crop=True)
-                img = arr[0].astype("float32")
-                img[img == 0] = np.nan
-                values.append(np.nanmean(img))
-        except Exception:
-            values.append(np.nan)
-    return values
-
-
-def process_folder(path, reservoir):
-    rows = []
-    scenes = glob.glob(os.path.join(path, "*"))
+        jobs.append((tif[0] if tif else None, reservoir, stats))
 
-    for s in scenes:
-        mtl = glob.glob(os.path.join(s, "*_MTL.txt"))
-        if not mtl:
-            continue
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(_band_stats_or_nan, jobs))
 
-        date = get_acquisition_date(mtl[0])
-        if not date:
-            continue
+    values = [mean for mean, _ in results]
+    if not stats:
+        return values
+    return values, [band_stats for _, band_stats in results]
 
-        flood = determine_flood_type(date)
-        reflectance = compute_mean_reflectance(s, reservoir)
 
-        if np.isnan(reflectance).any():
-            continue
+def process_scene(s, reservoir, stats=False):
+    mtl = glob.glob(os.path.join(s, "*_MTL.txt"))
+    if not mtl:
+        return None
+
+    date = get_acquisition_date(mtl[0])
+    if not date:
+        return None
+
+    with span("scene", scene=os.path.basename(s)):
+        if stats:
+            reflectance, band_stats = compute_mean_reflectance(s, reservoir, stats=True)
+        else:
+            reflectance = compute_mean_reflectance(s, reservoir)
+
+    if np.isnan(reflectance).any():
+        return None
+
+    row = scene_row(os.path.basename(s), date, reflectance)
+
+    if stats:
+        for name, band in zip(BAND_NAMES, band_stats):
+            for key, value in (band or {}).items():
+                row[f"{name}_{key}"] = value
+
+    return row
+
+
+def scene_row(scene_name, date, reflectance):
+    row = {
+        "Scene": scene_name,
+        "Date": date.strftime("%Y-%m-%d"),
+        "Flood Type": determine_flood_type(date),
+    }
+    row.update(dict(zip(BAND_NAMES, reflectance)))
+    return row
 
-        rows.append({
-            "Scene": os.path.basename(s),
-            "Date": date.strftime("%Y-%m-%d"),
-            "Flood Type": flood,
-            "Coastal": reflectance[0],
-            "Blue": reflectance[1],
-            "Green": reflectance[2],
-            "Red": reflectance[3],
-            "NIR": reflectance[4],
-            "SWIR1": reflectance[5],
-            "SWIR2": reflectance[6]
-        })
+
+def process_catalog(path, reservoir, catalog, n_workers=1):
+    # Scenes come from the catalog index; only scenes without a cached
+    # reflectance for this reservoir are read from disk
+    catalog.scan(path)
+    reservoir_key = geometry_key(reservoir.geometry)
+    scenes = catalog.query(base_path=path)
+
+    cached, missing = {}, []
+    for folder in scenes["folder"]:
+        values = catalog.cached_reflectance(folder, reservoir_key)
+        if values is None:
+            missing.append(folder)
+        else:
+            cached[folder] = values
+
+    if n_workers <= 1:
+        computed = [compute_mean_reflectance(f, reservoir) for f in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            computed = list(pool.map(
+                compute_mean_reflectance, missing, [reservoir] * len(missing)
+            ))
+
+    for folder, values in zip(missing, computed):
+        catalog.store_reflectance(folder, reservoir_key, values)
+        cached[folder] = values
+
+    rows = []
+    for scene in scenes.itertuples():
+        date = parse_acquisition_date(scene.date_acquired)
+        reflectance = cached[scene.folder]
+        if not date or np.isnan(reflectance).any():
+            continue
+        rows.append(scene_row(scene.filename, date, reflectance))
 
     return pd.DataFrame(rows)
+
+
+def process_folder(path, reservoir, n_workers=1, stats=False, catalog=None):
+    if catalog is not None and not stats:
+        return process_catalog(path, reservoir, catalog, n_workers)
+
+    scenes = glob.glob(os.path.join(path, "*"))
+
+    if n_workers <= 1:
+        rows = [process_scene(s, reservoir, stats) for s in scenes]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            rows = list(pool.map(
+                process_scene, scenes,
+                [reservoir] * len(scenes), [stats] * len(scenes)
+            ))
+
+    return pd.DataFrame([row for row in rows if row is not None])
@@ -7,8 +7,9 @@ This script trains multiple architectures (UNet, DeepLab, PSPNet) with
 ResNet34 and VGG16 backbones using ArcGIS Image Analyst's deep learning tools.
 """
 
+import os
 import time
-import arcpy
+from trace_utils import setup as setup_trace, span
 
 # Training Utility Function
 def train_model(
@@ -21,6 +22,7 @@ def train_model(
     validation_percentage=20,
 ):
     """Wrapper for ArcGIS TrainDeepLearningModel."""
+    import arcpy
 
     params = (
         "class_balancing False;"
@@ -33,7 +35,8 @@ def train_model(
 
     t0 = time.time()
 
-    with arcpy.EnvManager(processorType="GPU"):
+    with span("train", model_type=model_type, backbone=backbone), \
+            arcpy.EnvManager(processorType="GPU"):
         arcpy.ia.TrainDeepLearningModel(
             in_folder=in_folder,
             out_folder=out_folder,
@@ -60,10 +63,38 @@ def train_model(
 TRAIN_DATA = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji to Professor\General format\ManuKainjiPhd\DLSeg\New Model\1TrainSR"
 OUTPUT_BASE = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji to Professor\General format\ManuKainjiPhd\DLSeg\New Model\2TrainedModels"
 
+# "arcpy" trains through TrainDeepLearningModel on the GPU; "local" trains the
+# same matrix on CPU with PyTorch (train_utils), several jobs at once within
+# LOCAL_CORE_BUDGET, resuming from per-epoch checkpoints
+TRAIN_BACKEND = "arcpy"
+LOCAL_CORE_BUDGET = None
+LOCAL_MAX_CONCURRENT = None
+# Stage timings (trace_utils); None falls back to MNDWI_TRACE
+TRACE_PATH = None
+setup_trace(TRACE_PATH)
+
+
+def train_local():
+    from chip_utils import pack_chips
+    from train_utils import run_matrix
+
+    store_dir = pack_chips(TRAIN_DATA)
+    results = run_matrix(
+        store_dir,
+        os.path.join(OUTPUT_BASE, "Local"),
+        core_budget=LOCAL_CORE_BUDGET,
+        max_concurrent=LOCAL_MAX_CONCURRENT,
+    )
+    print(results.to_string(index=False))
+
 
 # Training Execution
 def main():
 
+    if TRAIN_BACKEND == "local":
+        train_local()
+        return
+
     # UNET Models
     train_model(
         in_folder=TRAIN_DATA,
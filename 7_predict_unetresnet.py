@@ -1,27 +1,98 @@
 #7_predict_unetresnet.py
 #Iterate through all L9 files and ignore the first WBF17 training data
 import os
+import time
+from trace_utils import setup as setup_trace, span
 
-folder_path = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Final L" 
+# "arcpy" runs ClassifyPixelsUsingDeepLearning on the GPU in ArcGIS Pro.
+# "local" runs the exported model on CPU (PyTorch/ONNX Runtime) and writes
+# the <scene>_prob.tif rasters script 8 reads from Uresnetpreds2018_2024.
+# "ensemble" runs every model in ENSEMBLE_MODELS on each tile read once and
+# writes <scene>_ensemble_prob.tif (band 1 fused, then one band per model).
+PREDICT_BACKEND = "arcpy"
+LOCAL_MODEL_PATH = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Models\UNet\RESNET34\RESNET34.onnx"
+LOCAL_EMD_PATH = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Models\UNet\RESNET34\RESNET34.emd"
+LOCAL_THREADS = None
+# Tile stitching for the local backend: "center", "cosine" or "gaussian"
+LOCAL_BLEND = "center"
+
+# TorchScript models <name>/<name>.pt, as exported by the local backend of
+# 6_train_models.py (OUTPUT_BASE\Local); the ArcPy .pth/.emd folders are not
+# loadable here
+ENSEMBLE_MODELS_DIR = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\ManuKainji to Professor\General format\ManuKainjiPhd\DLSeg\New Model\2TrainedModels\Local"
+ENSEMBLE_MODELS = ["UResNet", "UVGG16", "DpLResNet", "DpLVGG16", "PSPResNet", "PSPVGG16"]
+ENSEMBLE_EMD_PATH = r"GIS Files\TilesSurfaceWaterExtentTrainingData3\esri_model_definition.emd"
+ENSEMBLE_FUSION = "mean"  # "mean", "max" or "weighted"
+ENSEMBLE_WEIGHTS = None   # {model name: weight} for "weighted"
+
+folder_path = r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Final L"
 tif_files = [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.endswith('.tif') and file != 'WetBlackL2017.tif']
 
+output_folder = r"Uresnetpreds2018_2024"
+
+# Stage timings (trace_utils); None falls back to MNDWI_TRACE
+TRACE_PATH = None
+setup_trace(TRACE_PATH)
+
+if PREDICT_BACKEND == "local":
+    from inference_utils import load_emd_stats, load_model, predict_raster, prob_output_path
+
+    model = load_model(LOCAL_MODEL_PATH, n_threads=LOCAL_THREADS)
+    stats = load_emd_stats(LOCAL_EMD_PATH) if LOCAL_EMD_PATH else None
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+elif PREDICT_BACKEND == "ensemble":
+    from inference_utils import (
+        ensemble_model_paths, ensemble_output_path, load_emd_stats,
+        load_ensemble, predict_ensemble
+    )
+
+    models = load_ensemble(
+        ensemble_model_paths(ENSEMBLE_MODELS_DIR, ENSEMBLE_MODELS),
+        n_threads=LOCAL_THREADS
+    )
+    stats = load_emd_stats(ENSEMBLE_EMD_PATH)
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+else:
+    import arcpy
+
 for tif_file in tif_files:
     print(f"Processing: {tif_file}")
-    
+
     t0 = time.time()
-    
-    with arcpy.EnvManager(cellSize=30, processorType="GPU"):
-        out_classified_raster = arcpy.ia.ClassifyPixelsUsingDeepLearning(
-            in_raster=tif_file,
-            in_model_definition=r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Models\UNet\RESNET34\RESNET34.dlpk",
-            arguments="padding 56;batch_size 16;predict_background True;test_time_augmentation False;tile_size 224",
-            processing_mode="PROCESS_AS_MOSAICKED_IMAGE",
-            out_classified_folder=None,
-            out_featureclass=None
-        )
-    
-    output_path = os.path.join(r"Uresnetpreds2018_2024", f"SWEUNetRESNET34_{os.path.basename(tif_file)[:-4]}")
-    out_classified_raster.save(output_path)
-    
+
+    with span("scene", scene=os.path.basename(tif_file), backend=PREDICT_BACKEND):
+        if PREDICT_BACKEND == "local":
+            # Same tile_size 224 / padding 56 / batch_size 16 as the ArcPy run
+            output_path = prob_output_path(output_folder, os.path.basename(tif_file))
+            predict_raster(
+                model, tif_file, output_path,
+                tile_size=224, padding=56, batch_size=16, stats=stats,
+                blend=LOCAL_BLEND
+            )
+        elif PREDICT_BACKEND == "ensemble":
+            output_path = ensemble_output_path(output_folder, os.path.basename(tif_file))
+            predict_ensemble(
+                models, tif_file, output_path,
+                tile_size=224, padding=56, batch_size=16, stats=stats,
+                blend=LOCAL_BLEND, fusion=ENSEMBLE_FUSION, weights=ENSEMBLE_WEIGHTS
+            )
+        else:
+            with arcpy.EnvManager(cellSize=30, processorType="GPU"):
+                out_classified_raster = arcpy.ia.ClassifyPixelsUsingDeepLearning(
+                    in_raster=tif_file,
+                    in_model_definition=r"D:\Document folder\Projects\Research_Nigeria\Kainji Lake\DLSeg\SWE Prediction\Models\UNet\RESNET34\RESNET34.dlpk",
+                    arguments="padding 56;batch_size 16;predict_background True;test_time_augmentation False;tile_size 224",
+                    processing_mode="PROCESS_AS_MOSAICKED_IMAGE",
+                    out_classified_folder=None,
+                    out_featureclass=None
+                )
+
+            output_path = os.path.join(output_folder, f"SWEUNetRESNET34_{os.path.basename(tif_file)[:-4]}")
+            out_classified_raster.save(output_path)
+
     t1 = time.time()
-    print(f'Optimal UNetRESNET34 Prediction Runtime for {os.path.basename(tif_file)}: %.2f s' % (t1 - t0))
\ No newline at end of file
+    print(f'Optimal UNetRESNET34 Prediction Runtime for {os.path.basename(tif_file)}: %.2f s' % (t1 - t0))
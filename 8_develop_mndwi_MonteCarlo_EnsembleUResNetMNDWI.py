@@ -1,7 +1,15 @@
 #8_mndwi_MonteCarlo_UResNetMNDWI.py
 import os
+import json
+import time
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import rasterio
+from rasterio.windows import Window
+from index_utils import compute_indices
+from raster_utils import atomic_write_json, write_cog
+from trace_utils import setup as setup_trace, enabled as trace_enabled, span
 
 folder_path = r"Final L"
 uresnet_pred_folder = r"Uresnetpreds2018_2024"
@@ -14,94 +22,678 @@ MC_RUNS = 1000
 THRESH_MIN = 0.2
 THRESH_MAX = 0.4
 
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+# "exact" counts thresholds per pixel in one pass; "loop" is the reference
+# implementation with one full-raster pass per threshold
+MC_METHOD = "exact"
+MC_CHUNK_PIXELS = 1 << 20
+
+# Threshold distribution over [THRESH_MIN, THRESH_MAX]: "linspace" (default),
+# "truncnorm" or "beta". Random draws are seeded and sorted, so the exact
+# engine and the loop still agree
+MC_DISTRIBUTION = "linspace"
+MC_SEED = 42
+MC_NORMAL_MEAN = 0.3
+MC_NORMAL_STD = 0.05
+MC_BETA_A = 2.0
+MC_BETA_B = 2.0
+
+# Extra bands written after the ensemble probability (see PROB_BAND_NAMES)
+UNCERTAINTY_LAYERS = False
+
+# Streaming mode walks tile-aligned windows so peak memory is set by
+# STREAM_BLOCK_BUDGET_MB instead of the scene size
+STREAM_MODE = False
+STREAM_BLOCK_BUDGET_MB = 256
+STREAM_TILE_SIZE = 512
+# Working set per pixel: green/swir/mndwi/MC/UResNet/ensemble float32,
+# the searchsorted index and the uint16/uint8 outputs
+STREAM_BYTES_PER_PIXEL = 48
+STREAM_UNCERTAINTY_BYTES_PER_PIXEL = 24
+
+# Output format: "gtiff" writes plain float32/uint8 GeoTIFFs; "cog" writes
+# Cloud-Optimized GeoTIFFs (internal tiles, DEFLATE/ZSTD with predictor and
+# internal overviews) through a tiled staging file per output
+OUTPUT_FORMAT = "gtiff"
+COG_COMPRESS = "DEFLATE"
+COG_BLOCK_SIZE = 512
+COG_OVERVIEW_RESAMPLING = "AVERAGE"
+# Store probability bands as uint8 codes, value = code * scale + offset
+# (raster_utils.read_scaled decodes them)
+COG_QUANTIZE = False
+# Binary mask: "file" (separate uint8 raster), "band" (last band of the
+# probability raster) or "1bit" (separate NBITS=1 raster)
+COG_MASK = "file"
+
+# 254 steps so that 0.5 decodes exactly (code 127); 255 marks NaN. Pixels
+# within half a step of 0.5 may round across it, so the mask stays the
+# reference for the binary result
+QUANT_LEVELS = 254
+QUANT_NODATA = 255
+# Value range per band; unlisted bands cover 0-1
+QUANT_RANGES = {
+    "mndwi_mc_variance": (0.0, 0.25),
+    "mndwi_flip_threshold": (THRESH_MIN, THRESH_MAX),
+}
+MASK_BAND_NAME = "ensemble_mask"
+
+# Batch runner: scenes are spread over N_WORKERS processes and tracked in a
+# manifest so an interrupted run only redoes missing or stale scenes
+N_WORKERS = 1
+MANIFEST_NAME = "ensemble_manifest.json"
+
+# Stage timings (trace_utils): a .json path writes a Chrome trace, anything
+# else JSON lines. None falls back to MNDWI_TRACE
+TRACE_PATH = None
 
 # Compute MNDWI
 
 def compute_mndwi(green, swir):
-    numerator = green - swir
-    denominator = green + swir
-    mndwi = np.divide(
-        numerator, denominator,
-        out=np.zeros_like(numerator, dtype=np.float32),
-        where=(denominator != 0)
-    )
-    return mndwi
+    # Chunked band math (index_utils): the bands are cast to float32 per
+    # chunk, so no full-size numerator, denominator or float copies
+    return compute_indices({"green": green, "swir1": swir}, ["MNDWI"])["MNDWI"]
 
 # Monte Carlo Thresholding
 # Creates 1000 realizations across 0.2–0.4
 # Returns probability surface: freq(water) / MC_RUNSs
 
-def monte_carlo_mndwi_probability(mndwi):
-    thresholds = np.linspace(THRESH_MIN, THRESH_MAX, MC_RUNS)
+def mc_thresholds():
+    if MC_DISTRIBUTION == "linspace":
+        return np.linspace(THRESH_MIN, THRESH_MAX, MC_RUNS)
 
+    rng = np.random.default_rng(MC_SEED)
+
+    if MC_DISTRIBUTION == "truncnorm":
+        # Rejection sampling keeps draws inside [THRESH_MIN, THRESH_MAX]
+        draws = np.empty(0)
+        while draws.size < MC_RUNS:
+            batch = rng.normal(MC_NORMAL_MEAN, MC_NORMAL_STD, 2 * MC_RUNS)
+            batch = batch[(batch >= THRESH_MIN) & (batch <= THRESH_MAX)]
+            draws = np.concatenate([draws, batch])
+        thresholds = draws[:MC_RUNS]
+    elif MC_DISTRIBUTION == "beta":
+        thresholds = THRESH_MIN + (THRESH_MAX - THRESH_MIN) * rng.beta(
+            MC_BETA_A, MC_BETA_B, MC_RUNS
+        )
+    else:
+        raise ValueError(f"Unknown threshold distribution: {MC_DISTRIBUTION}")
+
+    return np.sort(thresholds)
+
+
+def water_count_loop(mndwi, thresholds):
     water_count = np.zeros(mndwi.shape, dtype=np.uint16)
 
     for th in thresholds:
         mask = mndwi >= th
         water_count += mask.astype(np.uint16)
 
+    return water_count
+
+
+def comparison_thresholds(mndwi, thresholds):
+    # Thresholds are cast to the dtype NumPy uses for `mndwi >= th` so every
+    # comparison matches the loop bit for bit
+    cmp_dtype = np.result_type(mndwi, thresholds[0])
+    return np.sort(np.asarray(thresholds).astype(cmp_dtype))
+
+
+def water_count_chunks(mndwi, thresholds, method=None):
+    """(start, stop, count) per MC_CHUNK_PIXELS chunk of the flattened MNDWI."""
+    method = method or MC_METHOD
+    if method not in ("exact", "loop"):
+        raise ValueError(f"Unknown Monte Carlo method: {method}")
+    th_sorted = comparison_thresholds(mndwi, thresholds)
+    check_nan = np.issubdtype(th_sorted.dtype, np.floating)
+    flat = np.ascontiguousarray(mndwi).reshape(-1)
+
+    for start in range(0, flat.size, MC_CHUNK_PIXELS):
+        stop = min(start + MC_CHUNK_PIXELS, flat.size)
+        if method == "loop":
+            yield start, stop, water_count_loop(flat[start:stop], thresholds)
+            continue
+        # count(mndwi >= th) over sorted thresholds is the right-side
+        # insertion index of each pixel
+        block = flat[start:stop].astype(th_sorted.dtype, copy=False)
+        count = np.searchsorted(th_sorted, block, side="right")
+        if check_nan:
+            count[np.isnan(block)] = 0
+        yield start, stop, count
+
+
+def water_count_exact(mndwi, thresholds):
+    water_count = np.empty(np.size(mndwi), dtype=np.uint16)
+    for start, stop, count in water_count_chunks(mndwi, thresholds, "exact"):
+        # Same uint16 wrap-around as the in-place accumulation of the loop
+        water_count[start:stop] = count
+    return water_count.reshape(np.shape(mndwi))
+
+
+def monte_carlo_mndwi_probability(mndwi, method=None):
+    method = method or MC_METHOD
+    thresholds = mc_thresholds()
+
+    if method == "exact":
+        water_count = water_count_exact(mndwi, thresholds)
+    elif method == "loop":
+        water_count = water_count_loop(mndwi, thresholds)
+    else:
+        raise ValueError(f"Unknown Monte Carlo method: {method}")
+
     probability = water_count.astype(np.float32) / MC_RUNS
     return np.clip(probability, 0, 1)
 
-tif_files = [f for f in os.listdir(input_folder) if f.endswith(".tif")]
+# Uncertainty layers
+# The per-chunk water count (MC_METHOD engine) is also the index of the
+# first threshold each pixel fails; every layer is derived from those two
 
-for tif_name in tif_files:
-    print(f"Processing: {tif_name}")
+PROB_BAND_NAMES = ["ensemble_prob"]
+UNCERTAINTY_BAND_NAMES = [
+    "mndwi_mc_prob",
+    "mndwi_mc_variance",
+    "mndwi_mc_entropy",
+    "mndwi_flip_threshold",
+    "uresnet_mndwi_agreement",
+]
 
-    tif_path = os.path.join(input_folder, tif_name)
-    uresnet_prob_path = os.path.join(
-        uresnet_pred_folder,
-        tif_name.replace(".tif", "_prob.tif")
-    )
 
-    if not os.path.exists(uresnet_prob_path):
-        print(f"Missing UNet probability raster for: {tif_name}")
-        continue
+def prob_band_names():
+    if UNCERTAINTY_LAYERS:
+        return PROB_BAND_NAMES + UNCERTAINTY_BAND_NAMES
+    return PROB_BAND_NAMES
 
 
-    with rasterio.open(tif_path) as src:
-        green = src.read(GREEN_BAND).astype(np.float32)
-        swir = src.read(SWIR_BAND).astype(np.float32)
-        profile = src.profile.copy()
+def monte_carlo_mndwi_layers(mndwi, uresnet_prob, method=None):
+    thresholds = mc_thresholds()
+    th_sorted = comparison_thresholds(mndwi, thresholds)
+    n_runs = th_sorted.size
 
-    mndwi = compute_mndwi(green, swir)
+    flat_uresnet = np.ascontiguousarray(uresnet_prob, dtype=np.float32).reshape(-1)
+    layers = np.empty((len(UNCERTAINTY_BAND_NAMES), flat_uresnet.size), dtype=np.float32)
 
-    # Monte Carlo MNDWI probability
-    print("Running Monte Carlo thresholding...")
-    mndwi_prob = monte_carlo_mndwi_probability(mndwi)
+    for start, stop, count in water_count_chunks(mndwi, thresholds, method):
+        # Same float32 division as monte_carlo_mndwi_probability
+        p = np.clip(count.astype(np.float32) / MC_RUNS, 0, 1)
+        q = 1 - p
 
-    # UNet-ResNet34 probability raster
-    with rasterio.open(uresnet_prob_path) as up:
-        uresnet_prob = up.read(1).astype(np.float32)
+        # Binary entropy in bits, 0 where the pixel never changes class
+        entropy = np.zeros_like(p)
+        mixed = (p > 0) & (p < 1)
+        pm, qm = p[mixed], q[mixed]
+        entropy[mixed] = -(pm * np.log2(pm) + qm * np.log2(qm))
 
-    # Maximum positive ensemble
-    ensemble_prob = np.maximum(uresnet_prob, mndwi_prob)
+        # First threshold at which the pixel stops being water; NaN when it
+        # is water (or dry) for every threshold in the range
+        flip = np.full(p.shape, np.nan, dtype=np.float32)
+        flips = (count > 0) & (count < n_runs)
+        flip[flips] = th_sorted[count[flips]]
 
-    # Final binary mask using 0.5 threshold (This will get rid of water artefacts and mixed LU water pixels)
-    ensemble_binary = (ensemble_prob >= 0.5).astype(np.uint8)
+        layers[0, start:stop] = p
+        layers[1, start:stop] = p * q
+        layers[2, start:stop] = entropy
+        layers[3, start:stop] = flip
+        layers[4, start:stop] = 1 - np.abs(flat_uresnet[start:stop] - p)
 
+    return layers.reshape((len(UNCERTAINTY_BAND_NAMES),) + mndwi.shape)
+
+# Scene processing
+
+def output_paths(tif_name):
     prob_output = os.path.join(
         output_folder,
         tif_name.replace(".tif", "_UResNetMNDWI_MC_prob.tif")
     )
-
-    profile.update(dtype=rasterio.float32, count=1)
-
-    with rasterio.open(prob_output, "w", **profile) as dst:
-        dst.write(ensemble_prob.astype(np.float32), 1)
-
-    # Save final mask
     mask_output = os.path.join(
         output_folder,
         tif_name.replace(".tif", "_UResNetMNDWI_MC_mask.tif")
     )
+    # No separate mask file when it is a band of the probability raster
+    if mask_in_prob():
+        mask_output = None
+    return prob_output, mask_output
+
+
+def fuse_max(uresnet_prob, mndwi_prob):
+    # Maximum positive ensemble
+    ensemble_prob = np.maximum(uresnet_prob, mndwi_prob).astype(np.float32, copy=False)
+
+    # Final binary mask using 0.5 threshold (This will get rid of water artefacts and mixed LU water pixels)
+    ensemble_binary = (ensemble_prob >= 0.5).astype(np.uint8)
+    return ensemble_prob, ensemble_binary
+
+
+def ensemble_block(green, swir, uresnet_prob):
+    with span("mndwi") as s:
+        s.add(pixels=green.size)
+        mndwi = compute_mndwi(green, swir)
+
+    with span("mc", runs=MC_RUNS, method=MC_METHOD) as s:
+        s.add(pixels=mndwi.size)
+        if UNCERTAINTY_LAYERS:
+            layers = monte_carlo_mndwi_layers(mndwi, uresnet_prob)
+            mndwi_prob = layers[0]
+        else:
+            layers = None
+            mndwi_prob = monte_carlo_mndwi_probability(mndwi)
+
+    with span("fusion") as s:
+        s.add(pixels=mndwi.size)
+        ensemble_prob, ensemble_binary = fuse_max(uresnet_prob, mndwi_prob)
+
+    if layers is None:
+        prob_bands = ensemble_prob[np.newaxis]
+    else:
+        prob_bands = np.concatenate([ensemble_prob[np.newaxis], layers])
+
+    return prob_bands, ensemble_binary
+
+
+def set_band_descriptions(dst, names):
+    for i, name in enumerate(names, start=1):
+        dst.set_band_description(i, name)
+
+# Output encoding
+# With OUTPUT_FORMAT = "cog" both outputs are first written as tiled,
+# uncompressed staging GeoTIFFs (windowed writes work for every mode) and
+# then copied to COG, which builds the overviews in one pass.
+
+def cog_enabled():
+    return OUTPUT_FORMAT == "cog"
+
+
+def mask_in_prob():
+    return cog_enabled() and COG_MASK == "band"
+
+
+def output_options():
+    # Recorded in the manifest so changing the format redoes finished scenes
+    if not cog_enabled():
+        return {"format": OUTPUT_FORMAT}
+    return {
+        "format": OUTPUT_FORMAT, "compress": COG_COMPRESS,
+        "block_size": COG_BLOCK_SIZE, "quantize": COG_QUANTIZE, "mask": COG_MASK,
+    }
+
+
+def quant_params(names):
+    """(scale, offset) per band, so that value = code * scale + offset."""
+    params = []
+    for name in names:
+        if name == MASK_BAND_NAME:
+            params.append((1.0, 0.0))
+            continue
+        lo, hi = QUANT_RANGES.get(name, (0.0, 1.0))
+        params.append(((hi - lo) / QUANT_LEVELS, lo))
+    return params
+
+
+def quantize_bands(bands, params):
+    codes = np.empty(bands.shape, dtype=np.uint8)
+    for i, (scale, offset) in enumerate(params):
+        q = np.rint((bands[i] - np.float32(offset)) / np.float32(scale))
+        np.clip(q, 0, QUANT_LEVELS, out=q)
+        q[np.isnan(q)] = QUANT_NODATA
+        codes[i] = q
+    return codes
+
+
+def prob_layout():
+    """Band names and dtype/nodata/quantization of the probability raster."""
+    names = prob_band_names()
+    if mask_in_prob():
+        names = names + [MASK_BAND_NAME]
+    if cog_enabled() and COG_QUANTIZE:
+        return names, rasterio.uint8, QUANT_NODATA, quant_params(names)
+    return names, rasterio.float32, None, None
+
+
+def encode_prob(prob_bands, ensemble_binary, params):
+    if mask_in_prob():
+        prob_bands = np.concatenate(
+            [prob_bands, ensemble_binary[np.newaxis].astype(np.float32)]
+        )
+    if params is None:
+        return prob_bands
+    return quantize_bands(prob_bands, params)
+
+
+def output_profiles(profile, tile=None):
+    """(probability, mask) write profiles, plus the probability layout."""
+    names, dtype, nodata, params = prob_layout()
+    prob_profile = dict(profile, dtype=dtype, count=len(names))
+    mask_profile = dict(profile, dtype=rasterio.uint8, count=1)
+    if cog_enabled():
+        # The source nodata (0 for Landsat SR) would hide dry mask pixels
+        staging = streaming_profile(profile, tile or COG_BLOCK_SIZE)
+        staging.pop("compress", None)
+        prob_profile = dict(staging, dtype=dtype, count=len(names), nodata=nodata)
+        mask_profile = dict(staging, dtype=rasterio.uint8, count=1, nodata=None)
+    return prob_profile, mask_profile, names, params
+
+
+def write_path(path):
+    # Staging file next to the output, replaced by the COG in finish_outputs
+    if path is None or not cog_enabled():
+        return path
+    return path[:-4] + ".staging.tif"
+
+
+def describe_prob(dst, names, params):
+    set_band_descriptions(dst, names)
+    if params is not None:
+        dst.scales = [scale for scale, _ in params]
+        dst.offsets = [offset for _, offset in params]
+
+
+def finish_outputs(prob_output, mask_output):
+    if not cog_enabled():
+        return
+    with span("cog"):
+        # Overviews of a mask band in the probability raster average to the
+        # water fraction (float) or the majority class (uint8)
+        write_cog(
+            write_path(prob_output), prob_output, COG_COMPRESS, COG_BLOCK_SIZE,
+            COG_OVERVIEW_RESAMPLING,
+        )
+        os.remove(write_path(prob_output))
+        if mask_output is not None:
+            write_cog(
+                write_path(mask_output), mask_output, COG_COMPRESS, COG_BLOCK_SIZE,
+                "MODE", nbits=1 if COG_MASK == "1bit" else None,
+            )
+            os.remove(write_path(mask_output))
+
+
+def process_scene(tif_path, uresnet_prob_path, prob_output, mask_output):
+    with span("read") as s:
+        with rasterio.open(tif_path) as src:
+            green = src.read(GREEN_BAND)
+            swir = src.read(SWIR_BAND)
+            profile = src.profile.copy()
+        s.add(bytes_read=green.nbytes + swir.nbytes, pixels=green.size)
+
+        # UNet-ResNet34 probability raster
+        with rasterio.open(uresnet_prob_path) as up:
+            uresnet_prob = up.read(1)
+        s.add(bytes_read=uresnet_prob.nbytes)
+        uresnet_prob = uresnet_prob.astype(np.float32)
+
+    print("Running Monte Carlo thresholding...")
+    prob_bands, ensemble_binary = ensemble_block(green, swir, uresnet_prob)
+
+    prob_profile, mask_profile, names, params = output_profiles(profile)
+    prob_bands = encode_prob(prob_bands, ensemble_binary, params)
+
+    with span("write") as s:
+        with rasterio.open(write_path(prob_output), "w", **prob_profile) as dst:
+            dst.write(prob_bands)
+            describe_prob(dst, names, params)
+        s.add(bytes_written=prob_bands.nbytes)
+
+        # Save final mask
+        if mask_output is not None:
+            with rasterio.open(write_path(mask_output), "w", **mask_profile) as dst:
+                dst.write(ensemble_binary, 1)
+            s.add(bytes_written=ensemble_binary.nbytes)
+
+    finish_outputs(prob_output, mask_output)
+
+# Streaming (windowed) scene processing
+
+def stream_windows(width, height, tile=None, budget_mb=None):
+    tile = tile or STREAM_TILE_SIZE
+    budget_mb = budget_mb or STREAM_BLOCK_BUDGET_MB
+    bytes_per_pixel = STREAM_BYTES_PER_PIXEL
+    if UNCERTAINTY_LAYERS:
+        bytes_per_pixel += STREAM_UNCERTAINTY_BYTES_PER_PIXEL
+    max_pixels = max(
+        tile * tile, int(budget_mb * 1024 * 1024) // bytes_per_pixel
+    )
+
+    # Prefer full-width strips of whole tile rows; fall back to runs of
+    # tiles along a single tile row when one strip exceeds the budget
+    if width * tile <= max_pixels:
+        win_w = width
+        win_h = tile * max(1, max_pixels // (width * tile))
+    else:
+        win_w = tile * max(1, max_pixels // (tile * tile))
+        win_h = tile
+
+    for row_off in range(0, height, win_h):
+        h = min(win_h, height - row_off)
+        for col_off in range(0, width, win_w):
+            w = min(win_w, width - col_off)
+            yield Window(col_off, row_off, w, h)
+
+
+def streaming_profile(profile, tile=None):
+    tile = tile or STREAM_TILE_SIZE
+    profile = profile.copy()
+    profile.update(count=1)
+
+    # GeoTIFF tiles must be multiples of 16; tiny rasters stay striped
+    if tile % 16 == 0 and profile["width"] >= tile and profile["height"] >= tile:
+        profile.update(tiled=True, blockxsize=tile, blockysize=tile)
+    return profile
+
+
+def process_scene_streaming(tif_path, uresnet_prob_path, prob_output, mask_output,
+                            budget_mb=None, tile=None):
+    with rasterio.open(tif_path) as src, rasterio.open(uresnet_prob_path) as up:
+        if (up.width, up.height) != (src.width, src.height):
+            raise ValueError(
+                f"UResNet probability grid {up.width}x{up.height} does not "
+                f"match {src.width}x{src.height} for {tif_path}"
+            )
+
+        profile = streaming_profile(src.profile, tile)
+        prob_profile, mask_profile, names, params = output_profiles(profile, tile)
+
+        print("Running Monte Carlo thresholding (streaming)...")
+        with ExitStack() as stack:
+            prob_dst = stack.enter_context(
+                rasterio.open(write_path(prob_output), "w", **prob_profile)
+            )
+            mask_dst = None
+            if mask_output is not None:
+                mask_dst = stack.enter_context(
+                    rasterio.open(write_path(mask_output), "w", **mask_profile)
+                )
+            describe_prob(prob_dst, names, params)
+
+            for window in stream_windows(src.width, src.height, tile, budget_mb):
+                with span("read") as s:
+                    green = src.read(GREEN_BAND, window=window)
+                    swir = src.read(SWIR_BAND, window=window)
+                    uresnet_prob = up.read(1, window=window)
+                    s.add(
+                        bytes_read=green.nbytes + swir.nbytes + uresnet_prob.nbytes,
+                        pixels=green.size,
+                    )
+                    uresnet_prob = uresnet_prob.astype(np.float32)
+
+                prob_bands, ensemble_binary = ensemble_block(green, swir, uresnet_prob)
+
+                prob_bands = encode_prob(prob_bands, ensemble_binary, params)
+
+                with span("write") as s:
+                    prob_dst.write(prob_bands, window=window)
+                    s.add(bytes_written=prob_bands.nbytes)
+                    if mask_dst is not None:
+                        mask_dst.write(ensemble_binary, 1, window=window)
+                        s.add(bytes_written=ensemble_binary.nbytes)
+
+    finish_outputs(prob_output, mask_output)
+
+
+# Batch runner with resume manifest
+
+def file_signature(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return {}
+
+
+def save_manifest(manifest, manifest_path):
+    atomic_write_json(manifest, manifest_path)
+
+
+def scene_jobs():
+    jobs = []
+    tif_files = sorted(f for f in os.listdir(folder_path) if f.endswith(".tif"))
+
+    for tif_name in tif_files:
+        prob_output, mask_output = output_paths(tif_name)
+        jobs.append({
+            "input": os.path.join(folder_path, tif_name),
+            "uresnet_prob": os.path.join(
+                uresnet_pred_folder,
+                tif_name.replace(".tif", "_prob.tif")
+            ),
+            "outputs": {
+                key: path
+                for key, path in (("prob", prob_output), ("mask", mask_output))
+                if path is not None
+            },
+        })
+    return jobs
+
+
+def is_up_to_date(entry, job):
+    if not entry or entry.get("status") != "done":
+        return False
+    if entry.get("output_options", {"format": "gtiff"}) != output_options():
+        return False
+    try:
+        if entry.get("input_signature") != file_signature(job["input"]):
+            return False
+        if entry.get("uresnet_signature") != file_signature(job["uresnet_prob"]):
+            return False
+        for key, path in job["outputs"].items():
+            if entry.get("output_signatures", {}).get(key) != file_signature(path):
+                return False
+    except OSError:
+        return False
+    return True
+
+
+def run_scene(job):
+    record = {
+        "input": job["input"],
+        "uresnet_prob": job["uresnet_prob"],
+        "outputs": job["outputs"],
+        "output_options": output_options(),
+        "started": time.time(),
+    }
+    t0 = time.time()
+
+    try:
+        record["input_signature"] = file_signature(job["input"])
+        record["uresnet_signature"] = file_signature(job["uresnet_prob"])
+
+        prob_output = job["outputs"]["prob"]
+        mask_output = job["outputs"].get("mask")
+        with span("scene", scene=os.path.basename(job["input"]), stream=STREAM_MODE) as s:
+            if trace_enabled():
+                with rasterio.open(job["input"]) as src:
+                    s.add(pixels=src.width * src.height)
+            if STREAM_MODE:
+                process_scene_streaming(
+                    job["input"], job["uresnet_prob"], prob_output, mask_output
+                )
+            else:
+                process_scene(job["input"], job["uresnet_prob"], prob_output, mask_output)
+
+        record["output_signatures"] = {
+            key: file_signature(path) for key, path in job["outputs"].items()
+        }
+        record["status"] = "done"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+
+    record["seconds"] = round(time.time() - t0, 3)
+    return record
+
+
+def run_batch(jobs, manifest_path, n_workers=None):
+    n_workers = n_workers or N_WORKERS
+    manifest = load_manifest(manifest_path)
+
+    pending = []
+    for job in jobs:
+        name = os.path.basename(job["input"])
+        if not os.path.exists(job["uresnet_prob"]):
+            print(f"Missing UNet probability raster for: {name}")
+            manifest[job["input"]] = dict(
+                job, status="missing_prob", started=time.time(), seconds=0.0
+            )
+            continue
+        if is_up_to_date(manifest.get(job["input"]), job):
+            print(f"Up to date, skipping: {name}")
+            continue
+        pending.append(job)
+
+    save_manifest(manifest, manifest_path)
+
+    def record_result(record):
+        # Only the parent process touches the manifest
+        manifest[record["input"]] = record
+        save_manifest(manifest, manifest_path)
+
+        name = os.path.basename(record["input"])
+        if record["status"] == "done":
+            print(f"Saved probability: {record['outputs']['prob']}")
+            if "mask" in record["outputs"]:
+                print(f"Saved mask: {record['outputs']['mask']}")
+            print(f"Processed {name} in {record['seconds']:.2f} s")
+        else:
+            print(f"Failed {name}: {record['error']}")
+
+    if n_workers <= 1:
+        for job in pending:
+            print(f"Processing: {os.path.basename(job['input'])}")
+            record_result(run_scene(job))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(run_scene, job): job for job in pending}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    # A crashed worker still gets a manifest entry
+                    job = futures[future]
+                    record = dict(
+                        job, status="failed", started=None, seconds=None,
+                        error=f"{type(e).__name__}: {e}"
+                    )
+                record_result(record)
+
+    return manifest
+
+
+def main():
+    setup_trace(TRACE_PATH)
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    manifest = run_batch(scene_jobs(), manifest_path)
 
-    profile.update(dtype=rasterio.uint8)
+    failed = [k for k, v in manifest.items() if v.get("status") == "failed"]
+    if failed:
+        print(f"{len(failed)} scene(s) failed, see {manifest_path}")
 
-    with rasterio.open(mask_output, "w", **profile) as dst:
-        dst.write(ensemble_binary, 1)
 
-    print(f"Saved probability: {prob_output}")
-    print(f"Saved mask: {mask_output}")
+if __name__ == "__main__":
+    main()
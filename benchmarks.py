@@ -0,0 +1,307 @@
+#benchmarks.py
+"""
+Benchmarks for the ensemble, evaluation and masking hot paths.
+
+Synthetic Landsat-like (7-band uint16 SR, 30 m) and Sentinel-2-like
+(float32 MNDWI, 10 m) rasters are generated per size, and each case is
+timed BENCH_REPEAT times. Peak memory is the tracemalloc peak of one extra
+untimed call, so it covers NumPy allocations but not GDAL's block cache.
+Results go to BENCH_OUTPUT as JSON; with BENCH_BASELINE set, the run is
+compared against an earlier result file.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+from shapely import affinity
+
+from evaluation_utils import evaluate_confusion
+from raster_utils import masked_read, clear_clip_mask_cache
+from script_utils import load_script
+
+BENCH_SIZES = [1000, 2000, 5000, 10000, 20000]
+BENCH_REPEAT = 3
+BENCH_CASES = None        # None runs all of CASES
+# Cases whose estimate (size^2 x bytes per pixel, see CASES) is above this
+# are skipped. The largest, monte_carlo at 20000^2, needs about 9.6 GB
+# (8.9 GiB). The estimates leave out the transient float64 arrays that
+# rng.normal allocates while the inputs are generated
+BENCH_MAX_MB = 12288
+BENCH_DATA_DIR = None     # None uses a temporary folder
+BENCH_OUTPUT = "benchmark_results.json"
+BENCH_BASELINE = None     # earlier result file to compare against
+REGRESSION_TOLERANCE = 0.10
+
+BLOCK_ROWS = 1024
+BENCH_SEED = 0
+
+
+ensemble = load_script("8_develop_mndwi_MonteCarlo_EnsembleUResNetMNDWI.py", "mc_ensemble")
+reflectance = load_script("2. reflectance_utils.py", "reflectance_utils")
+
+# Synthetic data
+# Water is a smooth random field (coarse noise, upsampled) so masks and
+# probabilities have lake-like structure rather than salt-and-pepper noise.
+
+def water_field(rng, rows, cols, cell=64):
+    coarse = rng.random((rows // cell + 2, cols // cell + 2), dtype=np.float32)
+    field = np.repeat(np.repeat(coarse, cell, axis=0), cell, axis=1)[:rows, :cols]
+    return field + rng.normal(0, 0.05, size=(rows, cols)).astype(np.float32)
+
+
+def landsat_bands(rng, rows, cols):
+    """Green and SWIR1 reflectance (float32) with water where the field is high."""
+    water = water_field(rng, rows, cols) > 0.6
+    green = rng.normal(0.08, 0.01, size=(rows, cols)).astype(np.float32)
+    swir = np.where(water, 0.02, 0.2).astype(np.float32)
+    swir += rng.normal(0, 0.02, size=(rows, cols)).astype(np.float32)
+    return green, swir
+
+
+def reservoir_geometry(transform, size):
+    # Ellipse over the central part of the raster, in raster coordinates
+    cx, cy = transform * (size / 2, size / 2)
+    radius = size * abs(transform.a) * 0.35
+    return [affinity.scale(Point(cx, cy).buffer(radius, 64), 1.0, 0.7)]
+
+
+def write_blocks(path, size, count, dtype, transform, fill):
+    profile = dict(
+        driver="GTiff", height=size, width=size, count=count, dtype=dtype,
+        crs="EPSG:32631", transform=transform, tiled=True,
+        blockxsize=512, blockysize=512, compress="deflate",
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        for r0 in range(0, size, BLOCK_ROWS):
+            rows = min(BLOCK_ROWS, size - r0)
+            window = rasterio.windows.Window(0, r0, size, rows)
+            dst.write(fill(r0, rows), window=window)
+
+
+def make_landsat_scene(folder, size, rng):
+    os.makedirs(folder, exist_ok=True)
+    transform = from_origin(600000, 1300000, 30, 30)
+    for b in reflectance.BAND_LIST:
+        path = os.path.join(folder, f"LC09_L2SP_191053_20230101_SR_B{b}.TIF")
+        if os.path.exists(path):
+            continue
+        base = 7000 + 1000 * b
+        write_blocks(
+            path, size, 1, "uint16", transform,
+            lambda r0, rows: rng.integers(base, base + 8000, size=(1, rows, size), dtype=np.uint16),
+        )
+    return transform
+
+
+def make_sen2_mndwi(path, size, rng):
+    transform = from_origin(600000, 1300000, 10, 10)
+    if not os.path.exists(path):
+        write_blocks(
+            path, size, 1, "float32", transform,
+            lambda r0, rows: (water_field(rng, rows, size) - 0.5)[np.newaxis],
+        )
+    return transform
+
+
+class Reservoir:
+    """Minimal stand-in for a GeoDataFrame row: only .geometry is used."""
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+
+# Cases
+# Each case maps (size, data_dir, rng) to the function that gets timed.
+
+def case_compute_mndwi(size, data_dir, rng):
+    green, swir = landsat_bands(rng, size, size)
+    return lambda: ensemble.compute_mndwi(green, swir)
+
+
+def case_monte_carlo(size, data_dir, rng):
+    green, swir = landsat_bands(rng, size, size)
+    mndwi = ensemble.compute_mndwi(green, swir)
+    del green, swir
+    return lambda: ensemble.monte_carlo_mndwi_probability(mndwi)
+
+
+def case_fuse_max(size, data_dir, rng):
+    uresnet_prob = np.clip(water_field(rng, size, size), 0, 1)
+    mndwi_prob = np.clip(water_field(rng, size, size), 0, 1)
+    return lambda: ensemble.fuse_max(uresnet_prob, mndwi_prob)
+
+
+def case_evaluate_model(size, data_dir, rng):
+    # Same call as evaluate_model in script 12
+    ref = (water_field(rng, size, size) > 0.6).astype(np.float32)
+    pred = (water_field(rng, size, size) > 0.6).astype(np.float32)
+    ref[:, :size // 20] = -9999
+    return lambda: evaluate_confusion(pred, ref, average="macro", nodata=-9999)
+
+
+def case_clip_raster(size, data_dir, rng):
+    # Same read as clip_raster in scripts 12 and 16
+    path = os.path.join(data_dir, f"sen2_mndwi_{size}.tif")
+    geometry = reservoir_geometry(make_sen2_mndwi(path, size, rng), size)
+
+    def run():
+        clear_clip_mask_cache()
+        with rasterio.open(path) as src:
+            return masked_read(src, geometry)
+
+    return run
+
+
+def case_mean_reflectance(size, data_dir, rng):
+    folder = os.path.join(data_dir, f"landsat_{size}")
+    reservoir = Reservoir(reservoir_geometry(make_landsat_scene(folder, size, rng), size))
+
+    def run():
+        clear_clip_mask_cache()
+        return reflectance.compute_mean_reflectance(folder, reservoir)
+
+    return run
+
+
+# name -> (case, bytes per pixel estimate of its inputs and peak working set)
+CASES = {
+    "compute_mndwi": (case_compute_mndwi, 16),
+    "monte_carlo_mndwi_probability": (case_monte_carlo, 24),
+    "fuse_max": (case_fuse_max, 16),
+    "evaluate_model": (case_evaluate_model, 16),
+    "clip_raster": (case_clip_raster, 8),
+    "compute_mean_reflectance": (case_mean_reflectance, 8),
+}
+
+# Running
+
+def time_case(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def run_case(name, size, data_dir, repeat=BENCH_REPEAT, max_mb=BENCH_MAX_MB):
+    record = {"case": name, "size": size, "pixels": size * size}
+    rng = np.random.default_rng(BENCH_SEED)
+
+    # Checked before the inputs are built, so skipped sizes allocate nothing
+    case, bytes_per_pixel = CASES[name]
+    if size * size * bytes_per_pixel / 1024 ** 2 > max_mb:
+        record["status"] = "skipped"
+        return record
+
+    func = case(size, data_dir, rng)
+
+    times, peak = time_case(func, repeat)
+    best = min(times)
+    record.update(
+        status="ok",
+        repeat=repeat,
+        min_s=best,
+        median_s=float(np.median(times)),
+        mpix_per_s=size * size / best / 1e6,
+        peak_mb=peak / 1024 ** 2,
+    )
+    return record
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_benchmarks(sizes=None, cases=None, repeat=BENCH_REPEAT, data_dir=None,
+                   max_mb=BENCH_MAX_MB):
+    sizes = sizes or BENCH_SIZES
+    cases = cases or list(CASES)
+    cleanup = data_dir is None
+    data_dir = data_dir or tempfile.mkdtemp(prefix="mndwi_bench_")
+    os.makedirs(data_dir, exist_ok=True)
+
+    results = []
+    try:
+        for size in sizes:
+            for name in cases:
+                record = run_case(name, size, data_dir, repeat, max_mb)
+                results.append(record)
+                if record["status"] == "ok":
+                    print(f"{name:32s} {size:6d}^2  {record['min_s']:9.3f} s  "
+                          f"{record['mpix_per_s']:8.1f} Mpx/s  {record['peak_mb']:9.1f} MB")
+                else:
+                    print(f"{name:32s} {size:6d}^2  {record['status']}")
+    finally:
+        if cleanup:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {"environment": environment(), "results": results}
+
+
+def compare_results(baseline, current, tolerance=REGRESSION_TOLERANCE):
+    """Per-case time ratios (current / baseline); ratios above 1 + tolerance are regressions."""
+    old = {(r["case"], r["size"]): r for r in baseline["results"] if r.get("status") == "ok"}
+    rows = []
+    for r in current["results"]:
+        key = (r["case"], r["size"])
+        if r.get("status") != "ok" or key not in old:
+            continue
+        ratio = r["min_s"] / old[key]["min_s"]
+        rows.append({
+            "case": r["case"], "size": r["size"], "ratio": ratio,
+            "peak_ratio": r["peak_mb"] / old[key]["peak_mb"] if old[key]["peak_mb"] else None,
+            "regression": ratio > 1 + tolerance,
+        })
+    return rows
+
+
+def main():
+    report = run_benchmarks(BENCH_SIZES, BENCH_CASES, BENCH_REPEAT, BENCH_DATA_DIR)
+
+    with open(BENCH_OUTPUT, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {BENCH_OUTPUT}")
+
+    if BENCH_BASELINE:
+        with open(BENCH_BASELINE, "r") as f:
+            baseline = json.load(f)
+        for row in compare_results(baseline, report):
+            flag = "REGRESSION" if row["regression"] else ""
+            print(f"{row['case']:32s} {row['size']:6d}^2  x{row['ratio']:.2f} {flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#catalog_utils.py
+"""
+Incremental SQLite catalog of Landsat scene folders.
+
+Each scene folder is parsed once: MTL fields, flow regime, SR band paths and
+file mtimes are stored, and rescans only reparse folders whose folder or MTL
+mtime changed. Mean reservoir reflectances are cached per scene and
+reservoir geometry. Queries by date, cloud cover, WRS path/row or flow
+regime read the index instead of the filesystem.
+"""
+
+import os
+import re
+import glob
+import json
+import sqlite3
+import pandas as pd
+
+CATALOG_DB = "scene_catalog.sqlite"
+SR_BANDS = [1, 2, 3, 4, 5, 6, 7]
+
+_MTL_LINE = re.compile(r"^\s*([A-Za-z0-9_]+)\s*=\s*(.*?)\s*$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    folder TEXT PRIMARY KEY,
+    base_path TEXT,
+    filename TEXT,
+    mtl_path TEXT,
+    folder_mtime REAL,
+    mtl_mtime REAL,
+    date_acquired TEXT,
+    flow_regime TEXT,
+    spacecraft_id TEXT,
+    sensor_id TEXT,
+    collection_category TEXT,
+    data_type TEXT,
+    cloud_cover REAL,
+    sun_elevation REAL,
+    sun_azimuth REAL,
+    wrs_path TEXT,
+    wrs_row TEXT,
+    mtl_json TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scenes_base ON scenes (base_path);
+CREATE INDEX IF NOT EXISTS idx_scenes_date ON scenes (date_acquired);
+CREATE TABLE IF NOT EXISTS bands (
+    folder TEXT,
+    band INTEGER,
+    path TEXT,
+    mtime REAL,
+    size INTEGER,
+    PRIMARY KEY (folder, band)
+);
+CREATE TABLE IF NOT EXISTS reflectance (
+    folder TEXT,
+    reservoir_key TEXT,
+    band INTEGER,
+    mean REAL,
+    PRIMARY KEY (folder, reservoir_key, band)
+);
+"""
+
+
+def parse_mtl_file(mtl_path):
+    """Single MTL parser: KEY = VALUE lines, quotes stripped."""
+    meta = {}
+    with open(mtl_path, "r") as f:
+        for line in f:
+            match = _MTL_LINE.match(line)
+            if match:
+                meta[match.group(1)] = match.group(2).strip('"')
+    return meta
+
+
+def assign_flood_type(date_str):
+    """Flow regime of an acquisition date: BF (Dec-Mar), WF (Jun-Nov) or Unknown."""
+    try:
+        month = int(date_str.split("-")[1])
+        if month in [12, 1, 2, 3]:
+            return "BF"
+        if month in [6, 7, 8, 9, 10, 11]:
+            return "WF"
+        return "Unknown"
+    except Exception:
+        return "Unknown"
+
+
+def _float_or(value, default=-1.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class SceneCatalog:
+    def __init__(self, db_path=CATALOG_DB):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Scanning
+
+    def scan(self, base_path):
+        """Index new or changed scene folders under base_path; returns counts."""
+        base_path = os.path.abspath(base_path)
+        known = {
+            row[0]: (row[1], row[2])
+            for row in self.conn.execute(
+                "SELECT folder, folder_mtime, mtl_mtime FROM scenes WHERE base_path = ?",
+                (base_path,),
+            )
+        }
+
+        seen = set()
+        updated = 0
+
+        for entry in os.scandir(base_path):
+            if not entry.is_dir():
+                continue
+            folder = os.path.abspath(entry.path)
+            mtl_files = glob.glob(os.path.join(folder, "*_MTL.txt"))
+            if not mtl_files:
+                continue
+            seen.add(folder)
+
+            folder_mtime = entry.stat().st_mtime
+            mtl_mtime = os.path.getmtime(mtl_files[0])
+            if known.get(folder) == (folder_mtime, mtl_mtime) and self._bands_unchanged(folder):
+                continue
+
+            self._index_folder(base_path, folder, mtl_files[0], folder_mtime, mtl_mtime)
+            updated += 1
+
+        removed = [folder for folder in known if folder not in seen]
+        for folder in removed:
+            self._forget(folder)
+
+        self.conn.commit()
+        return {"updated": updated, "removed": len(removed), "total": len(seen)}
+
+    def _index_folder(self, base_path, folder, mtl_path, folder_mtime, mtl_mtime):
+        meta = parse_mtl_file(mtl_path)
+        date = meta.get("DATE_ACQUIRED", "0000-00-00")
+
+        # Changed folders lose their cached reflectances
+        self._forget(folder)
+
+        self.conn.execute(
+            "INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                folder, base_path, os.path.basename(folder), mtl_path,
+                folder_mtime, mtl_mtime, date, assign_flood_type(date),
+                meta.get("SPACECRAFT_ID"), meta.get("SENSOR_ID"),
+                meta.get("COLLECTION_CATEGORY"), meta.get("DATA_TYPE"),
+                _float_or(meta.get("CLOUD_COVER")),
+                _float_or(meta.get("SUN_ELEVATION")),
+                _float_or(meta.get("SUN_AZIMUTH")),
+                meta.get("WRS_PATH"), meta.get("WRS_ROW"),
+                json.dumps(meta),
+            ),
+        )
+
+        for b in SR_BANDS:
+            tif = glob.glob(os.path.join(folder, f"*SR_B{b}.TIF"))
+            if tif:
+                st = os.stat(tif[0])
+                self.conn.execute(
+                    "INSERT INTO bands VALUES (?, ?, ?, ?, ?)",
+                    (folder, b, tif[0], st.st_mtime, st.st_size),
+                )
+
+    def _bands_unchanged(self, folder):
+        # Band files rewritten in place do not touch the folder mtime
+        for path, mtime in self.conn.execute(
+            "SELECT path, mtime FROM bands WHERE folder = ?", (folder,)
+        ):
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _forget(self, folder):
+        for table in ["scenes", "bands", "reflectance"]:
+            self.conn.execute(f"DELETE FROM {table} WHERE folder = ?", (folder,))
+
+    # Queries
+
+    def query(self, base_path=None, start=None, end=None, max_cloud=None,
+              wrs_path=None, wrs_row=None, flow_regime=None):
+        clauses, params = [], []
+        if base_path is not None:
+            clauses.append("base_path = ?")
+            params.append(os.path.abspath(base_path))
+        if start is not None:
+            clauses.append("date_acquired >= ?")
+            params.append(str(start))
+        if end is not None:
+            clauses.append("date_acquired <= ?")
+            params.append(str(end))
+        if max_cloud is not None:
+            clauses.append("cloud_cover <= ?")
+            params.append(float(max_cloud))
+        if wrs_path is not None:
+            clauses.append("CAST(wrs_path AS INTEGER) = ?")
+            params.append(int(wrs_path))
+        if wrs_row is not None:
+            clauses.append("CAST(wrs_row AS INTEGER) = ?")
+            params.append(int(wrs_row))
+        if flow_regime is not None:
+            clauses.append("flow_regime = ?")
+            params.append(flow_regime)
+
+        sql = "SELECT * FROM scenes"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY date_acquired, folder"
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def metadata_frame(self, **filters):
+        """Scenes in the column layout of extract_metadata_from_folder."""
+        scenes = self.query(**filters)
+        return pd.DataFrame({
+            "FILENAME": scenes["filename"],
+            "Flow Regime": scenes["flow_regime"],
+            "SPACECRAFT_ID": scenes["spacecraft_id"],
+            "SENSOR_ID": scenes["sensor_id"],
+            "DATE_ACQUIRED": scenes["date_acquired"],
+            "COLLECTION_CATEGORY": scenes["collection_category"],
+            "DATA_TYPE": scenes["data_type"],
+            "CLOUD_COVER": scenes["cloud_cover"],
+            "SUN_ELEVATION": scenes["sun_elevation"],
+            "SUN_AZIMUTH": scenes["sun_azimuth"],
+            "WRS_PATH": scenes["wrs_path"],
+            "WRS_ROW": scenes["wrs_row"],
+        })
+
+    def band_paths(self, folder):
+        rows = self.conn.execute(
+            "SELECT band, path FROM bands WHERE folder = ? ORDER BY band",
+            (os.path.abspath(folder),),
+        )
+        return dict(rows.fetchall())
+
+    # Cached reflectances
+
+    def cached_reflectance(self, folder, reservoir_key):
+        rows = dict(self.conn.execute(
+            "SELECT band, mean FROM reflectance WHERE folder = ? AND reservoir_key = ?",
+            (os.path.abspath(folder), reservoir_key),
+        ).fetchall())
+        if len(rows) != len(SR_BANDS):
+            return None
+        # SQLite stores NaN as NULL
+        return [float("nan") if rows[b] is None else rows[b] for b in SR_BANDS]
+
+    def store_reflectance(self, folder, reservoir_key, values):
+        folder = os.path.abspath(folder)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO reflectance VALUES (?, ?, ?, ?)",
+            [(folder, reservoir_key, b, float(v)) for b, v in zip(SR_BANDS, values)],
+        )
+        self.conn.commit()
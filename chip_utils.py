@@ -0,0 +1,314 @@
+#chip_utils.py
+"""
+Packed training chip store for the exported ArcGIS training data.
+
+pack_chips reads the image/label chips listed in map.txt once and writes
+them into two contiguous .npy arrays (images: N x bands x H x W, labels:
+N x H x W) plus index.json with each chip's source, georeference and
+per-band stats. Normalization is precomputed from
+esri_accumulated_stats.json (mean M1, std sqrt(M2 / Num)).
+
+Export tiles at the scene edge are padded with 65535 and declare no
+nodata. That fill (or the chip nodata, when set) is left out of the chip
+stats and comes out of ChipDataset as 0, the normalized band mean.
+
+ChipDataset serves (image, label) samples from memory-mapped arrays. The
+arrays are opened lazily in each DataLoader worker, chips are sliced
+without copying, and only the cropped/augmented float32 sample is
+materialized.
+"""
+
+import os
+import json
+import numpy as np
+import rasterio
+
+CHIP_DIR = os.path.join("GIS Files", "TilesSurfaceWaterExtentTrainingData3")
+STORE_NAME = "packed"
+ACCUMULATED_STATS = "esri_accumulated_stats.json"
+# Bumped when the store layout changes, so older stores are repacked
+STORE_VERSION = 2
+# Fill value of the exported uint16 chips when none is declared
+CHIP_NODATA = 65535
+
+# Same chip size, batch size and validation share as 6_train_models.py
+CHIP_SIZE = 224
+BATCH_SIZE = 16
+VALID_FRACTION = 0.2
+SPLIT_SEED = 42
+
+
+def parse_map(chip_dir):
+    """(image, label) paths from map.txt, with Windows separators resolved."""
+    pairs = []
+    with open(os.path.join(chip_dir, "map.txt"), "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            image, label = (os.path.join(chip_dir, *p.split("\\")) for p in parts[:2])
+            pairs.append((image, label))
+    return pairs
+
+
+def accumulated_stats(chip_dir):
+    """Per-band mean and std from Esri's accumulated band statistics."""
+    with open(os.path.join(chip_dir, ACCUMULATED_STATS), "r", encoding="utf-8-sig") as f:
+        bands = json.load(f)["BandStatsState"]
+    mean = np.array([b["M1"] for b in bands], dtype=np.float64)
+    std = np.sqrt(np.array([b["M2"] / b["Num"] for b in bands], dtype=np.float64))
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def source_signature(pairs):
+    # Count, total size and newest mtime of every source chip
+    sizes, mtimes = 0, 0
+    for image, label in pairs:
+        for path in (image, label):
+            st = os.stat(path)
+            sizes += st.st_size
+            mtimes = max(mtimes, st.st_mtime_ns)
+    return {"chips": len(pairs), "bytes": sizes, "mtime_ns": mtimes}
+
+
+def store_paths(store_dir):
+    return {
+        "images": os.path.join(store_dir, "images.npy"),
+        "labels": os.path.join(store_dir, "labels.npy"),
+        "index": os.path.join(store_dir, "index.json"),
+    }
+
+# Packing
+
+def chip_stats(image, nodata=None):
+    """Per-band stats over valid pixels; None for a band with none."""
+    stats = {"min": [], "max": [], "mean": [], "std": [], "valid": []}
+    for band in image.reshape(image.shape[0], -1):
+        values = band if nodata is None else band[band != nodata]
+        stats["valid"].append(int(values.size))
+        if not values.size:
+            for key in ("min", "max", "mean", "std"):
+                stats[key].append(None)
+            continue
+        stats["min"].append(values.min().item())
+        stats["max"].append(values.max().item())
+        stats["mean"].append(float(values.mean()))
+        stats["std"].append(float(values.std()))
+    return stats
+
+
+def pack_chips(chip_dir=CHIP_DIR, store_dir=None, overwrite=False):
+    """Pack the chips of chip_dir into store_dir; skipped if already current."""
+    store_dir = store_dir or os.path.join(chip_dir, STORE_NAME)
+    paths = store_paths(store_dir)
+    pairs = parse_map(chip_dir)
+    signature = source_signature(pairs)
+
+    if not overwrite and os.path.exists(paths["index"]):
+        with open(paths["index"], "r") as f:
+            index = json.load(f)
+        if index.get("source") == signature and index.get("version") == STORE_VERSION:
+            return store_dir
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    with rasterio.open(pairs[0][0]) as src:
+        count, height, width = src.count, src.height, src.width
+        image_dtype = src.dtypes[0]
+        crs = src.crs.to_wkt() if src.crs else None
+        nodata = src.nodata if src.nodata is not None else CHIP_NODATA
+
+    tmp = {key: path + ".tmp" for key, path in paths.items()}
+    images = np.lib.format.open_memmap(
+        tmp["images"], mode="w+", dtype=image_dtype,
+        shape=(len(pairs), count, height, width),
+    )
+    labels = np.lib.format.open_memmap(
+        tmp["labels"], mode="w+", dtype=np.uint8,
+        shape=(len(pairs), height, width),
+    )
+
+    chips = []
+    for i, (image_path, label_path) in enumerate(pairs):
+        with rasterio.open(image_path) as src:
+            if (src.count, src.height, src.width) != (count, height, width):
+                raise ValueError(f"{image_path} does not match the first chip's shape")
+            images[i] = src.read()
+            transform = tuple(src.transform)[:6]
+            bounds = tuple(src.bounds)
+        with rasterio.open(label_path) as src:
+            labels[i] = src.read(1)
+
+        chips.append({
+            "name": os.path.splitext(os.path.basename(image_path))[0],
+            "image": os.path.relpath(image_path, chip_dir),
+            "label": os.path.relpath(label_path, chip_dir),
+            "transform": transform,
+            "bounds": bounds,
+            "water_fraction": float(labels[i].mean()),
+            "stats": chip_stats(images[i], nodata),
+        })
+
+    images.flush()
+    labels.flush()
+    del images, labels
+
+    mean, std = accumulated_stats(chip_dir)
+    index = {
+        "version": STORE_VERSION,
+        "source": signature,
+        "crs": crs,
+        "shape": [len(pairs), count, height, width],
+        "dtype": image_dtype,
+        "nodata": nodata,
+        "norm_mean": mean.tolist(),
+        "norm_std": std.tolist(),
+        "chips": chips,
+    }
+    with open(tmp["index"], "w") as f:
+        json.dump(index, f)
+
+    # Index last, so a half-written store is never taken as current
+    os.replace(tmp["images"], paths["images"])
+    os.replace(tmp["labels"], paths["labels"])
+    os.replace(tmp["index"], paths["index"])
+    return store_dir
+
+
+def load_index(store_dir):
+    with open(store_paths(store_dir)["index"], "r") as f:
+        return json.load(f)
+
+
+def train_valid_split(n, valid_fraction=VALID_FRACTION, seed=SPLIT_SEED):
+    order = np.random.default_rng(seed).permutation(n)
+    n_valid = int(round(n * valid_fraction))
+    return np.sort(order[n_valid:]), np.sort(order[:n_valid])
+
+# Dataset
+
+def _worker_id():
+    """DataLoader worker id, 0 in the main process."""
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return 0
+    info = get_worker_info()
+    return info.id if info is not None else 0
+
+
+class ChipDataset:
+    """Map-style dataset over a packed store, usable with torch DataLoader."""
+
+    def __init__(self, store_dir, indices=None, chip_size=CHIP_SIZE, augment=False,
+                 seed=None):
+        index = load_index(store_dir)
+        self.paths = store_paths(store_dir)
+        self.indices = np.arange(index["shape"][0]) if indices is None else np.asarray(indices)
+        self.chip_size = chip_size
+        self.augment = augment
+        self.seed = seed
+        self.epoch = 0
+
+        self.mean = np.array(index["norm_mean"], dtype=np.float32)[:, None, None]
+        self.inv_std = 1.0 / np.array(index["norm_std"], dtype=np.float32)[:, None, None]
+        self.nodata = index.get("nodata")
+
+        # Opened per process on first access (after DataLoader forks workers)
+        self._images = None
+        self._labels = None
+        self._rng = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def set_epoch(self, epoch):
+        """Reseed augmentation from (seed, epoch, worker id) for this epoch."""
+        self.epoch = epoch
+        self._rng = None
+
+    def _open(self):
+        self._images = np.load(self.paths["images"], mmap_mode="r")
+        self._labels = np.load(self.paths["labels"], mmap_mode="r")
+
+    def _augment_rng(self):
+        if self._rng is None:
+            seed = self.seed
+            if seed is not None:
+                seed = [seed, self.epoch, _worker_id()]
+            self._rng = np.random.default_rng(seed)
+        return self._rng
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_images=None, _labels=None, _rng=None)
+        return state
+
+    def sample(self, i):
+        """Normalized float32 (bands, chip, chip) image and uint8 label."""
+        if self._images is None:
+            self._open()
+
+        chip = self.indices[i]
+        height, width = self._images.shape[2:]
+        size = self.chip_size
+
+        # Random crop when augmenting, else the center crop
+        if self.augment:
+            rng = self._augment_rng()
+            r = int(rng.integers(0, height - size + 1))
+            c = int(rng.integers(0, width - size + 1))
+        else:
+            r, c = (height - size) // 2, (width - size) // 2
+
+        # Views into the memory map; nothing is copied until normalization
+        image = self._images[chip, :, r:r + size, c:c + size]
+        label = self._labels[chip, r:r + size, c:c + size]
+
+        if self.augment:
+            k = int(rng.integers(0, 4))
+            image = np.rot90(image, k, axes=(1, 2))
+            label = np.rot90(label, k)
+            if rng.random() < 0.5:
+                image = image[:, :, ::-1]
+                label = label[:, ::-1]
+
+        out = np.subtract(image, self.mean, dtype=np.float32)
+        out *= self.inv_std
+        if self.nodata is not None:
+            # Padding becomes the band mean instead of a huge outlier
+            out[image == self.nodata] = 0
+        return out, np.ascontiguousarray(label)
+
+    def __getitem__(self, i):
+        import torch
+
+        image, label = self.sample(i)
+        return torch.from_numpy(image), torch.from_numpy(label.astype(np.int64))
+
+
+def chip_loaders(store_dir, batch_size=BATCH_SIZE, chip_size=CHIP_SIZE,
+                 valid_fraction=VALID_FRACTION, num_workers=0, seed=SPLIT_SEED):
+    """(train, valid) DataLoaders; training chips are augmented and shuffled."""
+    from torch.utils.data import DataLoader
+
+    n = load_index(store_dir)["shape"][0]
+    train_idx, valid_idx = train_valid_split(n, valid_fraction, seed)
+    common = dict(batch_size=batch_size, num_workers=num_workers)
+    # Training workers are restarted every epoch so they pick up set_epoch
+    train = DataLoader(
+        ChipDataset(store_dir, train_idx, chip_size, augment=True, seed=seed),
+        shuffle=True, drop_last=True, **common
+    )
+    valid = DataLoader(
+        ChipDataset(store_dir, valid_idx, chip_size, augment=False),
+        shuffle=False, persistent_workers=num_workers > 0, **common
+    )
+    return train, valid
+
+
+if __name__ == "__main__":
+    store = pack_chips(CHIP_DIR)
+    index = load_index(store)
+    print(f"Packed {index['shape'][0]} chips into {store}")
@@ -0,0 +1,256 @@
+#composite_utils.py
+"""
+Local Sentinel-2 median composites, replacing the GEE export scripts
+9/10/14/15 (...Sen2MNDWIandRGBAcquisitioninGEE...).
+
+Same recipe as the GEE scripts: every L1C granule over the AOI in the date
+window with CLOUDY_PIXEL_PERCENTAGE < 10, per-pixel median of each band
+over the granules, RGB = median B4/B3/B2 and
+MNDWI = normalizedDifference(B3, B11). Values are the raw L1C DNs, as in
+COPERNICUS/S2.
+
+Granules are read from local .SAFE products (MTD_TL.xml gives the
+sensing date and cloud percentage). The 10 m output grid covers the AOI;
+every band, including the 20 m B11, is warped onto it, and the median is
+computed block by block across worker threads, so only one block of the
+scene stack is in memory per worker. Output goes to the <name>_RGB.tif and
+<name>_MNDWI.tif layout script 16 reads.
+"""
+
+import os
+import glob
+import math
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio import features
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from raster_utils import block_windows
+from trace_utils import span
+
+# Local L1C products (*.SAFE) and the script 16 input folders
+S2_DIR = r"D:\Sentinel2\L1C"
+RGB_DIR = r"D:\GEEExports\Gerinya_LKJ\RGB"
+MNDWI_DIR = r"D:\GEEExports\Gerinya_LKJ\MNDWI"
+
+# dateRanges of scripts 9/14 and 10/15; end is exclusive, as filterDate
+COMPOSITES = [
+    {"name": "GRYFlood", "aoi": r"D:\ClipBoundaries\Gerinya.shp",
+     "start": "2024-11-07", "end": "2024-11-15"},
+    {"name": "LKJFlood", "aoi": r"D:\ClipBoundaries\SmallAreaConfluenceLKJBoundary.shp",
+     "start": "2024-11-07", "end": "2024-11-15"},
+]
+
+MAX_CLOUD = 10          # CLOUDY_PIXEL_PERCENTAGE < MAX_CLOUD
+RESOLUTION = 10         # export scale
+OUTPUT_CRS = None       # None: CRS of the first selected granule
+RGB_BANDS = ["B04", "B03", "B02"]
+MNDWI_BANDS = ["B03", "B11"]
+# Upsampling of the 20 m B11; GEE exports at scale 10 use nearest
+B11_RESAMPLING = "nearest"
+
+BLOCK_SIZE = 1024
+COMPOSITE_WORKERS = os.cpu_count() or 1
+
+# Granules
+
+def _xml_text(path, tags):
+    """First text of each tag (namespace ignored) in an XML file."""
+    found = {}
+    for _, elem in ET.iterparse(path):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag in tags and tag not in found:
+            found[tag] = (elem.text or "").strip()
+        elem.clear()
+    return found
+
+
+def granule_info(granule_dir):
+    meta = _xml_text(os.path.join(granule_dir, "MTD_TL.xml"),
+                     {"SENSING_TIME", "CLOUDY_PIXEL_PERCENTAGE"})
+    bands = {}
+    for path in glob.glob(os.path.join(granule_dir, "IMG_DATA", "*_B??.*")):
+        band, ext = os.path.splitext(path.rsplit("_", 1)[-1])
+        if ext.lower() in (".jp2", ".tif"):
+            bands[band] = path
+    return {
+        "id": os.path.basename(granule_dir),
+        "date": meta.get("SENSING_TIME", "")[:10],
+        "cloud": float(meta.get("CLOUDY_PIXEL_PERCENTAGE", 100)),
+        "bands": bands,
+    }
+
+
+def scan_granules(s2_dir=S2_DIR):
+    granules = []
+    for granule_dir in sorted(glob.glob(os.path.join(s2_dir, "*.SAFE", "GRANULE", "*"))):
+        if os.path.exists(os.path.join(granule_dir, "MTD_TL.xml")):
+            granules.append(granule_info(granule_dir))
+    return granules
+
+
+def select_granules(granules, start, end, aoi_bounds, aoi_crs, max_cloud=MAX_CLOUD,
+                    bands=RGB_BANDS + MNDWI_BANDS):
+    """Granules in [start, end) under the cloud limit that overlap the AOI."""
+    selected = []
+    for granule in granules:
+        if not (start <= granule["date"] < end) or granule["cloud"] >= max_cloud:
+            continue
+        if not all(band in granule["bands"] for band in bands):
+            continue
+        with rasterio.open(granule["bands"][bands[0]]) as src:
+            left, bottom, right, top = transform_bounds(src.crs, aoi_crs, *src.bounds)
+        a_left, a_bottom, a_right, a_top = aoi_bounds
+        if left < a_right and right > a_left and bottom < a_top and top > a_bottom:
+            selected.append(granule)
+    return selected
+
+# Composite
+
+def output_grid(bounds, crs, resolution=RESOLUTION):
+    """Transform, width, height of a grid snapped to the resolution."""
+    left = math.floor(bounds[0] / resolution) * resolution
+    bottom = math.floor(bounds[1] / resolution) * resolution
+    right = math.ceil(bounds[2] / resolution) * resolution
+    top = math.ceil(bounds[3] / resolution) * resolution
+    width = int(round((right - left) / resolution))
+    height = int(round((top - bottom) / resolution))
+    return dict(crs=crs, transform=from_origin(left, top, resolution, resolution),
+                width=width, height=height)
+
+
+def temporal_median(stack):
+    """Median along axis 0 ignoring NaN; NaN where no value is left."""
+    stack = np.sort(stack, axis=0)  # NaN sorts last
+    n = np.sum(~np.isnan(stack), axis=0)
+    lo = np.maximum((n - 1) // 2, 0)[None]
+    hi = np.maximum(n // 2, 0)[None]
+    median = (np.take_along_axis(stack, lo, 0)[0] + np.take_along_axis(stack, hi, 0)[0]) / 2
+    median[n == 0] = np.nan
+    return median
+
+
+def read_band(path, window, grid, resampling):
+    # L1C DN 0 is outside the swath; the VRT fills with it as well
+    with rasterio.open(path) as src, \
+            WarpedVRT(src, resampling=resampling, src_nodata=src.nodata or 0, nodata=0,
+                      **grid) as vrt:
+        values = vrt.read(1, window=window).astype(np.float32)
+    values[values == 0] = np.nan
+    return values
+
+
+def composite_block(granules, window, grid, footprints, bands):
+    """Median of each band over the granules overlapping one block."""
+    left, bottom, right, top = rasterio.windows.bounds(window, grid["transform"])
+    overlap = [
+        granule for granule, (g_left, g_bottom, g_right, g_top) in zip(granules, footprints)
+        if g_left < right and g_right > left and g_bottom < top and g_top > bottom
+    ]
+
+    medians = {}
+    for band in bands:
+        resampling = Resampling[B11_RESAMPLING] if band == "B11" else Resampling.nearest
+        if not overlap:
+            medians[band] = np.full((int(window.height), int(window.width)), np.nan,
+                                    dtype=np.float32)
+            continue
+        stack = np.stack([
+            read_band(granule["bands"][band], window, grid, resampling) for granule in overlap
+        ])
+        medians[band] = temporal_median(stack)
+    return medians
+
+
+def mndwi(green, swir):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ((green - swir) / (green + swir)).astype(np.float32)
+
+
+def composite(granules, aoi_path, rgb_path, mndwi_path, block_size=BLOCK_SIZE,
+              n_workers=None, crs=OUTPUT_CRS, resolution=RESOLUTION):
+    """Write the median RGB and MNDWI composites of the granules over the AOI."""
+    n_workers = n_workers or COMPOSITE_WORKERS
+    if crs is None:
+        with rasterio.open(granules[0]["bands"][MNDWI_BANDS[0]]) as src:
+            crs = src.crs
+
+    aoi = gpd.read_file(aoi_path).to_crs(crs)
+    grid = output_grid(aoi.total_bounds, crs, resolution)
+    geometry = list(aoi.geometry)
+
+    footprints = []
+    for granule in granules:
+        with rasterio.open(granule["bands"][MNDWI_BANDS[0]]) as src:
+            footprints.append(transform_bounds(src.crs, crs, *src.bounds))
+
+    bands = list(dict.fromkeys(RGB_BANDS + MNDWI_BANDS))
+    width, height = grid["width"], grid["height"]
+    blocks = list(block_windows(width, height, block_size))
+
+    def work(block):
+        medians = composite_block(granules, block, grid, footprints, bands)
+        # Export region is the AOI polygon, not its bounding box
+        inside = features.geometry_mask(
+            geometry, (int(block.height), int(block.width)),
+            rasterio.windows.transform(block, grid["transform"]), invert=True,
+        )
+        rgb = np.stack([np.where(inside, medians[band], np.nan) for band in RGB_BANDS])
+        index = np.where(inside, mndwi(*(medians[band] for band in MNDWI_BANDS)), np.nan)
+        return rgb.astype(np.float32), index.astype(np.float32)
+
+    profile = dict(
+        driver="GTiff", height=height, width=width, dtype="float32",
+        crs=crs, transform=grid["transform"], nodata=np.nan,
+        compress="deflate", predictor=3,
+    )
+    if width >= 256 and height >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    with span("composite", scenes=len(granules), blocks=len(blocks)) as s, \
+            rasterio.open(rgb_path, "w", count=len(RGB_BANDS), **profile) as rgb_dst, \
+            rasterio.open(mndwi_path, "w", count=1, **profile) as mndwi_dst, \
+            ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for i, band in enumerate(RGB_BANDS, start=1):
+            rgb_dst.set_band_description(i, band)
+        mndwi_dst.set_band_description(1, "MNDWI")
+
+        for start in range(0, len(blocks), n_workers):
+            batch = blocks[start:start + n_workers]
+            for block, (rgb, index) in zip(batch, pool.map(work, batch)):
+                rgb_dst.write(rgb, window=block)
+                mndwi_dst.write(index, 1, window=block)
+                s.add(bytes_written=rgb.nbytes + index.nbytes, pixels=index.size)
+    return rgb_path, mndwi_path
+
+
+def main():
+    for folder in (RGB_DIR, MNDWI_DIR):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    granules = scan_granules(S2_DIR)
+    for spec in COMPOSITES:
+        aoi = gpd.read_file(spec["aoi"])
+        selected = select_granules(granules, spec["start"], spec["end"],
+                                   aoi.total_bounds, aoi.crs)
+        print(f"{spec['name']} image count: {len(selected)}")
+        if not selected:
+            print(f"No S2 L1C images found for {spec['name']}")
+            continue
+
+        rgb_path, mndwi_path = composite(
+            selected, spec["aoi"],
+            os.path.join(RGB_DIR, f"{spec['name']}_RGB.tif"),
+            os.path.join(MNDWI_DIR, f"{spec['name']}_MNDWI.tif"),
+        )
+        print(f"Saved {rgb_path}\nSaved {mndwi_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+#datacube_utils.py
+"""
+Multi-year flood datacube over the script 8 ensemble rasters.
+
+Each (flow regime, year) period, e.g. WF2020, is one time slice. Slices are
+stored in the cube folder as uint8 .npy arrays (probability codes 0-254 and
+a 0/1 water mask, 255 = no data) next to cube.json, which holds the grid and
+the period list. Per-pixel statistics are kept as running counts
+(observations, water, per-regime counts, BF-to-WF transitions), so adding
+or replacing a period only reads that period and its BF/WF counterpart of
+the same year, never the whole archive.
+
+All work runs over row chunks in parallel threads on memory-mapped arrays,
+so memory use is set by CHUNK_ROWS rather than the number of periods.
+write_products derives inundation frequency, permanent vs seasonal water,
+BF-to-WF change and hydroperiod from the counts.
+"""
+
+import os
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from catalog_utils import assign_flood_type
+from raster_utils import atomic_write_json, scaled_read
+from trace_utils import span
+
+CUBE_DIR = "FloodCube"
+# Script 8 output folder and file names
+ENSEMBLE_DIR = "UResNetMNDWIEns"
+PROB_SUFFIX = "_UResNetMNDWI_MC_prob.tif"
+MASK_SUFFIX = "_UResNetMNDWI_MC_mask.tif"
+PRODUCTS_NAME = "flood_recurrence.tif"
+
+CHUNK_ROWS = 512
+CUBE_WORKERS = None  # defaults to os.cpu_count()
+
+# Used to derive the mask when a period has no mask raster
+WATER_THRESHOLD = 0.5
+# Water in at least this share of observations counts as permanent
+PERMANENT_FREQUENCY = 0.95
+# Season lengths (days) of the regimes in catalog_utils.assign_flood_type:
+# Black Flood Dec-Mar, White Flood Jun-Nov
+REGIME_DAYS = {"BF": 121, "WF": 183}
+REGIMES = ["BF", "WF"]
+
+PROB_LEVELS = 254
+NODATA = 255
+
+COUNT_NAMES = [
+    "observations", "water", "prob_sum",
+    "obs_BF", "water_BF", "obs_WF", "water_WF",
+    "pairs", "gain", "loss",
+]
+# prob_sum adds up probability codes; everything else counts periods
+COUNT_DTYPES = {"prob_sum": np.uint32}
+
+PRODUCT_BANDS = [
+    "frequency",
+    "frequency_BF",
+    "frequency_WF",
+    "mean_probability",
+    "water_class",        # 0 never water, 1 seasonal, 2 permanent
+    "bf_to_wf_gain",      # share of years dry in BF and water in WF
+    "bf_to_wf_loss",      # share of years water in BF and dry in WF
+    "hydroperiod_days",
+    "observations",
+]
+
+# Periods and scene names
+
+def period_key(regime, year):
+    # Same naming as the Sentinel-2 rasters in script 12 (WF2020.tif)
+    return f"{regime}{year}"
+
+
+def period_order(entry):
+    # BF (Dec-Mar) comes before WF (Jun-Nov) of the same year
+    return int(entry["year"]), REGIMES.index(entry["regime"])
+
+
+def scene_period(name):
+    """(regime, year) from a scene name such as WF2020, WetBlackL2017 or a Landsat product ID."""
+    match = re.search(r"(BF|WF)_?(\d{4})", name)
+    if match:
+        return match.group(1), match.group(2)
+
+    match = re.search(r"(Black|White)\D*(\d{4})", name, re.IGNORECASE)
+    if match:
+        regime = "BF" if match.group(1).lower() == "black" else "WF"
+        return regime, match.group(2)
+
+    match = re.search(r"_(\d{4})(\d{2})(\d{2})_", name)
+    if match:
+        year, month, day = match.groups()
+        regime = assign_flood_type(f"{year}-{month}-{day}")
+        if regime in REGIMES:
+            # December belongs to the Black Flood season of the next year
+            if regime == "BF" and month == "12":
+                year = str(int(year) + 1)
+            return regime, year
+
+    raise ValueError(f"Cannot tell the flow regime and year of '{name}'")
+
+# Cube files
+
+def cube_paths(cube_dir):
+    return {
+        "index": os.path.join(cube_dir, "cube.json"),
+        "slices": os.path.join(cube_dir, "slices"),
+        "counts": os.path.join(cube_dir, "counts"),
+    }
+
+
+def slice_paths(cube_dir, key):
+    folder = cube_paths(cube_dir)["slices"]
+    return {
+        "prob": os.path.join(folder, f"{key}_prob.npy"),
+        "mask": os.path.join(folder, f"{key}_mask.npy"),
+    }
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def raster_grid(src):
+    return {
+        "crs": src.crs.to_wkt() if src.crs else None,
+        "transform": list(src.transform)[:6],
+        "width": src.width,
+        "height": src.height,
+    }
+
+
+def check_grid(cube_grid, grid, path):
+    same = (
+        (grid["width"], grid["height"]) == (cube_grid["width"], cube_grid["height"])
+        and grid["crs"] == cube_grid["crs"]
+        and np.allclose(grid["transform"], cube_grid["transform"])
+    )
+    if not same:
+        raise ValueError(f"{path} is not on the cube grid; align it first")
+
+
+def load_cube(cube_dir):
+    path = cube_paths(cube_dir)["index"]
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_cube(cube, cube_dir):
+    atomic_write_json(cube, cube_paths(cube_dir)["index"])
+
+
+def create_cube(cube_dir, grid):
+    paths = cube_paths(cube_dir)
+    os.makedirs(paths["slices"], exist_ok=True)
+    os.makedirs(paths["counts"], exist_ok=True)
+
+    shape = (grid["height"], grid["width"])
+    for name in COUNT_NAMES:
+        counts = np.lib.format.open_memmap(
+            os.path.join(paths["counts"], f"{name}.npy"), mode="w+",
+            dtype=COUNT_DTYPES.get(name, np.uint16), shape=shape,
+        )
+        del counts
+
+    cube = {"grid": grid, "chunk_rows": CHUNK_ROWS, "scenes": {}}
+    save_cube(cube, cube_dir)
+    return cube
+
+
+def open_counts(cube_dir, mode="r+"):
+    folder = cube_paths(cube_dir)["counts"]
+    return {
+        name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mode)
+        for name in COUNT_NAMES
+    }
+
+
+def row_chunks(height, chunk_rows=CHUNK_ROWS):
+    return [(r0, min(r0 + chunk_rows, height)) for r0 in range(0, height, chunk_rows)]
+
+
+def run_chunks(func, chunks, n_workers=None):
+    # NumPy and GDAL release the GIL, so threads share the memory maps
+    n_workers = n_workers or CUBE_WORKERS or os.cpu_count() or 1
+    if n_workers <= 1:
+        return [func(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(func, chunks))
+
+# Slices
+
+def _read_prob(src, band, window):
+    # Script 8 float outputs carry the Landsat nodata value 0, which is a
+    # valid probability there, so only quantized bands use nodata; float
+    # bands mark missing pixels with NaN
+    if np.issubdtype(np.dtype(src.dtypes[band - 1]), np.integer):
+        return scaled_read(src, band, window)
+    return src.read(band, window=window).astype(np.float32)
+
+
+def write_slices(cube_dir, key, prob_path, mask_path=None, prob_band=1, mask_band=1,
+                 n_workers=None):
+    cube_grid = load_cube(cube_dir)["grid"]
+    height, width = cube_grid["height"], cube_grid["width"]
+    paths = slice_paths(cube_dir, key)
+    tmp = {kind: path + ".tmp" for kind, path in paths.items()}
+
+    prob_out = np.lib.format.open_memmap(tmp["prob"], mode="w+", dtype=np.uint8,
+                                         shape=(height, width))
+    mask_out = np.lib.format.open_memmap(tmp["mask"], mode="w+", dtype=np.uint8,
+                                         shape=(height, width))
+
+    def work(rows):
+        r0, r1 = rows
+        window = Window(0, r0, width, r1 - r0)
+        with rasterio.open(prob_path) as src:
+            prob = _read_prob(src, prob_band, window)
+        valid = ~np.isnan(prob)
+
+        if mask_path is None:
+            water = prob >= WATER_THRESHOLD
+        else:
+            with rasterio.open(mask_path) as src:
+                mask = src.read(mask_band, window=window)
+                # Inherited nodata of 0 or 1 would hide real mask values
+                if src.nodata is not None and src.nodata not in (0, 1):
+                    valid &= mask != src.nodata
+            water = mask > 0
+
+        codes = np.rint(np.clip(np.nan_to_num(prob), 0, 1) * PROB_LEVELS).astype(np.uint8)
+        codes[~valid] = NODATA
+        water = water.astype(np.uint8)
+        water[~valid] = NODATA
+
+        prob_out[r0:r1] = codes
+        mask_out[r0:r1] = water
+        return codes.nbytes + water.nbytes
+
+    with span("slices", period=key) as s:
+        written = run_chunks(work, row_chunks(height), n_workers)
+        s.add(bytes_written=sum(written), pixels=height * width)
+
+    prob_out.flush()
+    mask_out.flush()
+    del prob_out, mask_out
+    for kind, path in paths.items():
+        os.replace(tmp[kind], path)
+
+
+def open_slice(cube_dir, key, kind="mask"):
+    return np.load(slice_paths(cube_dir, key)[kind], mmap_mode="r")
+
+# Running counts
+
+def _bump(counts, name, r0, r1, values, sign):
+    block = counts[name][r0:r1]
+    if sign > 0:
+        block += values.astype(block.dtype)
+    else:
+        block -= values.astype(block.dtype)
+
+
+def apply_period(cube_dir, cube, key, sign=1, n_workers=None):
+    """Add (sign=1) or remove (sign=-1) one period's contribution to the counts."""
+    entry = cube["scenes"][key]
+    regime, year = entry["regime"], entry["year"]
+    other = period_key("WF" if regime == "BF" else "BF", year)
+    # A BF/WF pair is counted once, when its second period is present
+    paired = other in cube["scenes"]
+
+    counts = open_counts(cube_dir)
+    prob = open_slice(cube_dir, key, "prob")
+    mask = open_slice(cube_dir, key, "mask")
+    other_mask = open_slice(cube_dir, other, "mask") if paired else None
+
+    def work(rows):
+        r0, r1 = rows
+        m = np.asarray(mask[r0:r1])
+        valid = m != NODATA
+        water = m == 1
+
+        _bump(counts, "observations", r0, r1, valid, sign)
+        _bump(counts, "water", r0, r1, water, sign)
+        _bump(counts, "prob_sum", r0, r1, np.where(valid, prob[r0:r1], 0), sign)
+        _bump(counts, f"obs_{regime}", r0, r1, valid, sign)
+        _bump(counts, f"water_{regime}", r0, r1, water, sign)
+
+        if paired:
+            o = np.asarray(other_mask[r0:r1])
+            bf, wf = (m, o) if regime == "BF" else (o, m)
+            both = valid & (o != NODATA)
+            _bump(counts, "pairs", r0, r1, both, sign)
+            _bump(counts, "gain", r0, r1, both & (bf == 0) & (wf == 1), sign)
+            _bump(counts, "loss", r0, r1, both & (bf == 1) & (wf == 0), sign)
+
+    run_chunks(work, row_chunks(cube["grid"]["height"], cube["chunk_rows"]), n_workers)
+    for array in counts.values():
+        array.flush()
+
+
+def rebuild_counts(cube_dir, n_workers=None):
+    """Recompute the counts from the stored slices."""
+    cube = load_cube(cube_dir)
+    for array in open_counts(cube_dir).values():
+        array[:] = 0
+        array.flush()
+
+    scenes = cube["scenes"]
+    cube["scenes"] = {}
+    for key in sorted(scenes, key=lambda k: period_order(scenes[k])):
+        cube["scenes"][key] = scenes[key]
+        apply_period(cube_dir, cube, key, 1, n_workers)
+
+    cube.pop("pending", None)
+    save_cube(cube, cube_dir)
+    return cube
+
+
+def _recover(cube_dir, cube, n_workers=None):
+    # An update was interrupted: its period's slices and counts are
+    # suspect, so drop it and rebuild the counts from the rest
+    key = cube.pop("pending")
+    print(f"Recovering cube after an interrupted update of {key}")
+    cube["scenes"].pop(key, None)
+    save_cube(cube, cube_dir)
+    return rebuild_counts(cube_dir, n_workers)
+
+# Updates
+
+def add_scene(cube_dir, prob_path, mask_path=None, regime=None, year=None,
+              prob_band=1, mask_band=1, n_workers=None):
+    """Add or replace one period; returns False if it is already up to date."""
+    if regime is None or year is None:
+        regime, year = scene_period(os.path.basename(prob_path))
+    key = period_key(regime, str(year))
+
+    with rasterio.open(prob_path) as src:
+        grid = raster_grid(src)
+
+    cube = load_cube(cube_dir)
+    if cube is None:
+        cube = create_cube(cube_dir, grid)
+    elif cube.get("pending"):
+        cube = _recover(cube_dir, cube, n_workers)
+    check_grid(cube["grid"], grid, prob_path)
+
+    source = {
+        "prob": prob_path, "prob_signature": file_signature(prob_path),
+        "mask": mask_path,
+        "mask_signature": file_signature(mask_path) if mask_path else None,
+    }
+    entry = cube["scenes"].get(key)
+    if entry and entry["source"] == source:
+        return False
+
+    with span("cube_update", period=key, replace=entry is not None):
+        cube["pending"] = key
+        save_cube(cube, cube_dir)
+
+        if entry:
+            apply_period(cube_dir, cube, key, -1, n_workers)
+
+        write_slices(cube_dir, key, prob_path, mask_path, prob_band, mask_band, n_workers)
+        cube["scenes"][key] = {
+            "regime": regime, "year": str(year), "source": source,
+            "added": time.time(),
+        }
+        apply_period(cube_dir, cube, key, 1, n_workers)
+
+        del cube["pending"]
+        save_cube(cube, cube_dir)
+    return True
+
+
+def remove_scene(cube_dir, key, n_workers=None):
+    cube = load_cube(cube_dir)
+    if cube.get("pending"):
+        cube = _recover(cube_dir, cube, n_workers)
+    if key not in cube["scenes"]:
+        return False
+
+    cube["pending"] = key
+    save_cube(cube, cube_dir)
+    apply_period(cube_dir, cube, key, -1, n_workers)
+
+    del cube["scenes"][key]
+    del cube["pending"]
+    save_cube(cube, cube_dir)
+    for path in slice_paths(cube_dir, key).values():
+        os.remove(path)
+    return True
+
+
+def read_stack(cube_dir, kind="prob", window=None):
+    """(period keys, T x rows x cols float32) in time order; NaN is no data."""
+    cube = load_cube(cube_dir)
+    keys = sorted(cube["scenes"], key=lambda k: period_order(cube["scenes"][k]))
+    if window is None:
+        rows = slice(0, cube["grid"]["height"])
+        cols = slice(0, cube["grid"]["width"])
+    else:
+        (r0, r1), (c0, c1) = window.toranges()
+        rows, cols = slice(r0, r1), slice(c0, c1)
+
+    stack = np.empty((len(keys), rows.stop - rows.start, cols.stop - cols.start),
+                     dtype=np.float32)
+    for t, key in enumerate(keys):
+        codes = open_slice(cube_dir, key, kind)[rows, cols]
+        layer = codes.astype(np.float32)
+        if kind == "prob":
+            layer /= PROB_LEVELS
+        layer[codes == NODATA] = np.nan
+        stack[t] = layer
+    return keys, stack
+
+# Recurrence products
+
+def recurrence_block(counts):
+    """PRODUCT_BANDS x rows x cols float32 from one chunk of the counts."""
+    c = {name: np.asarray(array, dtype=np.float32) for name, array in counts.items()}
+    observed = c["observations"] > 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frequency = c["water"] / c["observations"]
+        freq_bf = c["water_BF"] / c["obs_BF"]
+        freq_wf = c["water_WF"] / c["obs_WF"]
+        mean_prob = c["prob_sum"] / (c["observations"] * PROB_LEVELS)
+        gain = c["gain"] / c["pairs"]
+        loss = c["loss"] / c["pairs"]
+
+    water_class = np.where(
+        frequency >= PERMANENT_FREQUENCY, 2, np.where(frequency > 0, 1, 0)
+    ).astype(np.float32)
+    water_class[~observed] = np.nan
+
+    # Days under water per year; a regime without observations takes the
+    # overall frequency
+    hydroperiod = (
+        np.where(c["obs_BF"] > 0, freq_bf, frequency) * REGIME_DAYS["BF"]
+        + np.where(c["obs_WF"] > 0, freq_wf, frequency) * REGIME_DAYS["WF"]
+    )
+
+    return np.stack([
+        frequency, freq_bf, freq_wf, mean_prob, water_class, gain, loss,
+        hydroperiod, c["observations"],
+    ]).astype(np.float32, copy=False)
+
+
+def write_products(cube_dir, out_path=None, n_workers=None):
+    cube = load_cube(cube_dir)
+    if cube.get("pending"):
+        cube = _recover(cube_dir, cube, n_workers)
+    out_path = out_path or os.path.join(cube_dir, PRODUCTS_NAME)
+    grid = cube["grid"]
+    height, width = grid["height"], grid["width"]
+
+    profile = dict(
+        driver="GTiff", height=height, width=width, count=len(PRODUCT_BANDS),
+        dtype="float32", crs=grid["crs"], transform=rasterio.Affine(*grid["transform"]),
+        nodata=np.nan, compress="deflate", predictor=3,
+    )
+    if width >= 256 and height >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    counts = open_counts(cube_dir, mode="r")
+    chunks = row_chunks(height, cube["chunk_rows"])
+
+    def work(rows):
+        r0, r1 = rows
+        return recurrence_block({name: array[r0:r1] for name, array in counts.items()})
+
+    with span("products", periods=len(cube["scenes"])) as s, \
+            rasterio.open(out_path, "w", **profile) as dst:
+        for i, name in enumerate(PRODUCT_BANDS, start=1):
+            dst.set_band_description(i, name)
+
+        # Blocks are computed in parallel, one batch per worker count at a
+        # time so only a few are held in memory, and written in order
+        n_workers = n_workers or CUBE_WORKERS or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for start in range(0, len(chunks), n_workers):
+                batch = chunks[start:start + n_workers]
+                for (r0, r1), block in zip(batch, pool.map(work, batch)):
+                    dst.write(block, window=Window(0, r0, width, r1 - r0))
+                    s.add(bytes_written=block.nbytes, pixels=width * (r1 - r0))
+    return out_path
+
+
+def ensemble_scenes(folder=ENSEMBLE_DIR):
+    """(probability path, mask path or None) for every script 8 output."""
+    scenes = []
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(PROB_SUFFIX):
+            continue
+        mask = os.path.join(folder, name.replace(PROB_SUFFIX, MASK_SUFFIX))
+        scenes.append((os.path.join(folder, name), mask if os.path.exists(mask) else None))
+    return scenes
+
+
+def main():
+    updated = 0
+    for prob_path, mask_path in ensemble_scenes(ENSEMBLE_DIR):
+        try:
+            if add_scene(CUBE_DIR, prob_path, mask_path):
+                updated += 1
+                print(f"Added {os.path.basename(prob_path)}")
+        except ValueError as e:
+            print(f"Skipping {os.path.basename(prob_path)}: {e}")
+
+    cube = load_cube(CUBE_DIR)
+    if cube is None:
+        print(f"No ensemble rasters found in {ENSEMBLE_DIR}")
+        return
+    print(f"{updated} period(s) updated, {len(cube['scenes'])} in the cube")
+    print(f"Saved {write_products(CUBE_DIR)}")
+
+
+if __name__ == "__main__":
+    main()
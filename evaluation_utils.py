@@ -0,0 +1,270 @@
+#evaluation_utils.py
+"""
+Confusion-matrix based evaluation helpers shared by the evaluation scripts.
+
+The confusion matrix is counted once in a fused, chunked bincount pass and
+every metric is derived from it. Threshold sweeps are built from one
+histogram of reference values per predicted class, so evaluating thousands
+of reference thresholds costs about one pass over the pixels instead of one
+pass per threshold.
+"""
+
+import numpy as np
+
+EVAL_CHUNK_PIXELS = 1 << 20
+# Largest label range counted with a dense bincount
+MAX_DENSE_LABELS = 256
+
+
+# Metrics from a confusion matrix (rows = reference, cols = prediction)
+# Follows sklearn: only labels present in either reference or prediction are
+# scored, and zero divisions count as 0 (zero_division=0)
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    out = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def present_labels(cm):
+    cm = np.asarray(cm)
+    return (cm.sum(axis=0) + cm.sum(axis=1)) > 0
+
+
+def metrics_from_confusion(cm, labels=None, average="macro", positive_label=1):
+    """Accuracy, precision, recall, F1 and IoU as a JSON-serializable dict."""
+    cm = np.asarray(cm)
+    labels = np.arange(cm.shape[0]) if labels is None else np.asarray(labels)
+    present = present_labels(cm)
+    cm = cm[present][:, present]
+    labels = labels[present]
+
+    tp = np.diag(cm)
+    pred_sum = cm.sum(axis=0)
+    true_sum = cm.sum(axis=1)
+    total = cm.sum()
+
+    if average == "binary":
+        # Scores of the positive label only; 0 when it never occurs
+        pos = np.flatnonzero(labels == positive_label)
+        tp, pred_sum, true_sum = (
+            (a[pos] if pos.size else np.zeros(1, dtype=np.int64))
+            for a in (tp, pred_sum, true_sum)
+        )
+    elif average != "macro":
+        raise ValueError(f"Unsupported average: {average}")
+
+    precision = _safe_divide(tp, pred_sum)
+    recall = _safe_divide(tp, true_sum)
+    f1 = _safe_divide(2.0 * tp, true_sum + pred_sum)
+    iou = _safe_divide(tp, true_sum + pred_sum - tp)
+
+    return {
+        "Accuracy": float(np.trace(cm) / total) if total else 0.0,
+        "Precision": float(np.mean(precision)) if precision.size else 0.0,
+        "Recall": float(np.mean(recall)) if recall.size else 0.0,
+        "F1": float(np.mean(f1)) if f1.size else 0.0,
+        "IoU": float(np.mean(iou)) if iou.size else 0.0,
+        "Confusion": cm.tolist(),
+        "Labels": labels.tolist(),
+    }
+
+# Fused confusion matrix
+# Invalid pixels (NaN or nodata in either map) go to an overflow bin that is
+# dropped, so no masked or flattened copies of the full rasters are made
+
+def _valid_chunk(arr, nodata):
+    valid = np.ones(arr.shape, dtype=bool)
+    if np.issubdtype(arr.dtype, np.floating):
+        valid &= ~np.isnan(arr)
+    if nodata is not None:
+        valid &= arr != nodata
+    return valid
+
+
+def confusion_bincount(ref, pred, nodata=-9999, chunk_pixels=None):
+    """Confusion matrix (rows = reference) over the labels present in either map."""
+    chunk_pixels = chunk_pixels or EVAL_CHUNK_PIXELS
+    ref = np.asarray(ref)
+    pred = np.asarray(pred)
+    if ref.shape != pred.shape:
+        raise ValueError(
+            f"Reference shape {ref.shape} does not match prediction {pred.shape}"
+        )
+
+    ref_flat = ref.reshape(-1)
+    pred_flat = pred.reshape(-1)
+    lo = hi = None
+    cm = np.zeros((0, 0), dtype=np.int64)
+
+    for start in range(0, ref_flat.size, chunk_pixels):
+        r = ref_flat[start:start + chunk_pixels]
+        p = pred_flat[start:start + chunk_pixels]
+        valid = _valid_chunk(r, nodata) & _valid_chunk(p, nodata)
+        if not valid.any():
+            continue
+
+        # Same truncation as .astype(int) on the masked values
+        ri = np.where(valid, r, 0).astype(np.int64)
+        pi = np.where(valid, p, 0).astype(np.int64)
+
+        c_lo = int(min(ri.min(), pi.min()))
+        c_hi = int(max(ri.max(), pi.max()))
+        if lo is None:
+            lo, hi = c_lo, c_lo - 1
+        new_lo, new_hi = min(lo, c_lo), max(hi, c_hi)
+        n = new_hi - new_lo + 1
+        if n > MAX_DENSE_LABELS:
+            raise ValueError(
+                f"Label range {new_lo}..{new_hi} is too wide for a class map"
+            )
+        if (new_lo, new_hi) != (lo, hi):
+            grown = np.zeros((n, n), dtype=np.int64)
+            off = lo - new_lo
+            grown[off:off + cm.shape[0], off:off + cm.shape[1]] = cm
+            cm, lo, hi = grown, new_lo, new_hi
+
+        codes = (ri - lo) * n + (pi - lo)
+        codes[~valid] = n * n
+        cm += np.bincount(codes, minlength=n * n + 1)[:n * n].reshape(n, n)
+
+    if lo is None:
+        return np.array([], dtype=np.int64), cm
+
+    labels = np.arange(lo, hi + 1)
+    present = present_labels(cm)
+    return labels[present], cm[present][:, present]
+
+
+def evaluate_confusion(pred, ref, average="macro", nodata=-9999):
+    labels, cm = confusion_bincount(ref, pred, nodata=nodata)
+    return metrics_from_confusion(cm, labels, average=average)
+
+# Per-class reference histograms
+
+def valid_prediction_mask(pred, nodata=-9999):
+    pred = np.asarray(pred)
+    valid = pred != nodata
+    if np.issubdtype(pred.dtype, np.floating):
+        valid &= ~np.isnan(pred)
+    return valid
+
+
+def class_histograms(pred, ref_raw, nodata=-9999):
+    """Histogram of raw reference values for every predicted class."""
+    pred = np.asarray(pred)
+    ref_raw = np.asarray(ref_raw)
+    if pred.shape != ref_raw.shape:
+        raise ValueError(
+            f"Prediction shape {pred.shape} does not match reference {ref_raw.shape}"
+        )
+
+    valid = valid_prediction_mask(pred, nodata)
+    pred_int = pred[valid].astype(int)
+    ref_vals = ref_raw[valid]
+
+    # Sort once by (class, value); each class is then a contiguous run
+    order = np.lexsort((ref_vals, pred_int))
+    pred_sorted = pred_int[order]
+    ref_sorted = ref_vals[order]
+    classes, starts, totals = np.unique(
+        pred_sorted, return_index=True, return_counts=True
+    )
+
+    histograms = {}
+    for c, start, total in zip(classes, starts, totals):
+        vals = ref_sorted[start:start + total]
+        if np.issubdtype(vals.dtype, np.floating):
+            # NaN sorts last and is never above a threshold
+            vals = vals[:np.searchsorted(vals, np.nan, side="left")]
+        values, counts = np.unique(vals, return_counts=True)
+        histograms[int(c)] = {
+            "values": values,
+            "cumulative": np.concatenate([[0], np.cumsum(counts)]),
+            "total": int(total),
+        }
+
+    return {"classes": [int(c) for c in classes], "histograms": histograms}
+
+# Threshold sweep
+# Reference is binarized as ref_raw > threshold, like threshold_array in
+# script 12, so results at any threshold match the per-threshold evaluation
+
+def sweep_confusions(hist, thresholds):
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    labels = sorted(set(hist["classes"]) | {0, 1})
+    index = {label: i for i, label in enumerate(labels)}
+
+    cms = np.zeros((thresholds.size, len(labels), len(labels)), dtype=np.int64)
+
+    for c in hist["classes"]:
+        h = hist["histograms"][c]
+        values = h["values"]
+
+        # Compare in the dtype NumPy uses for `ref_raw > thr`
+        cmp_dtype = np.result_type(values, 0.0)
+        th = thresholds.astype(cmp_dtype)
+        not_above = h["cumulative"][np.searchsorted(values, th, side="right")]
+        above = h["cumulative"][-1] - not_above
+
+        cms[:, index[1], index[c]] = above
+        cms[:, index[0], index[c]] = h["total"] - above
+
+    return np.array(labels), cms
+
+
+def threshold_sweep(hist, thresholds, positive_label=1):
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    labels, cms = sweep_confusions(hist, thresholds)
+    pos = int(np.searchsorted(labels, positive_label))
+    neg = int(np.searchsorted(labels, 0))
+
+    metrics = [metrics_from_confusion(cm, labels) for cm in cms]
+
+    # Binary rates for ROC / PR curves (reference positive = above threshold)
+    tp = cms[:, pos, pos]
+    fn = cms[:, pos, :].sum(axis=1) - tp
+    fp = cms[:, neg, pos]
+    tn = cms[:, neg, :].sum(axis=1) - fp
+
+    return {
+        "thresholds": thresholds,
+        "labels": labels,
+        "confusion": cms,
+        "metrics": metrics,
+        "tpr": _safe_divide(tp, tp + fn),
+        "fpr": _safe_divide(fp, fp + tn),
+        "precision": _safe_divide(tp, tp + fp),
+    }
+
+
+def optimal_threshold(sweep, metric="F1"):
+    """Threshold maximizing a macro metric, or Youden's J with metric="youden"."""
+    if metric == "youden":
+        scores = sweep["tpr"] - sweep["fpr"]
+    else:
+        scores = np.array([m[metric] for m in sweep["metrics"]])
+    best = int(np.argmax(scores))
+    return float(sweep["thresholds"][best]), float(scores[best])
+
+
+def sweep_summary(sweep, metric="F1"):
+    best_thr, best_score = optimal_threshold(sweep, metric)
+    youden_thr, youden_score = optimal_threshold(sweep, "youden")
+
+    return {
+        "thresholds": sweep["thresholds"].tolist(),
+        "labels": sweep["labels"].tolist(),
+        "metrics": {
+            key: [m[key] for m in sweep["metrics"]]
+            for key in ["Accuracy", "Precision", "Recall", "F1", "IoU"]
+        },
+        "roc": {"fpr": sweep["fpr"].tolist(), "tpr": sweep["tpr"].tolist()},
+        "pr": {"recall": sweep["tpr"].tolist(), "precision": sweep["precision"].tolist()},
+        "optimal": {
+            metric: {"threshold": best_thr, "score": best_score},
+            "youden": {"threshold": youden_thr, "score": youden_score},
+        },
+    }
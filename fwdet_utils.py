@@ -0,0 +1,247 @@
+#fwdet_utils.py
+"""
+Local port of the FwDET flood depth model in 17_FlooddepthwithFIA.txt.
+
+Same steps as computeFwDET in the GEE script:
+  1. DEM outlier fill: pixels with a modified z-score above 3.5 against
+     the 3x3 focal median take the median of their 8 neighbours.
+  2. Boundary elevation: every flooded pixel takes the elevation of the
+     nearest dry pixel. The GEE script gets this from three cumulativeCost
+     runs ((cost2 - cost0) / (cost1 - cost0) is the source elevation of the
+     least-cost path); here it is one Euclidean nearest-feature transform.
+  3. Depth = boundary elevation - filled DEM, smoothed with a 7x7 boxcar
+     over flooded pixels, negatives set to 0.
+
+Depth is reported over flooded pixels (mask value 1), as in FwDET.
+Pixels farther than MAX_DISTANCE from any dry pixel are left empty, as
+the GEE cost runs stop at 5000 m. Large DEMs are processed in blocks
+with a halo wide enough that the result does not depend on the block
+size.
+"""
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from scipy.ndimage import distance_transform_edt, median_filter, uniform_filter
+from raster_utils import block_windows, read_flood
+from trace_utils import span
+
+# Flood extents written by script 16 and the DEMs of the GEE script
+MASK_DIR = r"D:\FloodOutputs\UResNet_vs_MNDWI"
+MASK_SUFFIXES = ["_UResNetMNDWIFExt.tif", "_Sen2FextGTruth.tif"]
+DEM_PATHS = {
+    "LKJ": r"D:\FloodOutputs\DEM\ExtrFilledLKJDEM.tif",
+    "GRY": r"D:\FloodOutputs\DEM\ExtrFilledGRYDEM.tif",
+}
+OUTPUT_DIR = r"D:\FloodOutputs\FwDET"
+
+OUTLIER_Z = 3.5
+MAX_DISTANCE = 5000    # DEM map units (metres for UTM), the GEE "push"
+BUFFER = 1000          # around the flood mask bounds, as in the GEE script
+SMOOTH_RADIUS = 3      # boxcar radius in pixels
+
+BLOCK_SIZE = 2048
+FWDET_WORKERS = 1
+
+# 3x3 neighbourhood without its centre (kernelw in the GEE script)
+RING = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=bool)
+
+# Array steps
+
+def fill_dem_outliers(dem):
+    med = median_filter(dem, size=3, mode="nearest")
+    med_ring = median_filter(dem, footprint=RING, mode="nearest")
+    diff = dem - med
+    mad = median_filter(np.abs(diff), size=3, mode="nearest")
+
+    # A zero median deviation is a masked division in GEE: no replacement
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mz = 0.6745 * diff / mad
+    return np.where((mad > 0) & (mz > OUTLIER_Z), med_ring, dem)
+
+
+def boundary_elevation(flood, filled, sources, pixel_size, max_distance=None):
+    """Elevation of the nearest source (dry) pixel, NaN beyond max_distance."""
+    if not sources.any():
+        return np.full(flood.shape, np.nan, dtype=np.float32)
+
+    distance, (rows, cols) = distance_transform_edt(
+        ~sources, sampling=pixel_size, return_indices=True
+    )
+    surface = filled[rows, cols].astype(np.float32)
+    if max_distance:
+        surface[distance > max_distance] = np.nan
+    return surface
+
+
+def smooth_depth(depth, valid, radius=SMOOTH_RADIUS):
+    # Boxcar mean over valid pixels only, so dry land never leaks in
+    size = 2 * radius + 1
+    weight = uniform_filter(valid.astype(np.float32), size, mode="constant")
+    total = uniform_filter(np.where(valid, depth, 0).astype(np.float32), size, mode="constant")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(valid, total / weight, np.nan).astype(np.float32)
+
+
+def fwdet_depth(flood, dem, pixel_size=(1.0, 1.0), max_distance=MAX_DISTANCE):
+    """Flood depth (float32, NaN outside the flood) from a boolean mask and a DEM.
+
+    pixel_size is (row, column) spacing in the units of max_distance. DEM
+    nodata must be NaN.
+    """
+    dem = dem.astype(np.float32)
+    dem_valid = ~np.isnan(dem)
+    if not dem_valid.all():
+        if not dem_valid.any():
+            return np.full(dem.shape, np.nan, dtype=np.float32)
+        # Nearest valid elevation, only so the focal medians see no NaN
+        rows, cols = distance_transform_edt(~dem_valid, return_distances=False,
+                                            return_indices=True)
+        dem = dem[rows, cols]
+
+    filled = fill_dem_outliers(dem)
+    sources = ~flood & dem_valid
+    depth = boundary_elevation(flood, filled, sources, pixel_size, max_distance) - filled
+
+    valid = flood & dem_valid & ~np.isnan(depth)
+    depth = smooth_depth(depth, valid)
+    depth[depth < 0] = 0
+    return depth
+
+# Rasters
+
+def block_halo(pixel_size, max_distance=MAX_DISTANCE):
+    # Nearest dry pixel, plus the smoothing window, plus the two focal
+    # median passes behind the boundary elevation
+    if not max_distance:
+        return None
+    return math.ceil(max_distance / min(pixel_size)) + SMOOTH_RADIUS + 3
+
+
+def processing_window(dem_src, mask_src, buffer=BUFFER):
+    left, bottom, right, top = transform_bounds(mask_src.crs, dem_src.crs, *mask_src.bounds)
+    window = from_bounds(
+        left - buffer, bottom - buffer, right + buffer, top + buffer,
+        transform=dem_src.transform,
+    ).round_offsets().round_lengths()
+    return window.intersection(Window(0, 0, dem_src.width, dem_src.height))
+
+
+def read_dem(src, window):
+    dem = src.read(1, window=window).astype(np.float32)
+    if src.nodata is not None:
+        dem[dem == src.nodata] = np.nan
+    return dem
+
+
+def depth_output_path(mask_path, out_dir=OUTPUT_DIR):
+    name = os.path.basename(mask_path).replace(".tif", "_FwDET_depth.tif")
+    return os.path.join(out_dir, name)
+
+
+def fwdet_raster(mask_path, dem_path, out_path, block_size=BLOCK_SIZE,
+                 max_distance=MAX_DISTANCE, n_workers=None):
+    """Write the FwDET depth of a flood mask raster on the DEM grid."""
+    n_workers = n_workers or FWDET_WORKERS
+
+    with rasterio.open(dem_path) as dem_src, rasterio.open(mask_path) as mask_src:
+        area = processing_window(dem_src, mask_src)
+        transform = dem_src.window_transform(area)
+        width, height = int(area.width), int(area.height)
+        res_x, res_y = dem_src.res
+        dem_grid = dict(crs=dem_src.crs, transform=dem_src.transform,
+                        width=dem_src.width, height=dem_src.height)
+        same_grid = (mask_src.crs, mask_src.transform, mask_src.shape) == (
+            dem_src.crs, dem_src.transform, dem_src.shape
+        )
+
+    pixel_size = (res_y, res_x)
+    halo = block_halo(pixel_size, max_distance)
+    if halo is None:
+        # Without a distance limit every block would need the whole raster
+        block_size = max(width, height)
+        halo = 0
+
+    row_off, col_off = int(area.row_off), int(area.col_off)
+    blocks = list(block_windows(width, height, block_size))
+
+    def work(block):
+        # Block plus halo, clipped to the processing area
+        r0 = max(int(block.row_off) - halo, 0)
+        c0 = max(int(block.col_off) - halo, 0)
+        r1 = min(int(block.row_off + block.height) + halo, height)
+        c1 = min(int(block.col_off + block.width) + halo, width)
+        window = Window(col_off + c0, row_off + r0, c1 - c0, r1 - r0)
+
+        with rasterio.open(dem_path) as dem_src:
+            dem = read_dem(dem_src, window)
+        with rasterio.open(mask_path) as mask_src:
+            if same_grid:
+                flood = read_flood(mask_src, window)
+            else:
+                # Mask resampled onto the DEM grid, like floodImg.reproject
+                with WarpedVRT(mask_src, resampling=Resampling.nearest, **dem_grid) as vrt:
+                    flood = read_flood(vrt, window)
+
+        depth = fwdet_depth(flood, dem, pixel_size, max_distance)
+        top, left = int(block.row_off) - r0, int(block.col_off) - c0
+        return depth[top:top + int(block.height), left:left + int(block.width)]
+
+    profile = dict(
+        driver="GTiff", height=height, width=width, count=1, dtype="float32",
+        crs=dem_grid["crs"], transform=transform, nodata=np.nan,
+        compress="deflate", predictor=3,
+    )
+    if width >= 256 and height >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    with span("fwdet", mask=os.path.basename(mask_path), blocks=len(blocks)) as s, \
+            rasterio.open(out_path, "w", **profile) as dst, \
+            ThreadPoolExecutor(max_workers=n_workers) as pool:
+        dst.set_band_description(1, "depth")
+        for start in range(0, len(blocks), n_workers):
+            batch = blocks[start:start + n_workers]
+            for block, depth in zip(batch, pool.map(work, batch)):
+                dst.write(depth, 1, window=block)
+                s.add(bytes_written=depth.nbytes, pixels=depth.size)
+    return out_path
+
+
+def site_dem(name):
+    for site, dem_path in DEM_PATHS.items():
+        if site.lower() in name.lower():
+            return dem_path
+    return None
+
+
+def main():
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    for name in sorted(os.listdir(MASK_DIR)):
+        if not any(name.endswith(suffix) for suffix in MASK_SUFFIXES):
+            continue
+        dem_path = site_dem(name)
+        if dem_path is None:
+            print(f"No DEM for {name}, skipping.")
+            continue
+
+        mask_path = os.path.join(MASK_DIR, name)
+        out_path = fwdet_raster(mask_path, dem_path, depth_output_path(mask_path))
+        with rasterio.open(out_path) as src:
+            depth = src.read(1)
+        flooded = ~np.isnan(depth)
+        if flooded.any():
+            print(f"{name}: mean depth {depth[flooded].mean():.2f} m, "
+                  f"max {depth[flooded].max():.2f} m")
+        print(f"Saved {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#impact_utils.py
+"""
+Local flood impact assessment, the computeImpacts step of
+17_FlooddepthwithFIA.txt.
+
+Takes a flood depth raster (fwdet_utils output) or a 0/1 flood extent
+raster and reports per depth class:
+  - population: sum of a population count raster. Counts are resampled
+    onto the flood grid with area-weighted "sum" resampling, so totals hold
+    whatever the two resolutions and projections are.
+  - land cover: LULC pixel frequency histogram, on the LULC grid.
+  - buildings: footprints intersecting each class (a building counts in its
+    deepest class), or with their centroid in it.
+
+Rasters are read in windowed blocks. Footprints go into one STRtree, which
+each block queries with its flood shapes (or its bounds, for centroids),
+so buildings are never tested pairwise against the flood.
+"""
+
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import shapely
+from rasterio import features
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box, shape
+from raster_utils import block_windows, read_flood
+from trace_utils import span
+
+DEPTH_DIR = r"D:\FloodOutputs\FwDET"
+DEPTH_SUFFIX = "_FwDET_depth.tif"
+POP_PATH = r"D:\FloodOutputs\Impacts\GHS_POP_2023.tif"
+LULC_PATH = r"D:\FloodOutputs\Impacts\S2_LULC_Timeseries_10m.tif"
+BUILDINGS_PATH = r"D:\FloodOutputs\Impacts\MS_Buildings.gpkg"
+OUTPUT_DIR = r"D:\FloodOutputs\Impacts"
+
+# Depth class edges in metres: (0, 0.5], (0.5, 1], ..., and > the last edge.
+# Depth 0 is not flooded, as depthMask = depth.gt(0) in the GEE script
+DEPTH_BINS = [0, 0.5, 1.0, 2.0, 5.0]
+# "polygon" (footprint intersects the class) or "centroid"
+BUILDING_MODE = "polygon"
+BLOCK_SIZE = 2048
+
+# Esri Sentinel-2 10 m land cover classes
+LULC_NAMES = {
+    1: "Water", 2: "Trees", 4: "Flooded vegetation", 5: "Crops",
+    7: "Built area", 8: "Bare ground", 9: "Snow/ice", 10: "Clouds",
+    11: "Rangeland",
+}
+
+# Depth classes
+
+def class_labels(bins=DEPTH_BINS):
+    labels = [f"{lo:g}-{hi:g} m" for lo, hi in zip(bins[:-1], bins[1:])]
+    return labels + [f">{bins[-1]:g} m"]
+
+
+def is_depth(src):
+    return np.issubdtype(np.dtype(src.dtypes[0]), np.floating)
+
+
+def classify_depth(depth, bins=DEPTH_BINS):
+    """Class index per pixel, -1 where not flooded (depth <= 0 or NaN)."""
+    classes = np.digitize(depth, bins, right=True) - 1
+    classes[~(depth > bins[0])] = -1
+    return classes.astype(np.int16)
+
+
+def read_classes(src, window, bins=DEPTH_BINS):
+    if not is_depth(src):
+        # Extent rasters have a single "flooded" class
+        return np.where(read_flood(src, window), 0, -1).astype(np.int16)
+    depth = src.read(1, window=window).astype(np.float32)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        depth[depth == src.nodata] = np.nan
+    return classify_depth(depth, bins)
+
+
+def pixel_hectares(src):
+    if src.crs is None or not src.crs.is_projected:
+        return np.nan
+    return abs(src.transform.a * src.transform.e) / 10000
+
+# Rasters
+
+def flooded_area(flood_path, n_classes, bins=DEPTH_BINS):
+    pixels = np.zeros(n_classes, dtype=np.int64)
+    with rasterio.open(flood_path) as src:
+        for window in block_windows(src.width, src.height, BLOCK_SIZE):
+            classes = read_classes(src, window, bins)
+            pixels += np.bincount(classes[classes >= 0], minlength=n_classes)
+        return pixels, pixels * pixel_hectares(src)
+
+
+def population_by_class(flood_path, pop_path, n_classes, bins=DEPTH_BINS):
+    totals = np.zeros(n_classes, dtype=np.float64)
+    with rasterio.open(flood_path) as src, rasterio.open(pop_path) as pop_src, \
+            WarpedVRT(pop_src, crs=src.crs, transform=src.transform, width=src.width,
+                      height=src.height, resampling=Resampling.sum) as pop:
+        for window in block_windows(src.width, src.height, BLOCK_SIZE):
+            classes = read_classes(src, window, bins)
+            inside = classes >= 0
+            if not inside.any():
+                continue
+            values = pop.read(1, window=window).astype(np.float64)
+            if pop.nodata is not None:
+                values[values == pop.nodata] = 0
+            values[np.isnan(values)] = 0
+            totals += np.bincount(classes[inside], weights=values[inside], minlength=n_classes)
+    return totals
+
+
+def landcover_by_class(flood_path, lulc_path, labels, bins=DEPTH_BINS):
+    """Long table of (class, LULC code, pixels, hectares) on the LULC grid."""
+    counts = Counter()
+    with rasterio.open(lulc_path) as lulc, rasterio.open(flood_path) as src:
+        # Only the LULC blocks under the flood raster are read
+        bounds = transform_bounds(src.crs, lulc.crs, *src.bounds)
+        area = from_bounds(*bounds, transform=lulc.transform).round_offsets().round_lengths()
+        area = area.intersection(Window(0, 0, lulc.width, lulc.height))
+
+        with WarpedVRT(src, crs=lulc.crs, transform=lulc.transform, width=lulc.width,
+                       height=lulc.height, resampling=Resampling.nearest) as flood:
+            for window in block_windows(int(area.width), int(area.height), BLOCK_SIZE,
+                                        row_off=int(area.row_off), col_off=int(area.col_off)):
+                classes = read_classes(flood, window, bins)
+                inside = classes >= 0
+                if not inside.any():
+                    continue
+                codes = lulc.read(1, window=window)
+                if lulc.nodata is not None:
+                    inside &= codes != lulc.nodata
+                keys = classes[inside].astype(np.int64) << 32 | codes[inside].astype(np.int64)
+                values, n = np.unique(keys, return_counts=True)
+                counts.update(dict(zip(values.tolist(), n.tolist())))
+        hectares = pixel_hectares(lulc)
+
+    rows = []
+    for key, n in sorted(counts.items()):
+        cls, code = key >> 32, key & 0xFFFFFFFF
+        rows.append({
+            "depth_class": labels[cls], "lulc": code,
+            "lulc_name": LULC_NAMES.get(code, str(code)),
+            "pixels": n, "hectares": n * hectares,
+        })
+    return pd.DataFrame(rows, columns=["depth_class", "lulc", "lulc_name", "pixels", "hectares"])
+
+# Buildings
+
+def load_buildings(buildings_path, flood_path):
+    """Footprints within the flood raster bounds, in the raster CRS."""
+    with rasterio.open(flood_path) as src:
+        crs, bounds = src.crs, src.bounds
+    area = gpd.GeoSeries([box(*bounds)], crs=crs)
+    buildings = gpd.read_file(buildings_path, bbox=area)
+    return buildings.to_crs(crs).geometry.values
+
+
+def building_classes(flood_path, geoms, bins=DEPTH_BINS, mode=BUILDING_MODE):
+    """Deepest class per footprint, -1 for footprints outside the flood."""
+    geoms = np.asarray(geoms)
+    result = np.full(len(geoms), -1, dtype=np.int16)
+    if not len(geoms):
+        return result
+
+    tree = shapely.STRtree(geoms)
+    if mode == "centroid":
+        centroids = shapely.centroid(geoms)
+        xs, ys = shapely.get_x(centroids), shapely.get_y(centroids)
+    elif mode != "polygon":
+        raise ValueError(f"Unknown building mode: {mode}")
+
+    with rasterio.open(flood_path) as src:
+        for window in block_windows(src.width, src.height, BLOCK_SIZE):
+            classes = read_classes(src, window, bins)
+            if not (classes >= 0).any():
+                continue
+            transform = src.window_transform(window)
+
+            if mode == "polygon":
+                shapes = list(features.shapes(classes, mask=classes >= 0, transform=transform))
+                polygons = [shape(geom) for geom, _ in shapes]
+                values = np.array([value for _, value in shapes], dtype=np.int16)
+                shape_idx, building_idx = tree.query(polygons, predicate="intersects")
+                np.maximum.at(result, building_idx, values[shape_idx])
+            else:
+                # Candidates from the block bounds, then sampled at the centroid
+                idx = tree.query(box(*rasterio.windows.bounds(window, src.transform)))
+                rows, cols = rasterio.transform.rowcol(transform, xs[idx], ys[idx])
+                rows, cols = np.asarray(rows), np.asarray(cols)
+                inside = ((rows >= 0) & (rows < classes.shape[0])
+                          & (cols >= 0) & (cols < classes.shape[1]))
+                idx, rows, cols = idx[inside], rows[inside], cols[inside]
+                np.maximum.at(result, idx, classes[rows, cols])
+    return result
+
+# Report
+
+def assess_impacts(flood_path, pop_path=None, lulc_path=None, buildings_path=None,
+                   bins=DEPTH_BINS, building_mode=BUILDING_MODE):
+    """(per-class summary, LULC histogram) for one flood depth or extent raster."""
+    with rasterio.open(flood_path) as src:
+        labels = class_labels(bins) if is_depth(src) else ["flooded"]
+    n_classes = len(labels)
+
+    summary = pd.DataFrame({"depth_class": labels})
+    with span("impacts", flood=os.path.basename(flood_path)):
+        with span("area"):
+            summary["flooded_pixels"], summary["flooded_ha"] = flooded_area(
+                flood_path, n_classes, bins
+            )
+
+        if pop_path:
+            with span("population"):
+                summary["population"] = population_by_class(flood_path, pop_path, n_classes, bins)
+
+        landcover = None
+        if lulc_path:
+            with span("landcover"):
+                landcover = landcover_by_class(flood_path, lulc_path, labels, bins)
+
+        if buildings_path:
+            with span("buildings") as s:
+                geoms = load_buildings(buildings_path, flood_path)
+                classes = building_classes(flood_path, geoms, bins, building_mode)
+                summary["buildings"] = np.bincount(classes[classes >= 0], minlength=n_classes)
+                s.add(footprints=len(geoms))
+
+    total = {column: summary[column].sum() for column in summary.columns[1:]}
+    summary = pd.concat(
+        [summary, pd.DataFrame([dict(total, depth_class="total")])], ignore_index=True
+    )
+    return summary, landcover
+
+
+def main():
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    for name in sorted(os.listdir(DEPTH_DIR)):
+        if not name.endswith(DEPTH_SUFFIX):
+            continue
+        flood_path = os.path.join(DEPTH_DIR, name)
+        summary, landcover = assess_impacts(
+            flood_path, POP_PATH, LULC_PATH, BUILDINGS_PATH
+        )
+
+        base = name.replace(DEPTH_SUFFIX, "")
+        print(f"\nIMPACT SUMMARY: {base}")
+        print(summary.to_string(index=False))
+
+        summary.to_csv(os.path.join(OUTPUT_DIR, f"{base}_impacts.csv"), index=False)
+        if landcover is not None:
+            landcover.to_csv(os.path.join(OUTPUT_DIR, f"{base}_landcover.csv"), index=False)
+
+
+if __name__ == "__main__":
+    main()
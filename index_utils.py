@@ -0,0 +1,202 @@
+#index_utils.py
+"""
+Fused band math for water indices on Landsat SR stacks.
+
+Every index is one expression over named bands. compute_indices evaluates
+the selected set chunk by chunk: each chunk of the input bands is cast to
+float32 once, every index is computed from it and written into its
+preallocated output. Temporaries are chunk-sized (INDEX_CHUNK_PIXELS)
+instead of full-scene, so allocation stays flat whatever the scene size.
+With numexpr installed the expressions run fused in its virtual machine;
+otherwise the matching INDEX_FUNCTIONS run in plain NumPy on the chunk.
+
+Normalized differences are 0 where the denominator is 0, as compute_mndwi
+in script 8 always returned.
+"""
+
+import os
+import re
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from trace_utils import span
+
+folder_path = r"Final L"
+output_folder = r"SpectralIndices"
+
+# 1-based band of each name in the "Final L" SR stacks (Landsat 8/9 order)
+LANDSAT_BANDS = {"blue": 2, "green": 3, "red": 4, "nir": 5, "swir1": 6, "swir2": 7}
+
+INDEX_EXPRESSIONS = {
+    "MNDWI": "where(green + swir1 != 0, (green - swir1) / (green + swir1), 0)",
+    "NDWI": "where(green + nir != 0, (green - nir) / (green + nir), 0)",
+    # Feyisa et al. (2014), defined on surface reflectance
+    "AWEI_nsh": "4 * (green - swir1) - (0.25 * nir + 2.75 * swir2)",
+    "AWEI_sh": "blue + 2.5 * green - 1.5 * (nir + swir1) - 0.25 * swir2",
+}
+
+
+def normalized_difference(a, b):
+    total = a + b
+    return np.where(total != 0, (a - b) / total, 0)
+
+
+# NumPy form of each INDEX_EXPRESSIONS entry, over a dict of band chunks
+INDEX_FUNCTIONS = {
+    "MNDWI": lambda b: normalized_difference(b["green"], b["swir1"]),
+    "NDWI": lambda b: normalized_difference(b["green"], b["nir"]),
+    "AWEI_nsh": lambda b: 4 * (b["green"] - b["swir1"]) - (0.25 * b["nir"] + 2.75 * b["swir2"]),
+    "AWEI_sh": lambda b: (b["blue"] + 2.5 * b["green"] - 1.5 * (b["nir"] + b["swir1"])
+                          - 0.25 * b["swir2"]),
+}
+
+# Indices computed by main(); any subset of INDEX_EXPRESSIONS
+INDEX_SET = ["MNDWI"]
+
+# DN -> reflectance applied to every band before the band math. 1/0 keeps
+# the raw DNs (normalized differences only need a zero offset; AWEI values
+# are in reflectance units only with the true scale)
+REFLECTANCE_SCALE = 1.0
+REFLECTANCE_OFFSET = 0.0
+
+# "auto" uses numexpr when it is installed, else "numpy"
+INDEX_ENGINE = "auto"
+# 64K float32 pixels = 256 KB per chunk buffer
+INDEX_CHUNK_PIXELS = 1 << 16
+INDEX_BLOCK_ROWS = 1024
+
+
+def index_bands(names):
+    """Band names the given indices need, in LANDSAT_BANDS order."""
+    used = set()
+    for name in names:
+        used.update(re.findall(r"[A-Za-z_]\w*", INDEX_EXPRESSIONS[name]))
+    return [band for band in LANDSAT_BANDS if band in used]
+
+
+def resolve_engine(engine=None):
+    engine = engine or INDEX_ENGINE
+    if engine == "auto":
+        try:
+            import numexpr  # noqa: F401
+            return "numexpr"
+        except ImportError:
+            return "numpy"
+    if engine not in ("numexpr", "numpy"):
+        raise ValueError(f"Unknown index engine: {engine}")
+    return engine
+
+
+def compute_indices(bands, names, out=None, chunk_pixels=None, engine=None,
+                    scale=REFLECTANCE_SCALE, offset=REFLECTANCE_OFFSET):
+    """Float32 arrays of the named indices from a dict of equally shaped bands.
+
+    out may hold preallocated float32 arrays per index (e.g. views into a
+    multi-band block); missing ones are allocated. Non-contiguous ones are
+    computed into a contiguous buffer and copied back at the end.
+    """
+    chunk_pixels = chunk_pixels or INDEX_CHUNK_PIXELS
+    engine = resolve_engine(engine)
+    shape = next(iter(bands.values())).shape
+    needed = index_bands(names)
+
+    out = dict(out or {})
+    for name in names:
+        if name not in out:
+            out[name] = np.empty(shape, dtype=np.float32)
+    flat_in = {band: np.ravel(bands[band]) for band in needed}
+    # reshape(-1) would silently copy a non-contiguous array
+    work = {
+        name: out[name] if out[name].flags.c_contiguous
+        else np.empty(shape, dtype=np.float32)
+        for name in names
+    }
+    flat_out = {name: work[name].reshape(-1) for name in names}
+
+    if engine == "numexpr":
+        import numexpr
+
+    scratch = {band: np.empty(chunk_pixels, dtype=np.float32) for band in needed}
+    size = int(np.prod(shape))
+    for start in range(0, size, chunk_pixels):
+        stop = min(start + chunk_pixels, size)
+        chunk = {}
+        for band in needed:
+            buf = scratch[band][:stop - start]
+            np.copyto(buf, flat_in[band][start:stop], casting="unsafe")
+            if scale != 1 or offset != 0:
+                buf *= np.float32(scale)
+                buf += np.float32(offset)
+            chunk[band] = buf
+
+        for name in names:
+            target = flat_out[name][start:stop]
+            if engine == "numexpr":
+                numexpr.evaluate(INDEX_EXPRESSIONS[name], local_dict=chunk, out=target,
+                                 casting="same_kind")
+            else:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    target[...] = INDEX_FUNCTIONS[name](chunk)
+
+    for name in names:
+        if work[name] is not out[name]:
+            np.copyto(out[name], work[name])
+    return {name: out[name] for name in names}
+
+# Rasters
+
+def index_output_paths(tif_path, names, out_dir=output_folder):
+    base = os.path.splitext(os.path.basename(tif_path))[0]
+    return {name: os.path.join(out_dir, f"{base}_{name}.tif") for name in names}
+
+
+def index_raster(tif_path, outputs, band_map=LANDSAT_BANDS, block_rows=INDEX_BLOCK_ROWS,
+                 engine=None):
+    """Write each index in outputs ({name: path}) from one read of its bands."""
+    names = list(outputs)
+    needed = index_bands(names)
+
+    with rasterio.open(tif_path) as src:
+        profile = src.profile.copy()
+        profile.update(count=1, dtype="float32", nodata=None,
+                       compress="deflate", predictor=3)
+        if src.width >= 256 and src.height >= 256:
+            profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+        with ExitStack() as stack:
+            dsts = {}
+            for name, path in outputs.items():
+                dsts[name] = stack.enter_context(rasterio.open(path, "w", **profile))
+                dsts[name].set_band_description(1, name)
+
+            with span("indices", scene=os.path.basename(tif_path), indices=",".join(names)):
+                for row_off in range(0, src.height, block_rows):
+                    window = Window(0, row_off, src.width, min(block_rows, src.height - row_off))
+                    with span("read") as s:
+                        block = src.read([band_map[band] for band in needed], window=window)
+                        s.add(bytes_read=block.nbytes, pixels=block[0].size)
+                    with span("band_math") as s:
+                        values = compute_indices(dict(zip(needed, block)), names, engine=engine)
+                        s.add(pixels=block[0].size)
+                    with span("write") as s:
+                        for name, array in values.items():
+                            dsts[name].write(array, 1, window=window)
+                            s.add(bytes_written=array.nbytes)
+    return outputs
+
+
+def main():
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    print(f"Band math engine: {resolve_engine()}")
+    for tif_name in sorted(f for f in os.listdir(folder_path) if f.endswith(".tif")):
+        tif_path = os.path.join(folder_path, tif_name)
+        outputs = index_raster(tif_path, index_output_paths(tif_path, INDEX_SET))
+        for path in outputs.values():
+            print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
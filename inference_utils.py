@@ -0,0 +1,423 @@
+#inference_utils.py
+"""
+CPU tiled inference for the exported segmentation models, independent of ArcPy.
+
+Models are run from TorchScript (.pt/.pth) or ONNX (.onnx) exports through
+PyTorch or ONNX Runtime, both imported only when used. Tiling follows
+ClassifyPixelsUsingDeepLearning: tile_size is the model input and padding
+pixels on each side are context only, so every tile contributes its central
+(tile_size - 2 * padding) square to the output.
+
+Tiles are read with rasterio windows on a reader thread while the model runs
+on the previous batch, and the stitched probability raster is written one
+row of tiles at a time.
+
+With blend="cosine" or "gaussian" the whole tile is used instead: tiles
+overlap by 2 * padding and are averaged with a separable weight window, so
+seams and tile-edge artifacts are blended out. Only one row band of tiles
+(tile_size rows of accumulators) is kept, and rows no later tile can reach
+are flushed to the output as soon as their tile row is done.
+"""
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from trace_utils import span
+
+TILE_SIZE = 224
+PADDING = 56
+BATCH_SIZE = 16
+PREFETCH_BATCHES = 2
+WATER_CLASS = 1
+
+# Tile stitching: "center" (crop, as ArcGIS), "cosine" or "gaussian"
+BLEND = "center"
+GAUSSIAN_SIGMA = 0.125  # fraction of tile_size
+OUTPUT_BLOCK_SIZE = 256
+
+
+def load_emd_stats(emd_path):
+    """Per-band (mean, std) from the AllTilesStats of an Esri model definition."""
+    with open(emd_path, "r", encoding="utf-8-sig") as f:
+        emd = json.load(f)
+    stats = emd["AllTilesStats"]
+    mean = np.array([b["Mean"] for b in stats], dtype=np.float32)
+    std = np.array([b["StdDev"] for b in stats], dtype=np.float32)
+    return mean, std
+
+# Model backends
+
+class OnnxModel:
+    def __init__(self, path, n_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class TorchScriptModel:
+    def __init__(self, path, n_threads=None):
+        import torch
+
+        if n_threads:
+            torch.set_num_threads(n_threads)
+        self.torch = torch
+        self.model = torch.jit.load(path, map_location="cpu").eval()
+
+    def __call__(self, batch):
+        with self.torch.inference_mode():
+            output = self.model(self.torch.from_numpy(batch))
+        if isinstance(output, (tuple, list)):
+            output = output[0]
+        return output.numpy()
+
+
+def load_model(model_path, n_threads=None):
+    ext = os.path.splitext(model_path)[1].lower()
+    if ext == ".onnx":
+        return OnnxModel(model_path, n_threads)
+    if ext in (".pt", ".pth", ".torchscript"):
+        return TorchScriptModel(model_path, n_threads)
+    raise ValueError(
+        f"Unsupported model format '{ext}': export the .dlpk model to "
+        "TorchScript or ONNX first"
+    )
+
+
+def water_probability(output, water_class=WATER_CLASS):
+    """(N, C, H, W) logits to (N, H, W) water probability."""
+    output = np.asarray(output, dtype=np.float32)
+    if output.ndim == 3:
+        output = output[:, np.newaxis]
+
+    # Single-channel models are sigmoid, multi-class (with background) softmax
+    if output.shape[1] == 1:
+        return 1.0 / (1.0 + np.exp(-output[:, 0]))
+
+    shifted = output - output.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp[:, water_class] / exp.sum(axis=1)
+
+# Tiling
+
+def tile_step(tile_size, padding):
+    step = tile_size - 2 * padding
+    if step <= 0:
+        raise ValueError(f"padding {padding} leaves no output for tile_size {tile_size}")
+    return step
+
+
+def tile_origins(width, height, tile_size, padding):
+    step = tile_step(tile_size, padding)
+    for row in range(0, height, step):
+        for col in range(0, width, step):
+            yield row, col
+
+
+def read_tile(src, row, col, tile_size, padding, bands=None):
+    # Tile covers [row - padding, row - padding + tile_size); parts outside
+    # the raster are filled by reflection
+    r0, c0 = row - padding, col - padding
+    rr0, cc0 = max(r0, 0), max(c0, 0)
+    rr1 = min(r0 + tile_size, src.height)
+    cc1 = min(c0 + tile_size, src.width)
+
+    data = src.read(bands, window=Window(cc0, rr0, cc1 - cc0, rr1 - rr0))
+    data = data.astype(np.float32, copy=False)
+
+    pad = ((0, 0), (rr0 - r0, r0 + tile_size - rr1), (cc0 - c0, c0 + tile_size - cc1))
+    if any(p for axis in pad for p in axis):
+        mode = "reflect" if min(data.shape[1:]) > 1 else "edge"
+        data = np.pad(data, pad, mode=mode)
+    return data
+
+
+def weight_window(tile_size, blend=BLEND, sigma=GAUSSIAN_SIGMA):
+    """(tile_size, tile_size) blending weights, positive everywhere."""
+    x = np.arange(tile_size, dtype=np.float64) + 0.5
+    if blend == "cosine":
+        w = np.sin(np.pi * x / tile_size) ** 2
+    elif blend == "gaussian":
+        w = np.exp(-0.5 * ((x - tile_size / 2) / (sigma * tile_size)) ** 2)
+    else:
+        raise ValueError(f"Unknown blend window '{blend}'")
+    return np.outer(w, w).astype(np.float32)
+
+
+def input_stats(stats, band_count, bands=None):
+    """(mean, std) for the bands fed to the model; they must match one to one.
+
+    Stats covering every raster band are subset with bands. Any other
+    length is an error: stats of another sensor (e.g. the 7-band Landsat
+    .emd for a Sentinel-2 RGB) would otherwise be applied silently.
+    """
+    if stats is None:
+        return None
+    mean, std = (np.asarray(v, dtype=np.float32) for v in stats)
+    n_inputs = len(bands) if bands else band_count
+    if bands and len(mean) == band_count and len(mean) != n_inputs:
+        idx = np.asarray(bands) - 1
+        mean, std = mean[idx], std[idx]
+    if len(mean) != n_inputs or len(std) != n_inputs:
+        raise ValueError(
+            f"Normalization stats have {len(mean)} bands but the model input has "
+            f"{n_inputs}; use the .emd of the model trained on this input"
+        )
+    return mean, std
+
+
+def normalize_tiles(batch, stats):
+    if stats is None:
+        return batch
+    mean, std = stats
+    batch -= mean[:, np.newaxis, np.newaxis]
+    batch /= std[:, np.newaxis, np.newaxis]
+    return batch
+
+
+def _batch_reader(src_path, origins, tile_size, padding, bands, stats,
+                  batch_size, out_queue):
+    try:
+        with rasterio.open(src_path) as src:
+            for start in range(0, len(origins), batch_size):
+                batch_origins = origins[start:start + batch_size]
+                with span("read", tiles=len(batch_origins)) as s:
+                    batch = np.stack([
+                        read_tile(src, row, col, tile_size, padding, bands)
+                        for row, col in batch_origins
+                    ])
+                    s.add(bytes_read=batch.nbytes, pixels=batch[:, 0].size)
+                out_queue.put((batch_origins, normalize_tiles(batch, stats)))
+        out_queue.put(None)
+    except Exception as e:
+        out_queue.put(e)
+
+
+def iter_batches(src_path, origins, tile_size, padding, bands, stats,
+                 batch_size, prefetch=PREFETCH_BATCHES):
+    """Normalized tile batches, read ahead on a background thread."""
+    batches = queue.Queue(maxsize=max(1, prefetch))
+    reader = threading.Thread(
+        target=_batch_reader,
+        args=(src_path, origins, tile_size, padding, bands, stats, batch_size, batches),
+        daemon=True,
+    )
+    reader.start()
+
+    while True:
+        item = batches.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+    reader.join()
+
+
+def probability_profile(profile, count=1):
+    profile = profile.copy()
+    for key in ("blockxsize", "blockysize", "tiled", "photometric"):
+        profile.pop(key, None)
+    profile.update(
+        driver="GTiff", dtype=rasterio.float32, count=count, nodata=None,
+        tiled=True, blockxsize=OUTPUT_BLOCK_SIZE, blockysize=OUTPUT_BLOCK_SIZE,
+    )
+    return profile
+
+
+def prob_output_path(out_folder, tif_name):
+    # Same naming script 8 expects for the UResNet probability raster
+    return os.path.join(out_folder, tif_name.replace(".tif", "_prob.tif"))
+
+
+def _stitch_center(dst, predictions, width, height, tile_size, padding, count=1):
+    step = tile_step(tile_size, padding)
+    strip, strip_row, tiles_left = None, None, 0
+    tiles_per_row = -(-width // step)
+
+    for (row, col), prob in predictions:
+        if row != strip_row:
+            strip_row = row
+            strip = np.zeros((count, min(step, height - row), width), dtype=np.float32)
+            tiles_left = tiles_per_row
+
+        h, w = strip.shape[1], min(step, width - col)
+        strip[:, :, col:col + w] = prob[:, padding:padding + h, padding:padding + w]
+        tiles_left -= 1
+
+        # Row of tiles complete: flush it and drop the buffer
+        if tiles_left == 0:
+            with span("write") as s:
+                dst.write(strip, window=Window(0, row, width, h))
+                s.add(bytes_written=strip.nbytes)
+            strip = None
+
+
+def _stitch_blended(dst, predictions, width, height, tile_size, padding, weights,
+                    count=1):
+    step = tile_step(tile_size, padding)
+    tiles_per_row = -(-width // step)
+
+    # Accumulators cover raster rows [top, top + tile_size): the current row
+    # of tiles. The first step rows are final once that row is done.
+    acc = np.zeros((count, tile_size, width), dtype=np.float32)
+    wsum = np.zeros((tile_size, width), dtype=np.float32)
+    top, flushed, tiles_left = -padding, 0, tiles_per_row
+
+    for (row, col), prob in predictions:
+        r0, r1 = max(row - padding, 0), min(row - padding + tile_size, height)
+        c0, c1 = max(col - padding, 0), min(col - padding + tile_size, width)
+        tr, tc = r0 - (row - padding), c0 - (col - padding)
+        w = weights[tr:tr + r1 - r0, tc:tc + c1 - c0]
+
+        acc[:, r0 - top:r1 - top, c0:c1] += prob[:, tr:tr + r1 - r0, tc:tc + c1 - c0] * w
+        wsum[r0 - top:r1 - top, c0:c1] += w
+        tiles_left -= 1
+        if tiles_left:
+            continue
+
+        # Rows above the next tile row's top are final
+        done = height if row + step >= height else min(top + step, height)
+        if done > flushed:
+            a, b = flushed - top, done - top
+            with span("write") as s:
+                rows = acc[:, a:b] / wsum[a:b]
+                dst.write(rows, window=Window(0, flushed, width, done - flushed))
+                s.add(bytes_written=rows.nbytes)
+            flushed = done
+
+        acc[:, :-step] = acc[:, step:]
+        wsum[:-step] = wsum[step:]
+        acc[:, -step:] = 0
+        wsum[-step:] = 0
+        top += step
+        tiles_left = tiles_per_row
+
+
+def _run_tiled(in_path, out_path, predict_batch, count, tile_size, padding,
+               batch_size, bands, stats, blend, descriptions=None):
+    # predict_batch maps a normalized (N, C, T, T) batch to (N, count, T, T)
+    with rasterio.open(in_path) as src:
+        width, height = src.width, src.height
+        profile = probability_profile(src.profile, count=count)
+        stats = input_stats(stats, src.count, bands)
+
+    origins = list(tile_origins(width, height, tile_size, padding))
+
+    def predictions():
+        for batch_origins, batch in iter_batches(
+            in_path, origins, tile_size, padding, bands, stats, batch_size
+        ):
+            with span("model", tiles=len(batch_origins)) as s:
+                probs = predict_batch(batch)
+                s.add(pixels=batch[:, 0].size)
+            yield from zip(batch_origins, probs)
+
+    with span("predict", scene=os.path.basename(in_path), blend=blend) as s, \
+            rasterio.open(out_path, "w", **profile) as dst:
+        s.add(pixels=width * height)
+        if descriptions:
+            for i, name in enumerate(descriptions, start=1):
+                dst.set_band_description(i, name)
+
+        if blend == "center":
+            _stitch_center(dst, predictions(), width, height, tile_size, padding, count)
+        else:
+            weights = weight_window(tile_size, blend)
+            _stitch_blended(
+                dst, predictions(), width, height, tile_size, padding, weights, count
+            )
+
+    return out_path
+
+
+def predict_raster(model, in_path, out_path, tile_size=TILE_SIZE, padding=PADDING,
+                   batch_size=BATCH_SIZE, bands=None, stats=None,
+                   water_class=WATER_CLASS, blend=BLEND):
+    def predict_batch(batch):
+        return water_probability(model(batch), water_class)[:, np.newaxis]
+
+    return _run_tiled(
+        in_path, out_path, predict_batch, 1, tile_size, padding,
+        batch_size, bands, stats, blend,
+    )
+
+# Multi-model ensemble
+# Each tile is read, normalized and batched once and then run through every
+# model. Output band 1 is the fused probability (so readers of band 1, like
+# script 8, get the ensemble), followed by one band per model.
+
+# Model folders written by 6_train_models.py
+ENSEMBLE_MODELS = ["UResNet", "UVGG16", "DpLResNet", "DpLVGG16", "PSPResNet", "PSPVGG16"]
+FUSION = "mean"
+
+
+def ensemble_model_paths(models_dir, names=None, ext=".pt"):
+    """{name: <models_dir>/<name>/<name><ext>}, the TorchScript layout of
+    train_utils.export_model."""
+    names = names or ENSEMBLE_MODELS
+    return {name: os.path.join(models_dir, name, name + ext) for name in names}
+
+
+def load_ensemble(model_paths, n_threads=None):
+    missing = [path for path in model_paths.values() if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(
+            "Missing ensemble models (train and export them with "
+            "6_train_models.py, TRAIN_BACKEND = \"local\"): " + ", ".join(missing)
+        )
+    return {name: load_model(path, n_threads) for name, path in model_paths.items()}
+
+
+def fuse_probabilities(probs, fusion=FUSION, weights=None):
+    """Fuse (M, ...) per-model probabilities along axis 0."""
+    if fusion == "mean":
+        return probs.mean(axis=0)
+    if fusion == "max":
+        return probs.max(axis=0)
+    if fusion == "weighted":
+        if weights is None or len(weights) != probs.shape[0]:
+            raise ValueError("weighted fusion needs one weight per model")
+        w = np.asarray(weights, dtype=np.float32)
+        return np.tensordot(w / w.sum(), probs, axes=1)
+    raise ValueError(f"Unknown fusion '{fusion}'")
+
+
+def ensemble_output_path(out_folder, tif_name):
+    return os.path.join(out_folder, tif_name.replace(".tif", "_ensemble_prob.tif"))
+
+
+def predict_ensemble(models, in_path, out_path, tile_size=TILE_SIZE, padding=PADDING,
+                     batch_size=BATCH_SIZE, bands=None, stats=None,
+                     water_class=WATER_CLASS, blend=BLEND, fusion=FUSION,
+                     weights=None):
+    """models is {name: model}; weights, if given, is {name: weight}."""
+    names = list(models)
+    if isinstance(weights, dict):
+        weights = [weights[name] for name in names]
+
+    def predict_batch(batch):
+        probs = np.stack([
+            water_probability(models[name](batch), water_class) for name in names
+        ])
+        fused = fuse_probabilities(probs, fusion, weights)
+        return np.concatenate([fused[np.newaxis], probs]).swapaxes(0, 1)
+
+    descriptions = [f"ensemble_{fusion}"] + [f"{name}_prob" for name in names]
+    return _run_tiled(
+        in_path, out_path, predict_batch, len(names) + 1, tile_size, padding,
+        batch_size, bands, stats, blend, descriptions,
+    )
@@ -0,0 +1,289 @@
+#polygonize_utils.py
+"""
+Raster-to-vector stage for binary flood masks.
+
+Masks (script 16 extents, script 8 ensemble masks) are polygonized window
+by window with rasterio.features.shapes, in parallel processes. Polygons
+that do not touch an inner window edge are final: they are cleaned
+(optional hole filling, simplification and sliver removal) in the worker
+and streamed to the output as soon as their window is done. Polygons on a
+seam are kept, joined with their neighbours across the seam (shared edge,
+so 4-connected like shapes itself) and written at the end.
+
+Output is a GeoPackage layer or a GeoParquet file (needs pyarrow) with
+the mask value and polygon area, the vector form the GEE depth script
+takes as FeatureCollections.
+"""
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import geopandas as gpd
+import pyogrio
+import rasterio
+import shapely
+from rasterio import features
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from shapely.geometry import shape
+from raster_utils import block_windows, read_flood
+from trace_utils import span
+
+# (folder, file suffix) of the masks to vectorize
+MASK_SOURCES = [
+    (r"D:\FloodOutputs\UResNet_vs_MNDWI", "_UResNetMNDWIFExt.tif"),
+    (r"D:\FloodOutputs\UResNet_vs_MNDWI", "_Sen2FextGTruth.tif"),
+    (r"UResNetMNDWIEns", "_UResNetMNDWI_MC_mask.tif"),
+]
+OUTPUT_DIR = r"D:\FloodOutputs\FloodExtents"
+OUTPUT_FORMAT = "gpkg"  # "gpkg" or "parquet"
+
+WINDOW_SIZE = 4096
+POLYGONIZE_WORKERS = 1
+WRITE_BATCH = 10000
+
+# Cleaning, in map units (metres for UTM); None skips the step
+SIMPLIFY_TOLERANCE = None
+MIN_AREA = None        # polygons smaller than this are dropped
+MIN_HOLE_AREA = None   # holes smaller than this are filled
+
+# Cleaning
+
+def fill_holes(geoms, min_hole_area):
+    geoms = geoms.copy()
+    for i in np.flatnonzero(shapely.get_num_interior_rings(geoms) > 0):
+        polygon = geoms[i]
+        holes = [ring for ring in polygon.interiors
+                 if shapely.area(shapely.Polygon(ring)) >= min_hole_area]
+        geoms[i] = shapely.Polygon(polygon.exterior, holes)
+    return geoms
+
+
+def clean_polygons(geoms, tolerance=None, min_area=None, min_hole_area=None):
+    geoms = shapely.get_parts(np.asarray(geoms, dtype=object))
+    if min_hole_area:
+        geoms = fill_holes(geoms, min_hole_area)
+    if tolerance:
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if min_area:
+        geoms = geoms[shapely.area(geoms) >= min_area]
+    return geoms[~shapely.is_empty(geoms)]
+
+# Windows
+
+def polygonize_window(mask_path, window, cleaning):
+    """(final WKB, seam WKB) polygons of the water pixels in one window."""
+    with rasterio.open(mask_path) as src:
+        flood = read_flood(src, window)
+        transform = src.window_transform(window)
+        width, height = src.width, src.height
+
+    if not flood.any():
+        return [], []
+
+    geoms = np.array(
+        [shape(geom) for geom, _ in features.shapes(flood.view(np.uint8), mask=flood,
+                                                    transform=transform)],
+        dtype=object,
+    )
+
+    # Edges shared with another window; half a pixel absorbs rounding
+    left, top = transform * (0, 0)
+    right, bottom = transform * (window.width, window.height)
+    tol_x, tol_y = abs(transform.a) / 2, abs(transform.e) / 2
+    xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+
+    seam = np.zeros(len(geoms), dtype=bool)
+    if window.col_off > 0:
+        seam |= xmin <= left + tol_x
+    if window.col_off + window.width < width:
+        seam |= xmax >= right - tol_x
+    if window.row_off > 0:
+        seam |= ymax >= top - tol_y
+    if window.row_off + window.height < height:
+        seam |= ymin <= bottom + tol_y
+
+    final = clean_polygons(geoms[~seam], **cleaning)
+    return shapely.to_wkb(final).tolist(), shapely.to_wkb(geoms[seam]).tolist()
+
+
+def _polygonize_task(args):
+    return polygonize_window(*args)
+
+
+def merge_seams(geoms):
+    """Union seam polygons that share an edge across window borders."""
+    geoms = np.asarray(geoms, dtype=object)
+    if len(geoms) < 2:
+        return geoms
+
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate="intersects")
+    pair = left < right
+    left, right = left[pair], right[pair]
+
+    # Corner contact is not a connection (shapes uses 4-connectivity)
+    shared = shapely.length(shapely.intersection(
+        shapely.boundary(geoms[left]), shapely.boundary(geoms[right])
+    )) > 0
+    graph = coo_matrix(
+        (np.ones(shared.sum()), (left[shared], right[shared])), shape=(len(geoms), len(geoms))
+    )
+    n_groups, labels = connected_components(graph, directed=False)
+
+    order = np.argsort(labels, kind="stable")
+    groups = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    merged = [
+        geoms[idx[0]] if len(idx) == 1 else shapely.union_all(geoms[idx])
+        for idx in groups
+    ]
+    return np.array(merged, dtype=object)
+
+# Writers
+
+class GpkgWriter:
+    def __init__(self, path, crs, layer):
+        self.path = path
+        self.crs = crs
+        self.layer = layer
+        self.started = False
+
+    def write(self, geoms):
+        frame = gpd.GeoDataFrame(
+            {"value": np.ones(len(geoms), dtype=np.int32), "area": shapely.area(geoms)},
+            geometry=list(geoms), crs=self.crs,
+        )
+        pyogrio.write_dataframe(
+            frame, self.path, layer=self.layer, driver="GPKG",
+            append=self.started, promote_to_multi=True,
+        )
+        self.started = True
+
+    def close(self):
+        if not self.started:
+            # Empty mask: still leave a layer behind
+            self.write(np.array([], dtype=object))
+
+
+class ParquetWriter:
+    def __init__(self, path, crs, layer=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from pyproj import CRS
+
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Polygon", "MultiPolygon"],
+                "crs": CRS.from_wkt(crs.to_wkt()).to_json_dict() if crs else None,
+            }},
+        }
+        self.pa = pa
+        self.schema = pa.schema(
+            [("value", pa.int32()), ("area", pa.float64()), ("geometry", pa.binary())],
+            metadata={b"geo": json.dumps(geo).encode()},
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, geoms):
+        table = self.pa.table({
+            "value": np.ones(len(geoms), dtype=np.int32),
+            "area": shapely.area(geoms),
+            "geometry": shapely.to_wkb(geoms),
+        }, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+def vector_output_path(mask_path, out_dir=OUTPUT_DIR, fmt=OUTPUT_FORMAT):
+    name = os.path.splitext(os.path.basename(mask_path))[0]
+    return os.path.join(out_dir, f"{name}.{fmt}")
+
+# Driver
+
+def polygonize_mask(mask_path, out_path, window_size=WINDOW_SIZE, n_workers=None,
+                    tolerance=SIMPLIFY_TOLERANCE, min_area=MIN_AREA,
+                    min_hole_area=MIN_HOLE_AREA):
+    """Vectorize the water pixels of a mask raster; returns the polygon count."""
+    n_workers = n_workers or POLYGONIZE_WORKERS
+    cleaning = dict(tolerance=tolerance, min_area=min_area, min_hole_area=min_hole_area)
+
+    with rasterio.open(mask_path) as src:
+        crs = src.crs
+        windows = list(block_windows(src.width, src.height, window_size))
+
+    layer = os.path.splitext(os.path.basename(out_path))[0]
+    base, ext = os.path.splitext(out_path)
+    tmp_path = f"{base}.tmp{ext}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    writer = (ParquetWriter if ext.lower() == ".parquet" else GpkgWriter)(tmp_path, crs, layer)
+
+    pending, seams, written = [], [], 0
+
+    def flush(force=False):
+        nonlocal pending, written
+        if pending and (force or len(pending) >= WRITE_BATCH):
+            writer.write(shapely.from_wkb(pending))
+            written += len(pending)
+            pending = []
+
+    def collect(result):
+        final, seam = result
+        pending.extend(final)
+        seams.extend(seam)
+        flush()
+
+    with span("polygonize", mask=os.path.basename(mask_path), windows=len(windows)) as s:
+        tasks = [(mask_path, window, cleaning) for window in windows]
+        if n_workers <= 1:
+            for task in tasks:
+                collect(_polygonize_task(task))
+        else:
+            # At most two windows per worker in flight, so memory stays bounded
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                queue = iter(tasks)
+                running = {pool.submit(_polygonize_task, t) for t in
+                           (next(queue, None) for _ in range(2 * n_workers)) if t}
+                while running:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+                        task = next(queue, None)
+                        if task is not None:
+                            running.add(pool.submit(_polygonize_task, task))
+
+        merged = clean_polygons(merge_seams(shapely.from_wkb(seams)), **cleaning)
+        pending.extend(shapely.to_wkb(merged).tolist())
+        flush(force=True)
+        writer.close()
+        s.add(polygons=written, seam_pieces=len(seams))
+
+    os.replace(tmp_path, out_path)
+    return written
+
+
+def main():
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    for folder, suffix in MASK_SOURCES:
+        if not os.path.isdir(folder):
+            print(f"Missing mask folder: {folder}")
+            continue
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(suffix):
+                continue
+            mask_path = os.path.join(folder, name)
+            out_path = vector_output_path(mask_path)
+            n = polygonize_mask(mask_path, out_path)
+            print(f"Saved {n} polygons: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
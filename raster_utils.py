@@ -0,0 +1,383 @@
+#raster_utils.py
+"""
+Shared raster helpers for the preprocessing and evaluation scripts.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio import features
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.mask import raster_geometry_mask
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+from trace_utils import span
+
+# Number of (geometry, grid) clip masks kept in memory
+CLIP_MASK_CACHE_SIZE = 64
+
+# Cloud-Optimized GeoTIFF defaults ("ZSTD" needs a GDAL built with zstd)
+COG_COMPRESS = "DEFLATE"
+COG_BLOCK_SIZE = 512
+
+
+def read_band(path, band=1):
+    with rasterio.open(path) as src:
+        return src.read(band)
+
+
+def read_scaled(path, band=1):
+    """Band as float32 with scale/offset applied and nodata set to NaN."""
+    with rasterio.open(path) as src:
+        return scaled_read(src, band)
+
+
+def scaled_read(src, band=1, window=None):
+    arr = src.read(band, window=window)
+    scale, offset = src.scales[band - 1], src.offsets[band - 1]
+    nodata = src.nodata
+
+    out = arr.astype(np.float32)
+    if scale != 1 or offset != 0:
+        out *= np.float32(scale)
+        out += np.float32(offset)
+    if nodata is not None:
+        out[arr == nodata] = np.nan
+    return out
+
+
+def read_flood(src, window=None):
+    """Boolean flood mask (value > 0) of band 1, with nodata as dry."""
+    values = src.read(1, window=window)
+    flood = values > 0
+    # Masks from script 8 inherit the Landsat nodata 0, which is "dry" here
+    if src.nodata is not None and src.nodata not in (0, 1):
+        flood &= values != src.nodata
+    return flood
+
+
+def block_windows(width, height, size, row_off=0, col_off=0):
+    """Windows of at most size x size covering a width x height area, row-major."""
+    for r0 in range(0, height, size):
+        for c0 in range(0, width, size):
+            yield Window(col_off + c0, row_off + r0,
+                         min(size, width - c0), min(size, height - r0))
+
+
+def atomic_write_json(obj, path, indent=4):
+    # Write to a temporary file first so an interrupted save never leaves
+    # a truncated file behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def write_cog(src_path, dst_path, compress=COG_COMPRESS, blocksize=COG_BLOCK_SIZE,
+              resampling="AVERAGE", nbits=None):
+    """Copy a raster to a Cloud-Optimized GeoTIFF with internal overviews.
+
+    PREDICTOR=YES selects horizontal differencing for integer bands and the
+    floating-point predictor for float32. Band descriptions, scale/offset
+    and nodata are carried over from the source.
+    """
+    options = dict(
+        COMPRESS=compress, BLOCKSIZE=blocksize,
+        OVERVIEW_RESAMPLING=resampling, BIGTIFF="IF_SAFER",
+    )
+    if nbits:
+        options["NBITS"] = nbits
+    else:
+        options["PREDICTOR"] = "YES"
+    # Everything lives inside the COG; no .aux.xml sidecar
+    with rasterio.Env(GDAL_PAM_ENABLED="NO"):
+        rasterio.shutil.copy(src_path, dst_path, driver="COG", **options)
+
+# Cached clip masks
+# rasterio.mask.mask re-rasterizes the clip geometry on every call. The
+# boolean mask, crop window and cropped transform only depend on the geometry
+# and the raster grid, so they are computed once per (geometry hash, CRS,
+# transform, shape) and reused across bands, years and products.
+
+_clip_mask_cache = OrderedDict()
+_clip_mask_lock = threading.Lock()
+# Rasterization is serialized: concurrent band reads of one scene share a
+# grid, so the first thread computes the mask and the rest hit the cache
+_clip_mask_compute_lock = threading.Lock()
+
+
+def geometry_key(geometry):
+    digest = hashlib.sha1()
+    for geom in geometry:
+        if hasattr(geom, "wkb"):
+            digest.update(geom.wkb)
+        else:
+            geo = getattr(geom, "__geo_interface__", geom)
+            digest.update(json.dumps(geo, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def clip_mask(src, geometry):
+    """Cached (shape_mask, transform, window) of raster_geometry_mask(crop=True)."""
+    key = (
+        geometry_key(geometry),
+        src.crs.to_wkt() if src.crs else None,
+        tuple(src.transform),
+        (src.height, src.width),
+    )
+
+    with _clip_mask_lock:
+        if key in _clip_mask_cache:
+            _clip_mask_cache.move_to_end(key)
+            return _clip_mask_cache[key]
+
+    with _clip_mask_compute_lock:
+        with _clip_mask_lock:
+            if key in _clip_mask_cache:
+                return _clip_mask_cache[key]
+
+        result = raster_geometry_mask(src, geometry, crop=True)
+
+        with _clip_mask_lock:
+            _clip_mask_cache[key] = result
+            while len(_clip_mask_cache) > CLIP_MASK_CACHE_SIZE:
+                _clip_mask_cache.popitem(last=False)
+    return result
+
+
+def clear_clip_mask_cache():
+    with _clip_mask_lock:
+        _clip_mask_cache.clear()
+
+
+def masked_read(src, geometry, indexes=None, nodata=None):
+    """Drop-in for rasterio.mask.mask(src, geometry, crop=True, ...).
+
+    Only the cropped window is read from disk and pixels outside the
+    geometry are set to nodata (the raster nodata, or 0 if unset).
+    """
+    if nodata is None:
+        nodata = src.nodata if src.nodata is not None else 0
+
+    shape_mask, transform, window = clip_mask(src, geometry)
+
+    if indexes is None:
+        out_shape = (src.count,) + shape_mask.shape
+    elif isinstance(indexes, int):
+        out_shape = shape_mask.shape
+    else:
+        out_shape = (len(indexes),) + shape_mask.shape
+
+    out_image = src.read(
+        window=window, out_shape=out_shape, masked=True, indexes=indexes
+    )
+    out_image.mask = out_image.mask | shape_mask
+    return out_image.filled(nodata), transform
+
+# Grid alignment
+# Products of different resolutions (Landsat 30 m, Sentinel-2 10 m) are
+# compared on one target grid per site: the grid of a reference raster
+# cropped to the site geometry, stored as JSON and rebuilt only when the
+# reference or the geometry changes. Every product is read through a
+# WarpedVRT onto that grid, so GDAL resamples it window by window and no
+# full-resolution copy of a mismatched raster is ever held.
+
+# Resampling per kind of product
+ALIGN_RESAMPLING = {"mask": "nearest", "prob": "average"}
+
+
+def grid_from_raster(path, geometry=None):
+    """Grid (CRS, transform, size) of a raster, cropped to the geometry bounds.
+
+    geometry must be in the raster CRS, as for masked_read. The crop is
+    snapped outward to whole reference pixels.
+    """
+    with rasterio.open(path) as src:
+        window = Window(0, 0, src.width, src.height)
+        if geometry is not None:
+            bounds = np.array([features.bounds(geom) for geom in geometry])
+            crop = from_bounds(*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0),
+                               transform=src.transform)
+            col0, row0 = np.floor(crop.col_off), np.floor(crop.row_off)
+            col1 = np.ceil(crop.col_off + crop.width)
+            row1 = np.ceil(crop.row_off + crop.height)
+            window = Window(col0, row0, col1 - col0, row1 - row0).intersection(window)
+        transform = src.window_transform(window)
+        return {
+            "crs": src.crs.to_wkt(),
+            "transform": [float(v) for v in list(transform)[:6]],
+            "width": int(window.width),
+            "height": int(window.height),
+        }
+
+
+def grid_profile(grid):
+    return dict(crs=CRS.from_wkt(grid["crs"]), transform=Affine(*grid["transform"]),
+                width=grid["width"], height=grid["height"])
+
+
+def grid_key(grid, geometry=None):
+    digest = hashlib.sha1(json.dumps(grid, sort_keys=True).encode("utf-8"))
+    if geometry is not None:
+        digest.update(geometry_key(geometry).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def site_grid(cache_path, reference_path, geometry=None):
+    """Target grid of a site, cached as JSON next to its source signature."""
+    st = os.stat(reference_path)
+    source = {
+        "reference": os.path.abspath(reference_path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "geometry": geometry_key(geometry) if geometry is not None else None,
+    }
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            if cached.get("source") == source:
+                return cached["grid"]
+        except (OSError, ValueError):
+            pass
+
+    grid = grid_from_raster(reference_path, geometry)
+    atomic_write_json({"source": source, "grid": grid}, cache_path)
+    return grid
+
+
+def read_aligned(path, grid, resampling="nearest", geometry=None, band=1, window=None):
+    """Band resampled onto the grid as float32 (scale/offset applied).
+
+    NaN where the source has no data and, with geometry (in the grid CRS),
+    outside it.
+    """
+    with rasterio.open(path) as src:
+        scale, offset = src.scales[band - 1], src.offsets[band - 1]
+        # Without nodata, an alpha band marks the pixels the source covers
+        with WarpedVRT(src, resampling=Resampling[resampling], add_alpha=src.nodata is None,
+                       **grid_profile(grid)) as vrt:
+            values = vrt.read(band, window=window, masked=True)
+            transform = vrt.window_transform(window) if window else vrt.transform
+
+    out = values.filled(0).astype(np.float32)
+    if scale != 1 or offset != 0:
+        out *= np.float32(scale)
+        out += np.float32(offset)
+    out[np.ma.getmaskarray(values)] = np.nan
+    if geometry is not None:
+        outside = features.geometry_mask(geometry, out.shape, transform)
+        out[outside] = np.nan
+    return out
+
+
+def aligned_loader(grid, resampling="nearest", geometry=None):
+    """RasterRegistry loader reading onto the grid.
+
+    The loader name carries the grid and geometry hash, so a registry
+    cache_dir keeps the resampled arrays per grid.
+    """
+    def load(path):
+        return read_aligned(path, grid, resampling, geometry)
+
+    load.__name__ = f"aligned_{resampling}_{grid_key(grid, geometry)}"
+    return load
+
+# Lazy raster registry
+# Rasters are registered by key, e.g. ("Sen2", "BF", "2019"), and only opened
+# on first use. Loaded arrays are kept in LRU order and the oldest are dropped
+# once the total exceeds max_mb. With cache_dir set, each loaded array is
+# also saved as .npy and served memory-mapped afterwards, so re-reading an
+# evicted raster skips the clip/resize work.
+
+class RasterRegistry:
+    def __init__(self, max_mb=2048, cache_dir=None):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._arrays = OrderedDict()
+        self._nbytes = 0
+
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def register(self, key, path, loader=read_band):
+        if not os.path.exists(path):
+            return False
+        self._entries[key] = (path, loader)
+        return True
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return list(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key):
+        if key in self._arrays:
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+
+        if key not in self._entries:
+            raise KeyError(f"No raster registered for {key}")
+
+        path, loader = self._entries[key]
+        with span("load", key=repr(key)) as s:
+            arr = self._load(key, path, loader)
+            s.add(bytes_read=arr.nbytes, pixels=arr.size)
+
+        self._arrays[key] = arr
+        self._nbytes += arr.nbytes
+        self._evict()
+        return arr
+
+    def release(self, key):
+        arr = self._arrays.pop(key, None)
+        if arr is not None:
+            self._nbytes -= arr.nbytes
+
+    def clear(self):
+        self._arrays.clear()
+        self._nbytes = 0
+
+    def _evict(self):
+        # The most recently used array always stays, even if it alone
+        # exceeds the ceiling
+        while self._nbytes > self.max_bytes and len(self._arrays) > 1:
+            _, arr = self._arrays.popitem(last=False)
+            self._nbytes -= arr.nbytes
+
+    def _cache_path(self, key, path, loader):
+        st = os.stat(path)
+        tag = "|".join([
+            repr(key), os.path.abspath(path), str(st.st_size),
+            str(st.st_mtime_ns), getattr(loader, "__name__", repr(loader)),
+        ])
+        digest = hashlib.sha1(tag.encode("utf-8")).hexdigest()[:16]
+        name = "_".join(str(k) for k in key) if isinstance(key, tuple) else str(key)
+        return os.path.join(self.cache_dir, f"{name}_{digest}.npy")
+
+    def _load(self, key, path, loader):
+        if not self.cache_dir:
+            return loader(path)
+
+        cache_path = self._cache_path(key, path, loader)
+        if not os.path.exists(cache_path):
+            arr = loader(path)
+            tmp_path = cache_path[:-4] + ".tmp.npy"
+            np.save(tmp_path, np.ascontiguousarray(arr))
+            os.replace(tmp_path, cache_path)
+            del arr
+
+        return np.load(cache_path, mmap_mode="r")
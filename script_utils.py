@@ -0,0 +1,17 @@
+#script_utils.py
+"""
+Import helpers for the numbered pipeline scripts.
+"""
+
+import os
+import importlib.util
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(filename, name):
+    """Import one of the numbered scripts, which are not valid module names."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
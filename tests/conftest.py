@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from script_utils import load_script  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def ensemble():
+    return load_script("8_develop_mndwi_MonteCarlo_EnsembleUResNetMNDWI.py", "mc_ensemble")
+
+
+@pytest.fixture(scope="session")
+def reflectance():
+    return load_script("2. reflectance_utils.py", "reflectance_utils")
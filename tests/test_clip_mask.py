@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+import rasterio.mask
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+import raster_utils
+
+
+def test_concurrent_reads_rasterize_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "scene.tif")
+    with rasterio.open(
+        path, "w", driver="GTiff", height=64, width=64, count=7, dtype="uint16",
+        crs="EPSG:32631", transform=from_origin(600000, 1300000, 30, 30),
+    ) as dst:
+        dst.write(np.arange(7 * 64 * 64, dtype=np.uint16).reshape(7, 64, 64))
+    geometry = [box(600300, 1298700, 601200, 1299600)]
+
+    calls = []
+    lock = threading.Lock()
+    rasterize = raster_utils.raster_geometry_mask
+
+    def counting(*args, **kwargs):
+        with lock:
+            calls.append(1)
+        return rasterize(*args, **kwargs)
+
+    monkeypatch.setattr(raster_utils, "raster_geometry_mask", counting)
+    raster_utils.clear_clip_mask_cache()
+
+    def read(band):
+        with rasterio.open(path) as src:
+            return raster_utils.masked_read(src, geometry, indexes=band)
+
+    # One thread per band, as in compute_mean_reflectance
+    with ThreadPoolExecutor(max_workers=7) as pool:
+        results = list(pool.map(read, range(1, 8)))
+
+    assert len(calls) == 1
+    with rasterio.open(path) as src:
+        for band, (data, _) in zip(range(1, 8), results):
+            expected, _ = rasterio.mask.mask(src, geometry, crop=True, indexes=band)
+            assert np.array_equal(data, expected)
+    raster_utils.clear_clip_mask_cache()
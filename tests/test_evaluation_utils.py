@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from sklearn.metrics import (
+    accuracy_score, precision_score, recall_score, f1_score, jaccard_score, confusion_matrix,
+)
+
+import evaluation_utils
+from evaluation_utils import confusion_bincount, evaluate_confusion
+
+
+def masked_labels(pred, ref, nodata=-9999):
+    mask = (~np.isnan(pred)) & (~np.isnan(ref)) & (ref != nodata) & (pred != nodata)
+    return ref[mask].astype(int), pred[mask].astype(int)
+
+
+def sklearn_metrics(ref_f, pred_f, average):
+    kwargs = dict(average=average, zero_division=0)
+    return {
+        "Accuracy": accuracy_score(ref_f, pred_f),
+        "Precision": precision_score(ref_f, pred_f, **kwargs),
+        "Recall": recall_score(ref_f, pred_f, **kwargs),
+        "F1": f1_score(ref_f, pred_f, **kwargs),
+        "IoU": jaccard_score(ref_f, pred_f, **kwargs),
+    }
+
+
+def label_maps(ref_labels, pred_labels, seed=0, shape=(70, 90)):
+    rng = np.random.default_rng(seed)
+    ref = rng.choice(ref_labels, shape).astype(np.float32)
+    pred = rng.choice(pred_labels, shape).astype(np.float32)
+    for arr in (ref, pred):
+        arr[rng.random(shape) < 0.05] = np.nan
+        arr[rng.random(shape) < 0.05] = -9999
+    return ref, pred
+
+
+CASES = {
+    "binary": ([0, 1], [0, 1]),
+    "three_class": ([0, 1, 2], [0, 1, 2]),
+    # Label 1 absent from both maps; 3 only predicted (zero recall division)
+    "gaps": ([0, 2], [0, 2, 3]),
+    "one_class": ([1], [1]),
+    # Reference all 0, prediction all 1: every score divides by zero somewhere
+    "disjoint": ([0], [1]),
+}
+
+
+@pytest.mark.filterwarnings("ignore:A single label was found")
+@pytest.mark.parametrize("case", list(CASES))
+@pytest.mark.parametrize("chunk_pixels", [None, 997])
+def test_matches_sklearn_macro(monkeypatch, case, chunk_pixels):
+    if chunk_pixels:
+        monkeypatch.setattr(evaluation_utils, "EVAL_CHUNK_PIXELS", chunk_pixels)
+    ref, pred = label_maps(*CASES[case])
+    ref_f, pred_f = masked_labels(pred, ref)
+
+    labels, cm = confusion_bincount(ref, pred)
+    assert labels.tolist() == sorted(set(ref_f) | set(pred_f))
+    assert np.array_equal(cm, confusion_matrix(ref_f, pred_f))
+
+    got = evaluate_confusion(pred, ref, average="macro")
+    for key, value in sklearn_metrics(ref_f, pred_f, "macro").items():
+        assert got[key] == pytest.approx(value, rel=1e-12, abs=0), key
+    assert got["Confusion"] == confusion_matrix(ref_f, pred_f).tolist()
+
+
+@pytest.mark.parametrize("case", ["binary", "one_class", "disjoint"])
+def test_matches_sklearn_binary(case):
+    ref, pred = label_maps(*CASES[case], seed=1)
+    ref_f, pred_f = masked_labels(pred, ref)
+    got = evaluate_confusion(pred, ref, average="binary")
+    for key, value in sklearn_metrics(ref_f, pred_f, "binary").items():
+        assert got[key] == pytest.approx(value, rel=1e-12, abs=0), key
+
+
+def test_integer_maps_and_all_masked():
+    ref = np.array([[0, 1, -9999], [1, 1, 0]], dtype=np.int16)
+    pred = np.array([[0, 0, 1], [1, -9999, 1]], dtype=np.int16)
+    labels, cm = confusion_bincount(ref, pred)
+    assert labels.tolist() == [0, 1]
+    assert cm.tolist() == [[1, 1], [1, 1]]
+
+    labels, cm = confusion_bincount(np.full((3, 3), np.nan), np.zeros((3, 3)))
+    assert labels.size == 0 and cm.size == 0
+    assert evaluate_confusion(np.zeros((3, 3)), np.full((3, 3), np.nan))["Accuracy"] == 0.0
+
+
+def test_shape_mismatch():
+    with pytest.raises(ValueError):
+        confusion_bincount(np.zeros((2, 3)), np.zeros((3, 2)))
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+import fwdet_utils
+
+
+def basin(shape=(60, 80), radius=20, rim=10.0):
+    """Flat-floored circular basin (floor 0) with a rim at `rim` m, flooded to the rim."""
+    rows, cols = np.indices(shape)
+    r = np.hypot(rows - shape[0] / 2, cols - shape[1] / 2)
+    flood = r < radius
+    dem = np.where(flood, 0.0, rim).astype(np.float32)
+    return flood, dem
+
+
+def test_flat_basin_depth_is_rim_height():
+    flood, dem = basin()
+    depth = fwdet_utils.fwdet_depth(flood, dem, pixel_size=(10, 10), max_distance=None)
+    assert np.all(np.isnan(depth[~flood]))
+    np.testing.assert_allclose(depth[flood], 10.0, rtol=1e-6)
+
+
+def test_sloped_basin_tracks_water_level():
+    # Bowl floor below a 6 m shoreline: depth is shoreline minus floor,
+    # up to the 7x7 smoothing of the floor curvature
+    rows, cols = np.indices((81, 81))
+    r = np.hypot(rows - 40, cols - 40)
+    dem = (0.01 * r ** 2).astype(np.float32)
+    flood = dem < 6
+    depth = fwdet_utils.fwdet_depth(flood, dem, pixel_size=(1, 1), max_distance=None)
+
+    shoreline = dem[~flood & (r < 26)].min()
+    expected = shoreline - dem
+    interior = flood & (r < 20)
+    assert np.abs(depth[interior] - expected[interior]).max() < 0.25
+    assert np.nanmin(depth) >= 0
+
+
+def test_outlier_spike_is_filled():
+    # Rough floor: on a perfectly flat one the median deviation is 0 and,
+    # as in GEE, nothing is replaced
+    flood, dem = basin()
+    dem += np.random.default_rng(0).normal(0, 0.1, dem.shape).astype(np.float32)
+    spiked = dem.copy()
+    spiked[30, 40] = 50.0
+
+    clean = fwdet_utils.fwdet_depth(flood, dem, pixel_size=(10, 10), max_distance=None)
+    depth = fwdet_utils.fwdet_depth(flood, spiked, pixel_size=(10, 10), max_distance=None)
+    # Unfilled, the spike would lower the 7x7 mean around it by about 1 m
+    assert np.abs(depth - clean)[flood].max() < 0.01
+
+
+def test_max_distance_leaves_far_pixels_empty():
+    flood, dem = basin(radius=25)
+    depth = fwdet_utils.fwdet_depth(flood, dem, pixel_size=(10, 10), max_distance=100)
+    rows, cols = np.indices(flood.shape)
+    r = np.hypot(rows - 30, cols - 40)
+    assert np.isnan(depth[r < 10]).all()
+    assert not np.isnan(depth[flood & (r > 22)]).any()
+
+
+def write(path, array, dtype, nodata=None):
+    with rasterio.open(
+        path, "w", driver="GTiff", height=array.shape[0], width=array.shape[1], count=1,
+        dtype=dtype, nodata=nodata, crs="EPSG:32631",
+        transform=from_origin(600000, 1300000, 10, 10),
+    ) as dst:
+        dst.write(array.astype(dtype), 1)
+    return str(path)
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_blocked_raster_matches_whole(tmp_path, n_workers):
+    rng = np.random.default_rng(0)
+    rows, cols = np.indices((90, 120))
+    dem = 0.002 * ((rows - 45) ** 2 + (cols - 60) ** 2) + rng.normal(0, 0.2, rows.shape)
+    flood = dem < 4
+    dem_path = write(tmp_path / "dem.tif", dem, "float32", nodata=-9999)
+    mask_path = write(tmp_path / "mask.tif", flood, "uint8")
+
+    whole = fwdet_utils.fwdet_raster(mask_path, dem_path, str(tmp_path / "whole.tif"),
+                                     block_size=1000, max_distance=150)
+    blocked = fwdet_utils.fwdet_raster(mask_path, dem_path, str(tmp_path / "blocked.tif"),
+                                       block_size=16, max_distance=150, n_workers=n_workers)
+    with rasterio.open(whole) as a, rasterio.open(blocked) as b:
+        expected, got = a.read(1), b.read(1)
+    assert (~np.isnan(expected)).any()
+    assert np.array_equal(got, expected, equal_nan=True)
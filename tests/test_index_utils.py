@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import index_utils
+
+
+def landsat_chunk(shape=(40, 50), seed=0):
+    rng = np.random.default_rng(seed)
+    bands = {band: rng.integers(0, 20000, shape).astype(np.uint16)
+             for band in index_utils.LANDSAT_BANDS}
+    bands["green"][0, :5] = bands["swir1"][0, :5] = 0
+    bands["green"][1, :5] = bands["nir"][1, :5] = 0
+    return bands
+
+
+def reference(bands, name):
+    b = {key: value.astype(np.float32) for key, value in bands.items()}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if name == "MNDWI":
+            return np.where(b["green"] + b["swir1"] != 0,
+                            (b["green"] - b["swir1"]) / (b["green"] + b["swir1"]), 0)
+        if name == "NDWI":
+            return np.where(b["green"] + b["nir"] != 0,
+                            (b["green"] - b["nir"]) / (b["green"] + b["nir"]), 0)
+    if name == "AWEI_nsh":
+        return 4 * (b["green"] - b["swir1"]) - (0.25 * b["nir"] + 2.75 * b["swir2"])
+    return b["blue"] + 2.5 * b["green"] - 1.5 * (b["nir"] + b["swir1"]) - 0.25 * b["swir2"]
+
+
+@pytest.mark.parametrize("engine", ["numpy", "numexpr"])
+def test_indices_match_reference(engine):
+    if engine == "numexpr":
+        pytest.importorskip("numexpr")
+    bands = landsat_chunk()
+    names = list(index_utils.INDEX_EXPRESSIONS)
+    values = index_utils.compute_indices(bands, names, chunk_pixels=333, engine=engine)
+    for name in names:
+        assert values[name].dtype == np.float32
+        np.testing.assert_allclose(values[name], reference(bands, name), rtol=1e-6)
+    # Zero denominators give 0
+    assert not values["MNDWI"][0, :5].any() and not values["NDWI"][1, :5].any()
+
+
+def test_non_contiguous_out_is_filled():
+    bands = landsat_chunk()
+    names = ["MNDWI", "NDWI"]
+    # Transposed buffer and a strided band of a pixel-interleaved block
+    transposed = np.zeros(bands["green"].shape[::-1], dtype=np.float32).T
+    interleaved = np.zeros(bands["green"].shape + (2,), dtype=np.float32)
+    out = {"MNDWI": transposed, "NDWI": interleaved[..., 1]}
+    assert not transposed.flags.c_contiguous and not out["NDWI"].flags.c_contiguous
+
+    values = index_utils.compute_indices(bands, names, out=out, chunk_pixels=333)
+    expected = index_utils.compute_indices(bands, names, chunk_pixels=333)
+    for name in names:
+        assert values[name] is out[name]
+        assert np.array_equal(out[name], expected[name])
+    assert np.array_equal(interleaved[..., 1], expected["NDWI"])
+    assert not interleaved[..., 0].any()
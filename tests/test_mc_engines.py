@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+
+def edge_mndwi(thresholds, dtype, shape=(64, 64), seed=0):
+    """Random MNDWI with pixels exactly on and next to every threshold."""
+    rng = np.random.default_rng(seed)
+    mndwi = rng.uniform(-1, 1, shape).astype(dtype)
+    th = thresholds.astype(dtype)
+    edge = np.concatenate([
+        th,
+        np.nextafter(th, dtype(-np.inf)),
+        np.nextafter(th, dtype(np.inf)),
+        np.array([np.nan, -1, 0, 1], dtype=dtype),
+    ])
+    flat = mndwi.reshape(-1)
+    n = min(edge.size, flat.size)
+    flat[:n] = edge[:n]
+    return mndwi
+
+
+@pytest.mark.parametrize("distribution", ["linspace", "truncnorm", "beta"])
+@pytest.mark.parametrize("runs", [7, 1000, 1237])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_exact_matches_loop_float(ensemble, monkeypatch, distribution, runs, dtype):
+    monkeypatch.setattr(ensemble, "MC_DISTRIBUTION", distribution)
+    monkeypatch.setattr(ensemble, "MC_RUNS", runs)
+    # Small chunks so the chunk boundaries are exercised too
+    monkeypatch.setattr(ensemble, "MC_CHUNK_PIXELS", 1000)
+
+    thresholds = ensemble.mc_thresholds()
+    assert thresholds.size == runs
+    mndwi = edge_mndwi(thresholds, dtype, shape=(64, 96))
+
+    exact = ensemble.water_count_exact(mndwi, thresholds)
+    loop = ensemble.water_count_loop(mndwi, thresholds)
+    assert np.array_equal(exact, loop)
+    assert np.array_equal(
+        ensemble.monte_carlo_mndwi_probability(mndwi, method="exact"),
+        ensemble.monte_carlo_mndwi_probability(mndwi, method="loop"),
+    )
+
+
+@pytest.mark.parametrize("distribution", ["linspace", "truncnorm", "beta"])
+@pytest.mark.parametrize("runs", [7, 1000, 1237])
+@pytest.mark.parametrize("dtype", [np.int16, np.int32])
+def test_exact_matches_loop_integer(ensemble, monkeypatch, distribution, runs, dtype):
+    monkeypatch.setattr(ensemble, "MC_DISTRIBUTION", distribution)
+    monkeypatch.setattr(ensemble, "MC_RUNS", runs)
+
+    thresholds = ensemble.mc_thresholds()
+    rng = np.random.default_rng(1)
+    mndwi = rng.integers(-2, 3, (50, 70)).astype(dtype)
+
+    exact = ensemble.water_count_exact(mndwi, thresholds)
+    loop = ensemble.water_count_loop(mndwi, thresholds)
+    assert np.array_equal(exact, loop)
+
+
+@pytest.mark.parametrize("distribution", ["linspace", "truncnorm", "beta"])
+@pytest.mark.parametrize("runs", [7, 1000, 1237])
+def test_layers_follow_method(ensemble, monkeypatch, distribution, runs):
+    monkeypatch.setattr(ensemble, "MC_DISTRIBUTION", distribution)
+    monkeypatch.setattr(ensemble, "MC_RUNS", runs)
+    monkeypatch.setattr(ensemble, "MC_CHUNK_PIXELS", 1000)
+
+    mndwi = edge_mndwi(ensemble.mc_thresholds(), np.float32, shape=(48, 64))
+    uresnet_prob = np.random.default_rng(2).uniform(0, 1, mndwi.shape).astype(np.float32)
+
+    exact = ensemble.monte_carlo_mndwi_layers(mndwi, uresnet_prob, method="exact")
+    loop = ensemble.monte_carlo_mndwi_layers(mndwi, uresnet_prob, method="loop")
+    assert np.array_equal(exact, loop, equal_nan=True)
+    assert np.array_equal(exact[0], ensemble.monte_carlo_mndwi_probability(mndwi))
+
+
+def baseline_mndwi(green, swir):
+    """compute_mndwi as script 8 had it, on the float32 bands it read."""
+    green, swir = green.astype(np.float32), swir.astype(np.float32)
+    numerator = green - swir
+    denominator = green + swir
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=np.float32),
+                     where=(denominator != 0))
+
+
+@pytest.mark.parametrize("engine", ["numpy", "numexpr"])
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32, np.float64])
+def test_compute_mndwi_matches_baseline(ensemble, monkeypatch, engine, dtype):
+    if engine == "numexpr":
+        pytest.importorskip("numexpr")
+    import index_utils
+    monkeypatch.setattr(index_utils, "INDEX_ENGINE", engine)
+    monkeypatch.setattr(index_utils, "INDEX_CHUNK_PIXELS", 1000)
+
+    rng = np.random.default_rng(3)
+    if np.issubdtype(dtype, np.integer):
+        green = rng.integers(0, 30000, (60, 80)).astype(dtype)
+        swir = rng.integers(0, 30000, (60, 80)).astype(dtype)
+    else:
+        green = rng.uniform(-0.2, 1, (60, 80)).astype(dtype)
+        swir = rng.uniform(-0.2, 1, (60, 80)).astype(dtype)
+        # Opposite values: zero denominator with a nonzero numerator
+        green[1, :10], swir[1, :10] = 0.25, -0.25
+    # Zero denominator from both bands being 0
+    green[0, :10] = swir[0, :10] = 0
+
+    mndwi = ensemble.compute_mndwi(green, swir)
+    assert mndwi.dtype == np.float32
+    assert np.array_equal(mndwi, baseline_mndwi(green, swir))
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+import rasterio
+import rasterio.mask
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+import raster_utils
+
+
+class Reservoir:
+    def __init__(self, geometry):
+        self.geometry = geometry
+
+
+def baseline_mean_reflectance(scene_folder, reservoir, bands):
+    """compute_mean_reflectance before the integer rewrite (float32 nanmean)."""
+    values = []
+    for b in bands:
+        path = os.path.join(scene_folder, f"LC09_SR_B{b}.TIF")
+        with rasterio.open(path) as src:
+            arr, _ = rasterio.mask.mask(src, reservoir.geometry, crop=True)
+            img = arr[0].astype("float32")
+            img[img == 0] = np.nan
+            values.append(np.nanmean(img))
+    return values
+
+
+@pytest.fixture
+def scene(tmp_path, reflectance):
+    rng = np.random.default_rng(0)
+    transform = from_origin(600000, 1300000, 30, 30)
+    for b in reflectance.BAND_LIST:
+        data = rng.integers(7000 + 1000 * b, 15000 + 1000 * b, (120, 150)).astype(np.uint16)
+        # Fill (0) inside the reservoir is excluded, as the old zero-to-NaN rule
+        data[50:60, 60:80] = 0
+        with rasterio.open(
+            tmp_path / f"LC09_SR_B{b}.TIF", "w", driver="GTiff", height=120, width=150,
+            count=1, dtype="uint16", nodata=0, crs="EPSG:32631", transform=transform,
+        ) as dst:
+            dst.write(data, 1)
+    reservoir = Reservoir([Point(600000 + 75 * 30, 1300000 - 60 * 30).buffer(1200)])
+    raster_utils.clear_clip_mask_cache()
+    yield str(tmp_path), reservoir
+    raster_utils.clear_clip_mask_cache()
+
+
+@pytest.mark.parametrize("block_rows", [1024, 7])
+def test_integer_means_match_float_baseline(reflectance, monkeypatch, scene, block_rows):
+    monkeypatch.setattr(reflectance, "BLOCK_ROWS", block_rows)
+    folder, reservoir = scene
+
+    means = reflectance.compute_mean_reflectance(folder, reservoir)
+    expected = baseline_mean_reflectance(folder, reservoir, reflectance.BAND_LIST)
+    # The integer sum is exact; the old float32 nanmean carries rounding
+    np.testing.assert_allclose(means, expected, rtol=1e-6)
+
+
+def test_histogram_stats_match_numpy(reflectance, scene):
+    folder, reservoir = scene
+    _, stats = reflectance.compute_mean_reflectance(folder, reservoir, stats=True)
+
+    for b, band_stats in zip(reflectance.BAND_LIST, stats):
+        with rasterio.open(os.path.join(folder, f"LC09_SR_B{b}.TIF")) as src:
+            arr, _ = rasterio.mask.mask(src, reservoir.geometry, crop=True)
+        values = arr[0][arr[0] != 0].astype(np.float64)
+        assert band_stats["median"] == np.percentile(values, 50)
+        for q in reflectance.STATS_PERCENTILES:
+            assert band_stats[f"p{q}"] == np.percentile(values, q)
+        assert band_stats["std"] == pytest.approx(np.std(values), rel=1e-12)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from sklearn.metrics import (
+    accuracy_score, precision_score, recall_score, f1_score, jaccard_score, confusion_matrix,
+)
+
+from evaluation_utils import class_histograms, threshold_sweep
+
+# Five-threshold set of script 12
+THRESHOLDS = [0.10, 0.20, 0.22, 0.40, 0.90]
+
+
+def sklearn_evaluate(pred, ref):
+    """evaluate_model as script 12 had it before the bincount rewrite."""
+    mask = (~np.isnan(pred)) & (~np.isnan(ref)) & (ref != -9999) & (pred != -9999)
+    pred_f = pred[mask].astype(int).flatten()
+    ref_f = ref[mask].astype(int).flatten()
+    return {
+        "Accuracy": accuracy_score(ref_f, pred_f),
+        "Precision": precision_score(ref_f, pred_f, average="macro", zero_division=0),
+        "Recall": recall_score(ref_f, pred_f, average="macro", zero_division=0),
+        "F1": f1_score(ref_f, pred_f, average="macro", zero_division=0),
+        "IoU": jaccard_score(ref_f, pred_f, average="macro", zero_division=0),
+        "Confusion": confusion_matrix(ref_f, pred_f).tolist(),
+    }
+
+
+def sweep_inputs(n_classes, seed=0, shape=(80, 90)):
+    rng = np.random.default_rng(seed)
+    pred = rng.integers(0, n_classes, shape).astype(np.float32)
+    pred[rng.random(shape) < 0.05] = np.nan
+    pred[rng.random(shape) < 0.05] = -9999
+
+    sen2 = rng.uniform(0, 1, shape).astype(np.float32)
+    # Ties on every threshold, in the float32 the rasters are read as
+    ties = np.array(THRESHOLDS, dtype=np.float32)
+    sen2.reshape(-1)[:ties.size * 20] = np.repeat(ties, 20)
+    sen2[rng.random(shape) < 0.05] = np.nan
+    sen2[rng.random(shape) < 0.02] = -9999
+    return pred, sen2
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+@pytest.mark.parametrize("i", range(len(THRESHOLDS)))
+def test_sweep_matches_per_threshold_evaluation(n_classes, i):
+    pred, sen2 = sweep_inputs(n_classes, seed=n_classes)
+    sweep = threshold_sweep(class_histograms(pred, sen2), THRESHOLDS)
+
+    thr = THRESHOLDS[i]
+    expected = sklearn_evaluate(pred, (sen2 > thr).astype(np.uint8))
+    got = sweep["metrics"][i]
+    assert got["Confusion"] == expected["Confusion"]
+    for key in ["Accuracy", "Precision", "Recall", "F1", "IoU"]:
+        assert got[key] == expected[key], key
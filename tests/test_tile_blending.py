@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+import inference_utils
+
+
+class ArrayWriter:
+    """Stands in for a rasterio dataset: records every windowed write."""
+
+    def __init__(self, count, height, width):
+        self.data = np.full((count, height, width), np.nan, dtype=np.float32)
+        self.writes = np.zeros((height, width), dtype=np.int64)
+
+    def write(self, arr, window):
+        r, c = int(window.row_off), int(window.col_off)
+        h, w = int(window.height), int(window.width)
+        self.data[:, r:r + h, c:c + w] = arr
+        self.writes[r:r + h, c:c + w] += 1
+
+
+@pytest.mark.parametrize("blend", ["cosine", "gaussian"])
+@pytest.mark.parametrize("shape", [(100, 130), (32, 32), (17, 90)])
+def test_blend_weights_sum_to_one(blend, shape):
+    height, width = shape
+    tile_size, padding = 32, 8
+    origins = inference_utils.tile_origins(width, height, tile_size, padding)
+    # Constant tiles: the output is sum(w * c) / sum(w), so c exactly where
+    # the normalized weights of the overlapping tiles sum to 1
+    predictions = ((origin, np.full((1, tile_size, tile_size), 0.3, np.float32))
+                   for origin in origins)
+    dst = ArrayWriter(1, height, width)
+    inference_utils._stitch_blended(
+        dst, predictions, width, height, tile_size, padding,
+        inference_utils.weight_window(tile_size, blend),
+    )
+
+    assert (dst.writes == 1).all()
+    np.testing.assert_allclose(dst.data, 0.3, rtol=1e-6)
+
+
+@pytest.mark.parametrize("blend", ["center", "cosine", "gaussian"])
+def test_pointwise_model_matches_full_image(tmp_path, blend):
+    rng = np.random.default_rng(0)
+    image = rng.normal(0, 2, (2, 75, 110)).astype(np.float32)
+    in_path, out_path = str(tmp_path / "in.tif"), str(tmp_path / "prob.tif")
+    with rasterio.open(
+        in_path, "w", driver="GTiff", height=75, width=110, count=2, dtype="float32",
+        crs="EPSG:32631", transform=from_origin(0, 0, 10, 10),
+    ) as dst:
+        dst.write(image)
+
+    # Logit of each pixel depends on that pixel only, so tiling cannot change it
+    def model(batch):
+        return batch[:, :1] - 0.5 * batch[:, 1:2]
+
+    inference_utils.predict_raster(model, in_path, out_path, tile_size=32, padding=8,
+                                   batch_size=5, blend=blend)
+    with rasterio.open(out_path) as src:
+        prob = src.read(1)
+    expected = 1.0 / (1.0 + np.exp(-(image[0] - 0.5 * image[1])))
+    np.testing.assert_allclose(prob, expected, rtol=1e-5, atol=1e-6)
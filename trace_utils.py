@@ -0,0 +1,242 @@
+#trace_utils.py
+"""
+Lightweight per-stage instrumentation for the pipeline scripts.
+
+Tracing is off by default. It is switched on with configure(path), from a
+script with setup(TRACE_PATH), or by setting MNDWI_TRACE to an output path
+before a script starts. Paths ending in .json are written as a Chrome trace
+(chrome://tracing, Perfetto); any other path gets one JSON line per
+finished span.
+
+    with span("scene", scene=name):
+        with span("read") as s:
+            arr = src.read(1)
+            s.add(bytes_read=arr.nbytes, pixels=arr.size)
+
+Spans nest per thread. Each finished span records its duration, parent,
+counters (bytes_read, bytes_written, pixels, ...), pixel throughput and
+the process peak RSS; byte counters also roll up into the parent span.
+When tracing is off, span() returns a shared no-op object and add()
+returns immediately.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from functools import wraps
+
+TRACE_ENV = "MNDWI_TRACE"
+# Pid of the process that started the trace file, inherited by workers
+TRACE_PARENT_ENV = "MNDWI_TRACE_PARENT"
+
+# Counters summed into the enclosing span when a span closes, so a scene
+# span reports the total bytes of its read/write children
+ROLLUP_COUNTERS = ("bytes_read", "bytes_written")
+
+_enabled = False
+_writer = None
+_local = threading.local()
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+    except ImportError:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024 / 1024
+
+# Writer
+# Both formats are appended line by line (line-buffered), so spans from
+# forked or spawned workers interleave by whole lines in one file and
+# nothing is lost if a worker exits without running atexit handlers. Chrome
+# traces use the JSON array format, whose closing bracket is optional.
+
+def chrome_event(record):
+    args = dict(record["attrs"], **record["counters"])
+    for key in ("peak_rss_mb", "mpix_per_s", "error"):
+        if key in record:
+            args[key] = record[key]
+    return {
+        "name": record["name"], "ph": "X", "pid": record["pid"],
+        "tid": record["tid"], "ts": record["start"] * 1e6,
+        "dur": record["seconds"] * 1e6, "args": args,
+    }
+
+
+class TraceWriter:
+    def __init__(self, path, truncate=True):
+        self.chrome = path.lower().endswith(".json")
+        self.lock = threading.Lock()
+        if truncate:
+            open(path, "w").close()
+        # Always O_APPEND, so concurrent writers never overwrite each other
+        self.file = open(path, "a", buffering=1)
+        if self.chrome and self.file.tell() == 0:
+            self.file.write("[\n")
+
+    def emit(self, record):
+        if self.chrome:
+            line = json.dumps(chrome_event(record)) + ",\n"
+        else:
+            line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+
+def configure(path=None):
+    """Enable tracing to path (None disables it); returns whether tracing is on."""
+    global _enabled, _writer
+    close()
+
+    if not path:
+        return False
+
+    # The first process starts a fresh file; workers that inherit the
+    # environment append to it
+    parent = os.environ.get(TRACE_PARENT_ENV)
+    truncate = parent is None or parent == str(os.getpid())
+    os.environ[TRACE_ENV] = path
+    os.environ[TRACE_PARENT_ENV] = parent if not truncate else str(os.getpid())
+
+    _writer = TraceWriter(path, truncate)
+    _enabled = True
+    return True
+
+
+def setup(path=None):
+    """Script entry point: trace to path, else to MNDWI_TRACE when it is set.
+
+    Scripts call this with their TRACE_PATH constant. Tracing that is
+    already on for the same path (e.g. from MNDWI_TRACE at import) is left
+    running rather than restarted.
+    """
+    path = path or os.environ.get(TRACE_ENV)
+    if path and not (_enabled and path == os.environ.get(TRACE_ENV)):
+        return configure(path)
+    return _enabled
+
+
+def close():
+    global _enabled, _writer
+    _enabled = False
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def enabled():
+    return _enabled
+
+# Spans
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._t0
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].add(**{
+                k: v for k, v in self.counters.items() if k in ROLLUP_COUNTERS
+            })
+
+        record = {
+            "name": self.name, "parent": self.parent, "depth": self.depth,
+            "start": self.start, "seconds": seconds,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "attrs": self.attrs, "counters": self.counters,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if self.counters.get("pixels") and seconds > 0:
+            record["mpix_per_s"] = self.counters["pixels"] / seconds / 1e6
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+
+        writer = _writer
+        if writer is not None:
+            writer.emit(record)
+        return False
+
+
+def span(name, **attrs):
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def add(**counters):
+    """Add counters to the innermost open span of this thread."""
+    if not _enabled:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].add(**counters)
+
+
+def traced(name=None):
+    """Decorator wrapping every call in a span."""
+    def decorate(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+atexit.register(close)
+
+if os.environ.get(TRACE_ENV):
+    configure(os.environ[TRACE_ENV])
@@ -0,0 +1,288 @@
+#train_utils.py
+"""
+Local CPU training of the UNET / DEEPLAB / PSPNET x RESNET34 / VGG16_BN
+matrix from 6_train_models.py, without ArcPy.
+
+Models come from segmentation_models_pytorch and data from the packed chip
+store (chip_utils). Jobs run in separate processes, as many at once as the
+core budget allows, each with its share of torch threads. Every epoch is
+checkpointed, so an interrupted matrix resumes where it stopped, and
+per-epoch throughput, wall time and peak memory go to results tables.
+"""
+
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from chip_utils import BATCH_SIZE, CHIP_SIZE, VALID_FRACTION, chip_loaders, load_index
+from trace_utils import peak_rss_mb, span
+
+# Output folder names match the ArcPy runs in 6_train_models.py
+TRAIN_MATRIX = [
+    ("UNET", "RESNET34", "UResNet"),
+    ("UNET", "VGG16_BN", "UVGG16"),
+    ("DEEPLAB", "RESNET34", "DpLResNet"),
+    ("DEEPLAB", "VGG16_BN", "DpLVGG16"),
+    ("PSPNET", "RESNET34", "PSPResNet"),
+    ("PSPNET", "VGG16_BN", "PSPVGG16"),
+]
+
+MAX_EPOCHS = 100
+PATIENCE = 5          # epochs without a valid_loss improvement before stopping
+LEARNING_RATE = 1e-3
+NUM_CLASSES = 2       # background + SurfaceWaterExtent
+CORE_BUDGET = None    # defaults to os.cpu_count()
+MAX_CONCURRENT = None
+LOADER_WORKERS = 0
+
+EPOCHS_TABLE = "training_epochs.csv"
+RESULTS_TABLE = "training_results.csv"
+
+# Models
+
+def build_model(model_type, backbone, in_channels, classes=NUM_CLASSES):
+    import segmentation_models_pytorch as smp
+
+    encoder = backbone.lower().replace("timm:", "")
+    kwargs = dict(encoder_name=encoder, encoder_weights=None,
+                  in_channels=in_channels, classes=classes)
+
+    if model_type == "UNET":
+        return smp.Unet(**kwargs)
+    if model_type == "PSPNET":
+        return smp.PSPNet(**kwargs)
+    if model_type == "DEEPLAB":
+        if encoder.startswith("vgg"):
+            # VGG cannot be dilated, so the ASPP head runs at stride 32
+            return _vgg_deeplab(encoder, in_channels, classes)
+        return smp.DeepLabV3(**kwargs)
+    raise ValueError(f"Unknown model type '{model_type}'")
+
+
+def _vgg_deeplab(encoder_name, in_channels, classes):
+    import torch
+    from torch.nn import functional as F
+    from segmentation_models_pytorch.encoders import get_encoder
+    from torchvision.models.segmentation.deeplabv3 import DeepLabHead
+
+    class VGGDeepLab(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = get_encoder(encoder_name, in_channels=in_channels, weights=None)
+            self.head = DeepLabHead(self.encoder.out_channels[-1], classes)
+
+        def forward(self, x):
+            out = self.head(self.encoder(x)[-1])
+            return F.interpolate(out, size=x.shape[-2:], mode="bilinear", align_corners=False)
+
+    return VGGDeepLab()
+
+# Single job
+
+def job_paths(out_dir, name):
+    job_dir = os.path.join(out_dir, name)
+    return {
+        "dir": job_dir,
+        "checkpoint": os.path.join(job_dir, "checkpoint.pt"),
+        "best": os.path.join(job_dir, "best.pt"),
+        "model": os.path.join(job_dir, f"{name}.pt"),
+        "history": os.path.join(job_dir, "history.json"),
+    }
+
+
+def _save_atomic(obj, path):
+    import torch
+
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _run_epoch(model, loader, loss_fn, optimizer=None):
+    import torch
+
+    training = optimizer is not None
+    model.train(training)
+    total_loss, correct, pixels, chips = 0.0, 0, 0, 0
+
+    with torch.set_grad_enabled(training):
+        for images, labels in loader:
+            logits = model(images)
+            loss = loss_fn(logits, labels)
+            if training:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            total_loss += loss.item() * images.shape[0]
+            correct += (logits.argmax(1) == labels).sum().item()
+            pixels += labels.numel()
+            chips += images.shape[0]
+
+    return total_loss / max(chips, 1), correct / max(pixels, 1), chips
+
+
+def train_job(model_type, backbone, name, store_dir, out_dir, n_threads=1,
+              max_epochs=MAX_EPOCHS, patience=PATIENCE, batch_size=BATCH_SIZE,
+              chip_size=CHIP_SIZE, valid_fraction=VALID_FRACTION,
+              learning_rate=LEARNING_RATE, loader_workers=LOADER_WORKERS):
+    """Train (or resume) one model; returns its per-epoch history."""
+    import torch
+
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(0)
+    paths = job_paths(out_dir, name)
+    os.makedirs(paths["dir"], exist_ok=True)
+
+    in_channels = load_index(store_dir)["shape"][1]
+    model = build_model(model_type, backbone, in_channels)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    state = {"epoch": 0, "best_loss": float("inf"), "bad_epochs": 0,
+             "history": [], "stopped": False}
+    if os.path.exists(paths["checkpoint"]):
+        checkpoint = torch.load(paths["checkpoint"], map_location="cpu", weights_only=False)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        state = checkpoint["state"]
+        torch.set_rng_state(checkpoint["rng"])
+
+    if state["stopped"] or state["epoch"] >= max_epochs:
+        if not os.path.exists(paths["model"]):
+            export_model(model, paths, in_channels, chip_size)
+        return state["history"]
+
+    train_loader, valid_loader = chip_loaders(
+        store_dir, batch_size, chip_size, valid_fraction, num_workers=loader_workers
+    )
+
+    while state["epoch"] < max_epochs:
+        # Augmentation is seeded per epoch, so a resumed run repeats it
+        train_loader.dataset.set_epoch(state["epoch"])
+        with span("epoch", job=name, epoch=state["epoch"] + 1) as s:
+            t0 = time.time()
+            train_loss, train_acc, n_chips = _run_epoch(model, train_loader, loss_fn, optimizer)
+            t1 = time.time()
+            valid_loss, valid_acc, _ = _run_epoch(model, valid_loader, loss_fn)
+            t2 = time.time()
+            s.add(chips=n_chips, pixels=n_chips * chip_size * chip_size)
+
+        state["epoch"] += 1
+        improved = valid_loss < state["best_loss"]
+        if improved:
+            state["best_loss"] = valid_loss
+            state["bad_epochs"] = 0
+            _save_atomic(model.state_dict(), paths["best"])
+        else:
+            state["bad_epochs"] += 1
+
+        state["history"].append({
+            "job": name, "model_type": model_type, "backbone": backbone,
+            "epoch": state["epoch"], "train_loss": train_loss,
+            "valid_loss": valid_loss, "train_accuracy": train_acc,
+            "valid_accuracy": valid_acc, "chips_per_s": n_chips / max(t1 - t0, 1e-9),
+            "epoch_seconds": t2 - t0, "peak_rss_mb": peak_rss_mb(),
+            "threads": n_threads, "improved": improved,
+        })
+
+        state["stopped"] = state["bad_epochs"] >= patience
+
+        _save_atomic({
+            "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+            "state": state, "rng": torch.get_rng_state(),
+        }, paths["checkpoint"])
+        with open(paths["history"], "w") as f:
+            json.dump(state["history"], f, indent=2)
+
+        print(f"{name} epoch {state['epoch']}: train_loss {train_loss:.4f}, "
+              f"valid_loss {valid_loss:.4f}, {n_chips / (t1 - t0):.1f} chips/s")
+        if state["stopped"]:
+            break
+
+    export_model(model, paths, in_channels, chip_size)
+    return state["history"]
+
+
+def export_model(model, paths, in_channels, chip_size):
+    # Best weights as TorchScript, loadable by inference_utils.load_model
+    import torch
+
+    model.load_state_dict(torch.load(paths["best"], map_location="cpu"))
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros(1, in_channels, chip_size, chip_size))
+    traced.save(paths["model"])
+
+# Matrix
+
+def plan_threads(n_jobs, core_budget=None, max_concurrent=None):
+    """(concurrent jobs, torch threads per job) within the core budget."""
+    core_budget = core_budget or os.cpu_count() or 1
+    concurrent = min(n_jobs, max_concurrent or core_budget, core_budget)
+    concurrent = max(concurrent, 1)
+    return concurrent, max(1, core_budget // concurrent)
+
+
+def _job_summary(job, history, wall_seconds, status):
+    model_type, backbone, name = job[:3]
+    summary = {"job": name, "model_type": model_type, "backbone": backbone,
+               "status": status, "wall_seconds": wall_seconds}
+    if not history:
+        return summary
+    epochs = pd.DataFrame(history)
+    best = epochs.loc[epochs["valid_loss"].idxmin()]
+    return {
+        **summary,
+        "epochs": int(epochs["epoch"].max()), "best_epoch": int(best["epoch"]),
+        "best_valid_loss": float(best["valid_loss"]),
+        "best_valid_accuracy": float(best["valid_accuracy"]),
+        "mean_chips_per_s": float(epochs["chips_per_s"].mean()),
+        "train_seconds": float(epochs["epoch_seconds"].sum()),
+        "peak_rss_mb": float(epochs["peak_rss_mb"].max()),
+    }
+
+
+def _timed_job(args):
+    t0 = time.time()
+    with span("train", job=args[2], model_type=args[0], backbone=args[1]):
+        history = train_job(*args[:5], **args[5])
+    return history, time.time() - t0
+
+
+def run_matrix(store_dir, out_dir, matrix=None, core_budget=CORE_BUDGET,
+               max_concurrent=MAX_CONCURRENT, **train_kwargs):
+    """Train every (model_type, backbone, name) job; returns the results table."""
+    matrix = matrix or TRAIN_MATRIX
+    os.makedirs(out_dir, exist_ok=True)
+    concurrent, threads = plan_threads(len(matrix), core_budget, max_concurrent)
+    print(f"Training {len(matrix)} models, {concurrent} at a time with {threads} threads each")
+
+    jobs = [
+        (model_type, backbone, name, store_dir, out_dir, dict(train_kwargs, n_threads=threads))
+        for model_type, backbone, name in matrix
+    ]
+
+    histories, summaries = [], []
+    # One fresh spawned process per job: torch's thread pools are never
+    # forked and each job's peak memory is its own
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=concurrent, mp_context=context,
+                             max_tasks_per_child=1) as pool:
+        futures = {pool.submit(_timed_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                history, wall = future.result()
+                summaries.append(_job_summary(job, history, wall, "done"))
+                histories.extend(history)
+            except Exception as e:
+                print(f"{job[2]} failed: {e}")
+                summaries.append(_job_summary(job, [], None, f"failed: {e}"))
+
+    pd.DataFrame(histories).to_csv(os.path.join(out_dir, EPOCHS_TABLE), index=False)
+    results = pd.DataFrame(summaries)
+    results.to_csv(os.path.join(out_dir, RESULTS_TABLE), index=False)
+    return results